@@ -0,0 +1,129 @@
+""" Sample usage:
+    -  Format
+        $ python benchmarks.py [-i path_to_txt_file -m model_name | -n any_integer] -k [any integer] -ef [any integer ...]
+    -  Sentence index on 100000 synthetic embeddings, recall@10 and QPS for several ef_search values
+        $ python benchmarks.py -n 100000 -k 10 -ef 16 32 64 128 256
+    -  Sentence index on real sentences (one per line), encoded with a SentenceTransformer model and an embedding cache
+        $ python benchmarks.py -i /Users/some_user/sentences.txt -m xlm-r-bert-base-nli-stsb-mean-tokens
+                               -ec ../output/embedding_cache/ -k 10 -ef 32 64 128
+
+    Builds a SentenceIndex in a temporary folder and prints its build time, and for each ef_search value, its recall@k
+    with respect to the exact (brute force) cosine similarity search, and the queries per second of both.
+    Queries are held-out sentences (or embeddings) that are not in the index.
+"""
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from tasks.data_augmentation.src.assisted_labeling.sentence_index import SentenceIndex
+from tasks.data_augmentation.src.zero_shot_classification.embedding_cache import EmbeddingCache
+from tasks.data_augmentation.src.zero_shot_classification.latent_embeddings_classifier import encode_all_sents, \
+    normalize_rows
+
+
+def synthetic_embeddings(n, dim, n_clusters=100, seed=42):
+    """
+    Random embeddings grouped around n_clusters centers, closer to the structure of sentence embeddings than
+    uniformly random vectors
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    return centers[rng.integers(n_clusters, size=n)] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+
+
+def sentence_embeddings(input_path, model_name, embedding_cache_folder):
+    from sentence_transformers import SentenceTransformer
+
+    with open(input_path, "r", encoding="utf-8") as f:
+        sentences = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+    cache = EmbeddingCache(embedding_cache_folder, model_name) if embedding_cache_folder else None
+    embeddings = encode_all_sents(sentences, SentenceTransformer(model_name), cache=cache)
+    if cache is not None:
+        cache.close()
+
+    return embeddings
+
+
+def brute_force_search(corpus_embeddings, query_embeddings, k):
+    """
+    Return the (number of queries x k) indices of the exact k most similar corpus embeddings of each query
+    """
+    similarities = normalize_rows(query_embeddings) @ normalize_rows(corpus_embeddings).T
+    top_k = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(similarities, top_k, axis=1), axis=1)
+
+    return np.take_along_axis(top_k, order, axis=1)
+
+
+def recall_at_k(exact_indices, ann_results):
+    """
+    Fraction of the exact k nearest neighbours found by the approximate search
+    """
+    n_found = sum(len(set(exact) & set(int(sent_id) for sent_id, _ in results))
+                  for exact, results in zip(exact_indices, ann_results))
+
+    return n_found / exact_indices.size
+
+
+def main(embeddings, n_queries, k, ef_searches, M, ef_construction):
+    query_embeddings, corpus_embeddings = embeddings[:n_queries], embeddings[n_queries:]
+    print(f"{len(corpus_embeddings)} sentences of dimension {embeddings.shape[1]}, {len(query_embeddings)} queries")
+
+    start = time.perf_counter()
+    exact_indices = brute_force_search(corpus_embeddings, query_embeddings, k)
+    brute_force_qps = len(query_embeddings) / (time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as index_folder:
+        index = SentenceIndex(index_folder, M=M, ef_construction=ef_construction,
+                              initial_capacity=len(corpus_embeddings))
+        start = time.perf_counter()
+        index.add_embeddings([str(i) for i in range(len(corpus_embeddings))], corpus_embeddings)
+        print(f"Index built in {time.perf_counter() - start:.2f} s (M={M}, ef_construction={ef_construction})")
+        print(f"Brute force: {brute_force_qps:.1f} queries/sec")
+
+        for ef_search in ef_searches:
+            index.set_ef_search(ef_search)
+            start = time.perf_counter()
+            results = index.search_embeddings(query_embeddings, k)
+            ann_qps = len(query_embeddings) / (time.perf_counter() - start)
+
+            print(f"ef_search={ef_search}: recall@{k} {recall_at_k(exact_indices, results):.4f}, "
+                  f"{ann_qps:.1f} queries/sec ({ann_qps / brute_force_qps:.1f}x)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-i', '--input_path', default=None,
+                        help="Text file with one sentence per line. If not given, synthetic embeddings are used")
+    parser.add_argument('-m', '--model_name', default="xlm-r-bert-base-nli-stsb-mean-tokens",
+                        help="Name or path of the SentenceTransformer model that encodes the sentences")
+    parser.add_argument('-ec', '--embedding_cache', default=None,
+                        help="Folder of the embedding cache of the model")
+    parser.add_argument('-n', '--n_sents', default=100000,
+                        help="Number of synthetic embeddings")
+    parser.add_argument('-d', '--dim', default=768,
+                        help="Dimension of the synthetic embeddings")
+    parser.add_argument('-q', '--queries', default=1000,
+                        help="Number of held-out queries")
+    parser.add_argument('-k', '--k', default=10,
+                        help="Number of neighbours per query")
+    parser.add_argument('-ef', '--ef_searches', nargs='+', default=["16", "32", "64", "128", "256"],
+                        help="Values of ef_search to benchmark")
+    parser.add_argument('-M', '--M', default=32,
+                        help="Number of links per element of the HNSW graph")
+    parser.add_argument('-efc', '--ef_construction', default=200,
+                        help="Size of the candidate list while building the index")
+
+    args = parser.parse_args()
+
+    if args.input_path is not None:
+        all_embeddings = sentence_embeddings(args.input_path, args.model_name, args.embedding_cache)
+    else:
+        all_embeddings = synthetic_embeddings(int(args.n_sents), int(args.dim))
+
+    main(all_embeddings, int(args.queries), int(args.k), [int(ef) for ef in args.ef_searches], int(args.M),
+         int(args.ef_construction))
@@ -0,0 +1,160 @@
+""" Sample usage:
+    -  Format
+        $ python query_engine.py -c [path_to_aws_credentials_json] -l [english | spanish] -i [any integer] -e [any integer]
+    -  Top 500 sentences of documents 14778 to 16420 for each English query
+        $ python query_engine.py -c /Users/some_user/credentials.json -l english -i 14778 -e 16420 -r 500
+    -  Same as above, with a local copy of the bucket and an embedding cache, so a second run only encodes new sentences
+        $ python query_engine.py -s /Users/some_user/wri-nlp-policy/ -l english -i 14778 -e 16420 -r 500
+                                 -ec ../output/embedding_cache/
+
+    Assisted labeling: for each query of the queries Excel file of the bucket, find the sentences of the given range of
+    documents that are the most similar to it, and store them as a CSV file to be labeled in the assisted labeling
+    folder of the bucket (see S3Client.store_assisted_labeling_csv()).
+
+    Sentences are streamed from the bucket and encoded in batches. The similarities between all the queries and a batch
+    are computed as a single matrix product, and only the top results_limit sentences of each query are kept in a heap,
+    so memory does not grow with the number of sentences.
+"""
+import heapq
+import argparse
+from itertools import count, islice
+
+import numpy as np
+
+from tasks.data_augmentation.src.zero_shot_classification.embedding_cache import EmbeddingCache
+from tasks.data_augmentation.src.zero_shot_classification.latent_embeddings_classifier import encode_all_sents, \
+    normalize_rows
+from tasks.data_loading import S3Client, LocalBackend
+
+
+class TopNHeap:
+    """
+    The n highest scored items pushed so far. Among items with the same score, the ones pushed first are kept
+    """
+
+    def __init__(self, n):
+        self.n = n
+        # Entries are (score, -push order, item), so the root is the lowest score, and the latest among equal scores
+        self.heap = []
+        self.counter = count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def min_score(self):
+        return self.heap[0][0] if len(self.heap) == self.n else -np.inf
+
+    def push(self, score, item):
+        entry = (score, -next(self.counter), item)
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, entry)
+        else:
+            heapq.heappushpop(self.heap, entry)
+
+    def items(self):
+        """
+        Return the (score, item) pairs from highest to lowest score
+        """
+        return [(score, item) for score, _, item in sorted(self.heap, reverse=True)]
+
+
+def query_top_sentences(sentences, queries, sbert_model, results_limit=500, similarity_threshold=0, batch_size=1024,
+                        embedding_cache=None, lowercase=True):
+    """
+    Find the results_limit sentences most similar to each query, among the ones whose cosine similarity is above the
+    threshold. sentences is an iterable of (sentence id, {"text": "Sample sentence text", ...}), as yielded by
+    S3Client.load_sentences(), consumed in batches of batch_size.
+    Return a dictionary of {query: [[sentence id, similarity score, sentence text], ...]}, with the sentences sorted
+    by descending similarity, in the format expected by S3Client.store_assisted_labeling_csv()
+    """
+    queries = list(queries)
+    prepare = str.lower if lowercase else str
+    query_reps = normalize_rows(encode_all_sents([prepare(query) for query in queries], sbert_model))
+    heaps = [TopNHeap(results_limit) for _ in queries]
+    n_candidates = min(results_limit, batch_size)
+
+    sentences = iter(sentences)
+    while True:
+        batch = list(islice(sentences, batch_size))
+        if not batch:
+            break
+
+        texts = [sent_labels_map["text"] for _, sent_labels_map in batch]
+        batch_reps = normalize_rows(encode_all_sents([prepare(text) for text in texts], sbert_model,
+                                                     cache=embedding_cache))
+        similarities = query_reps @ batch_reps.T
+
+        for heap, query_similarities in zip(heaps, similarities):
+            # Only the top results_limit sentences of the batch can make it to the heap
+            if n_candidates < len(batch):
+                candidates = np.argpartition(-query_similarities, n_candidates - 1)[:n_candidates]
+                candidates.sort()
+            else:
+                candidates = np.arange(len(batch))
+
+            min_score = max(similarity_threshold, heap.min_score())
+            for i in candidates[query_similarities[candidates] > min_score]:
+                heap.push(float(query_similarities[i]), (batch[i][0], texts[i]))
+
+    return {query: [[sent_id, round(score, 4), text] for score, (sent_id, text) in heap.items()]
+            for query, heap in zip(queries, heaps)}
+
+
+def main(credentials_fpath, language, init_doc, end_doc, model_name, results_limit, similarity_threshold, batch_size,
+         storage_path=None, prefetch=0, embedding_cache_folder=None):
+    from sentence_transformers import SentenceTransformer
+
+    backend = LocalBackend(storage_path) if storage_path else None
+    s3_client = S3Client(creds_filepath=credentials_fpath, bucket_name="wri-nlp-policy", language=language,
+                         backend=backend)
+    model = SentenceTransformer(model_name)
+
+    queries_df = s3_client.get_queries(language)
+    queries = dict(zip(queries_df["Query sentence"], queries_df["Policy instrument"]))
+
+    embedding_cache = None
+    if embedding_cache_folder is not None:
+        embedding_cache = EmbeddingCache(embedding_cache_folder, model_name)
+
+    sentences = s3_client.load_sentences(language, init_doc, end_doc, prefetch)
+    results = query_top_sentences(sentences, queries, model, results_limit, similarity_threshold, batch_size,
+                                  embedding_cache)
+
+    if embedding_cache is not None:
+        embedding_cache.close()
+
+    s3_client.store_assisted_labeling_csv(results, queries, init_doc, results_limit)
+    print(f"Stored the top {results_limit} sentences of {len(queries)} queries in {s3_client.assisted_labeling_folder}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-c', '--creds_file', default=None,
+                        help="AWS credentials JSON file")
+    parser.add_argument('-l', '--language', required=True,
+                        help="Language of the documents and queries. Current options are: english, spanish")
+    parser.add_argument('-i', '--init_doc', required=True,
+                        help="Position of the first document to search, in the order of the sentences folder")
+    parser.add_argument('-e', '--end_doc', required=True,
+                        help="Position after the last document to search")
+    parser.add_argument('-m', '--model_name', default="xlm-r-bert-base-nli-stsb-mean-tokens",
+                        help="Name or path of the SentenceTransformer model")
+    parser.add_argument('-r', '--results_limit', default=500,
+                        help="Number of sentences stored per query")
+    parser.add_argument('-t', '--threshold', default=0,
+                        help="Minimum cosine similarity for a sentence to be stored")
+    parser.add_argument('-b', '--batch_size', default=1024,
+                        help="Number of sentences encoded and scored at once")
+    parser.add_argument('-s', '--storage_path', default=None,
+                        help="Folder with a local copy of the bucket, used instead of S3")
+    parser.add_argument('-f', '--prefetch', default=8,
+                        help="Number of JSON sentence files to download concurrently")
+    parser.add_argument('-ec', '--embedding_cache', default=None,
+                        help="Folder of the embedding cache of the model")
+
+    args = parser.parse_args()
+
+    main(args.creds_file, args.language, int(args.init_doc), int(args.end_doc), args.model_name,
+         int(args.results_limit), float(args.threshold), int(args.batch_size), args.storage_path, int(args.prefetch),
+         args.embedding_cache)
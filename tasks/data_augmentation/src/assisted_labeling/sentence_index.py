@@ -0,0 +1,220 @@
+"""
+Persistent approximate nearest neighbour (HNSW) index over sentence embeddings, to find the sentences most similar to
+new queries without scanning the whole corpus.
+
+The index folder contains:
+    - hnsw.bin: the hnswlib index, with cosine similarity
+    - sent_ids.txt: the id of the sentence of each element of the index, one per line in insertion order
+    - index_config.json: the parameters of the index
+Sentences can be added at any time (i.e. after new documents are split), and adding a sentence that is already in the
+index does nothing. Changes are persisted by save(), which replaces each file atomically, index_config.json last.
+"""
+import os
+import json
+from itertools import islice
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+from tasks.data_augmentation.src.zero_shot_classification.latent_embeddings_classifier import encode_all_sents
+
+INDEX_FNAME = "hnsw.bin"
+SENT_IDS_FNAME = "sent_ids.txt"
+INDEX_CONFIG_FNAME = "index_config.json"
+
+
+def check_hnswlib():
+    if hnswlib is None:
+        raise ImportError("The sentence index needs hnswlib. Install it with: pip install hnswlib")
+
+
+class SentenceIndex:
+    def __init__(self, index_folder, sbert_model=None, embedding_cache=None, M=32, ef_construction=200, ef_search=64,
+                 initial_capacity=100000, encode_batch_size=256):
+        """
+        Open the index stored in index_folder, or prepare a new one there. sbert_model (any object with an
+        S-BERT like encode() method) is only needed to add or search sentences by their text, and the embedding cache
+        of that model is used to encode them if given.
+        M and ef_construction are only used when a new index is created. ef_search trades recall for speed,
+        and can be changed at any time with set_ef_search()
+        """
+        check_hnswlib()
+        self.index_folder = index_folder
+        self.sbert_model = sbert_model
+        self.embedding_cache = embedding_cache
+        self.encode_batch_size = encode_batch_size
+        self.initial_capacity = initial_capacity
+
+        self.config = {"M": M, "ef_construction": ef_construction, "dim": None}
+        self.ef_search = ef_search
+        self.index = None
+        self.sent_ids = []
+        self.labels = {}
+
+        config_fpath = os.path.join(index_folder, INDEX_CONFIG_FNAME)
+        if os.path.exists(config_fpath):
+            with open(config_fpath, "r") as f:
+                self.config = json.load(f)
+            with open(os.path.join(index_folder, SENT_IDS_FNAME), "r", encoding="utf-8") as f:
+                self.sent_ids = [line.rstrip("\n") for line in f]
+
+            self.index = hnswlib.Index(space="cosine", dim=self.config["dim"])
+            self.index.load_index(os.path.join(index_folder, INDEX_FNAME),
+                                  max_elements=max(len(self.sent_ids), initial_capacity))
+            self.index.set_ef(ef_search)
+
+            # The ids are saved before the index, so after an interrupted save() there can be more ids than elements
+            n_elements = self.index.get_current_count()
+            if len(self.sent_ids) > n_elements:
+                self.sent_ids = self.sent_ids[:n_elements]
+                self._write_sent_ids()
+
+            self.labels = {sent_id: label for label, sent_id in enumerate(self.sent_ids)}
+
+    def __len__(self):
+        return len(self.sent_ids)
+
+    def __contains__(self, sent_id):
+        return sent_id in self.labels
+
+    def _init_index(self, dim):
+        self.config["dim"] = dim
+        self.index = hnswlib.Index(space="cosine", dim=dim)
+        self.index.init_index(max_elements=self.initial_capacity, M=self.config["M"],
+                              ef_construction=self.config["ef_construction"])
+        self.index.set_ef(self.ef_search)
+
+    def _encode(self, texts):
+        if self.sbert_model is None:
+            raise ValueError("An S-BERT model is needed to add or search sentences by their text")
+
+        return encode_all_sents(texts, self.sbert_model, batch_size=self.encode_batch_size, cache=self.embedding_cache)
+
+    def set_ef_search(self, ef_search):
+        """
+        Size of the candidate list while searching: higher values give a better recall but slower queries
+        """
+        self.ef_search = ef_search
+        if self.index is not None:
+            self.index.set_ef(ef_search)
+
+    def add_embeddings(self, sent_ids, embeddings):
+        """
+        Add sentences given their ids and embeddings. Return the number of sentences added, which excludes the ones
+        that were already in the index (or repeated)
+        """
+        new_rows = {}
+        for i, sent_id in enumerate(sent_ids):
+            if sent_id not in self.labels and sent_id not in new_rows:
+                new_rows[sent_id] = i
+        if not new_rows:
+            return 0
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)[list(new_rows.values())]
+        if self.index is None:
+            self._init_index(embeddings.shape[1])
+
+        n_elements = len(self.sent_ids) + len(new_rows)
+        if n_elements > self.index.get_max_elements():
+            # Grow geometrically, so that adding documents one by one does not resize the index every time
+            self.index.resize_index(max(n_elements, 2 * self.index.get_max_elements()))
+
+        labels = np.arange(len(self.sent_ids), n_elements)
+        self.index.add_items(embeddings, labels)
+        for sent_id, label in zip(new_rows, labels):
+            self.labels[sent_id] = int(label)
+            self.sent_ids.append(sent_id)
+
+        return len(new_rows)
+
+    def add_sentences(self, sentences, batch_size=4096):
+        """
+        Add the sentences that are not in the index yet, given an iterable of (sentence id, {"text": ..., ...}), as
+        yielded by S3Client.load_sentences() or SentenceStoreReader.iter_sentences(). Only those are encoded.
+        Return the number of sentences added
+        """
+        sentences = iter(sentences)
+        n_added = 0
+        while True:
+            batch = [(sent_id, sent_labels_map["text"]) for sent_id, sent_labels_map in islice(sentences, batch_size)]
+            if not batch:
+                return n_added
+
+            batch = [(sent_id, text) for sent_id, text in batch if sent_id not in self.labels]
+            if batch:
+                sent_ids, texts = zip(*batch)
+                n_added += self.add_embeddings(sent_ids, self._encode(texts))
+
+    def search_embeddings(self, query_embeddings, k=10):
+        """
+        Return, for each query embedding, a list of the (sentence id, cosine similarity) of its k nearest sentences,
+        from most to least similar
+        """
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        k = min(k, len(self.sent_ids))
+        if k == 0:
+            return [[] for _ in query_embeddings]
+
+        # The candidate list must be at least as long as the number of results
+        self.index.set_ef(max(self.ef_search, k))
+        labels, distances = self.index.knn_query(query_embeddings, k=k)
+        self.index.set_ef(self.ef_search)
+
+        return [[(self.sent_ids[label], float(1 - distance)) for label, distance in zip(query_labels, query_distances)]
+                for query_labels, query_distances in zip(labels, distances)]
+
+    def search(self, query_texts, k=10):
+        """
+        Return, for each query text, a list of the (sentence id, cosine similarity) of its k most similar sentences
+        """
+        if isinstance(query_texts, str):
+            query_texts = [query_texts]
+
+        return self.search_embeddings(self._encode(list(query_texts)), k)
+
+    def _tmp_fpath(self, fname):
+        return os.path.join(self.index_folder, f"{fname}.{os.getpid()}.tmp")
+
+    def _write_sent_ids(self):
+        tmp_fpath = self._tmp_fpath(SENT_IDS_FNAME)
+        with open(tmp_fpath, "w", encoding="utf-8") as f:
+            for sent_id in self.sent_ids:
+                f.write(sent_id + "\n")
+        os.replace(tmp_fpath, os.path.join(self.index_folder, SENT_IDS_FNAME))
+
+    def save(self):
+        """
+        Write every file to a temporary file first, and replace the previous one with it: the sentence ids, then the
+        index (see __init__), and index_config.json last, so an interrupted save never leaves a truncated index and
+        the index of an interrupted first save is never opened
+        """
+        if self.index is None:
+            return
+
+        os.makedirs(self.index_folder, exist_ok=True)
+        self._write_sent_ids()
+
+        tmp_fpath = self._tmp_fpath(INDEX_FNAME)
+        self.index.save_index(tmp_fpath)
+        os.replace(tmp_fpath, os.path.join(self.index_folder, INDEX_FNAME))
+
+        tmp_fpath = self._tmp_fpath(INDEX_CONFIG_FNAME)
+        with open(tmp_fpath, "w") as f:
+            json.dump(self.config, f)
+        os.replace(tmp_fpath, os.path.join(self.index_folder, INDEX_CONFIG_FNAME))
+
+
+def build_from_sentence_store(index, reader, language, countries=None, batch_size=4096):
+    """
+    Add the sentences of the columnar sentence store (see tasks.data_loading.src.sentence_store) of the given countries
+    (all of them by default) to the index. Return the number of sentences added
+    """
+    n_added = 0
+    for country in (countries or [None]):
+        n_added += index.add_sentences(reader.iter_sentences(language, country), batch_size)
+
+    return n_added
@@ -0,0 +1,178 @@
+""" Sample usage:
+    -  Format
+        $ python benchmarks.py ridge -k [number_of_words ...] -l [any float] -r [any integer] [--gpu]
+        $ python benchmarks.py nli -i [path_to_txt_file] -m [model_name] -t [label ...] -hy [hypothesis_template]
+    -  Compare both ridge solvers from 50 to 5000 words, with the default lambda of calc_proj_matrix
+        $ python benchmarks.py ridge -k 50 100 500 1000 2000 5000 -l 0.01
+    -  Same comparison, letting the new solver run on the GPU
+        $ python benchmarks.py ridge -k 50 500 5000 --gpu
+    -  Compare the NLI zero-shot pipeline with the batched classifier on 200 sentences (one per line), on CPU
+        $ python benchmarks.py nli -i /Users/some_user/sentences.txt -m joeddav/xlm-roberta-large-xnli -n 200
+                                   -t "direct payment" credit "technical assistance" -hy "This text is about {}."
+
+    ridge: fits the projection matrix of calc_proj_matrix on synthetic data shaped like its inputs (k S-BERT embeddings
+    regressed on k word vectors), with the legacy explicit inverse and with least_squares_with_reg. Prints the best fit
+    time of each one and their relative error with respect to a reference solution computed in extended form with
+    np.linalg.lstsq.
+
+    nli: classifies the sentences with one zero-shot pipeline call per sentence, and with BatchedNLIClassifier for each
+    batch size. Prints the throughput in sentences/sec, and how many sentences get the same top label.
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from tasks.data_augmentation.src.zero_shot_classification.latent_embeddings_classifier import least_squares_with_reg, \
+    to_numpy
+from tasks.data_augmentation.src.zero_shot_classification.nli_topic_classifier import *
+
+
+def legacy_least_squares_with_reg(X, y, lamda=0.01):
+    """
+    least_squares_with_reg as it was, explicitly inverting X^T X + lamda I. Only kept here as the baseline
+    """
+    X, y = np.array(X), np.array(y)
+    return np.linalg.inv(X.T.dot(X) + lamda * np.eye(X.shape[1])).dot(X.T).dot(y)
+
+
+def synthetic_embeddings(k, sbert_dim, word_dim, seed=42):
+    """
+    Random S-BERT-like embeddings with a quickly decaying spectrum (sentence embeddings are far from isotropic, which
+    is what makes the explicit inverse inaccurate), and word vectors that depend linearly on them plus noise
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(k, sbert_dim)).astype(np.float32) * np.logspace(0, -3, sbert_dim, dtype=np.float32)
+    y = X @ rng.normal(size=(sbert_dim, word_dim)).astype(np.float32)
+    y += 0.1 * rng.normal(size=y.shape).astype(np.float32)
+
+    return X, y
+
+
+def reference_solution(X, y, lamda):
+    """
+    Ridge solution as the least squares solution of [X; sqrt(lamda) I] W = [y; 0], which never forms X^T X
+    """
+    X, y = X.astype(np.float64), y.astype(np.float64)
+    X_ext = np.vstack([X, np.sqrt(lamda) * np.eye(X.shape[1])])
+    y_ext = np.vstack([y, np.zeros((X.shape[1], y.shape[1]))])
+
+    return np.linalg.lstsq(X_ext, y_ext, rcond=None)[0]
+
+
+def time_solver(solver, X, y, n_repeats):
+    """
+    Return the best fit time (in seconds) out of n_repeats runs, and the solution
+    """
+    best_time = float("inf")
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        W = to_numpy(solver(X, y))
+        best_time = min(best_time, time.perf_counter() - start)
+
+    return best_time, W
+
+
+def relative_error(W, W_ref):
+    return np.linalg.norm(W - W_ref) / np.linalg.norm(W_ref)
+
+
+def ridge_main(ks, lamda, n_repeats, sbert_dim, word_dim, use_gpu):
+    print(f"Lambda: {lamda}, S-BERT dimension: {sbert_dim}, word vector dimension: {word_dim}")
+    print(f"{'k':>6} | {'legacy (s)':>10} | {'new (s)':>10} | {'speed up':>8} | {'legacy error':>12} | {'new error':>12}")
+
+    for k in ks:
+        X, y = synthetic_embeddings(k, sbert_dim, word_dim)
+        W_ref = reference_solution(X, y, lamda)
+
+        legacy_time, W_legacy = time_solver(lambda X, y: legacy_least_squares_with_reg(X, y, lamda), X, y, n_repeats)
+        new_time, W_new = time_solver(lambda X, y: least_squares_with_reg(X, y, lamda, use_gpu), X, y, n_repeats)
+
+        print(f"{k:>6} | {legacy_time:>10.4f} | {new_time:>10.4f} | {legacy_time / new_time:>7.1f}x | "
+              f"{relative_error(W_legacy, W_ref):>12.2e} | {relative_error(W_new, W_ref):>12.2e}")
+
+
+def load_sentences(input_path, max_sents):
+    """
+    Read the non-empty lines of a text file, up to max_sents of them
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        sentences = [line.strip() for line in f if line.strip()]
+
+    return sentences[:max_sents]
+
+
+def nli_main(input_path, model_name, labels, hypothesis_template, max_sents, batch_sizes, allow_multi_class,
+             n_threads):
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+
+    sentences = load_sentences(input_path, max_sents)
+    classifier = create_classfier(model_name)
+    print(f"{len(sentences)} sentences, {len(labels)} labels, {torch.get_num_threads()} CPU threads")
+
+    start = time.perf_counter()
+    legacy_results = [classify_sentence(sentence, labels, hypothesis_template, classifier, allow_multi_class,
+                                        all_probs=True) for sentence in sentences]
+    legacy_time = time.perf_counter() - start
+    legacy_preds = [result[0][0] for result in legacy_results]
+    print(f"Pipeline, one call per sentence: {len(sentences) / legacy_time:.2f} sentences/sec")
+
+    for batch_size in batch_sizes:
+        nli_classifier = BatchedNLIClassifier.from_pipeline(classifier, labels, hypothesis_template,
+                                                            batch_size=batch_size)
+        start = time.perf_counter()
+        results = list(nli_classifier.classify(sentences, allow_multi_class, all_probs=True))
+        batched_time = time.perf_counter() - start
+
+        n_identical = sum(result[0][0] == legacy_pred for result, legacy_pred in zip(results, legacy_preds))
+        print(f"Batched, {batch_size} pairs per batch: {len(sentences) / batched_time:.2f} sentences/sec "
+              f"({legacy_time / batched_time:.1f}x), same top label: {n_identical}/{len(sentences)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    ridge_parser = subparsers.add_parser("ridge", help="Ridge regression solvers of calc_proj_matrix")
+    ridge_parser.add_argument('-k', '--ks', nargs='+', default=["50", "100", "500", "1000", "2000", "5000"],
+                              help="Numbers of words (rows of the regression) to benchmark")
+    ridge_parser.add_argument('-l', '--lamda', default=0.01,
+                              help="L2 regularization strength")
+    ridge_parser.add_argument('-r', '--repeats', default=3,
+                              help="Number of runs per solver, the best one is reported")
+    ridge_parser.add_argument('-sd', '--sbert_dim', default=768,
+                              help="Dimension of the S-BERT embeddings")
+    ridge_parser.add_argument('-wd', '--word_dim', default=300,
+                              help="Dimension of the word vectors")
+    ridge_parser.add_argument('--gpu', action="store_true",
+                              help="Let the new solver run on the GPU, if cupy finds one")
+
+    nli_parser = subparsers.add_parser("nli", help="NLI zero-shot classification throughput")
+    nli_parser.add_argument('-i', '--input_path', required=True,
+                            help="Text file with one sentence per line")
+    nli_parser.add_argument('-m', '--model_name', default="joeddav/xlm-roberta-large-xnli",
+                            help="NLI model of the zero-shot pipeline")
+    nli_parser.add_argument('-t', '--labels', required=True, nargs='+',
+                            help="Candidate labels")
+    nli_parser.add_argument('-hy', '--hypothesis_template', default="This text is about {}.",
+                            help="Hypothesis template, where {} is replaced by each label")
+    nli_parser.add_argument('-n', '--max_sents', default=200,
+                            help="Number of sentences to classify")
+    nli_parser.add_argument('-b', '--batch_sizes', nargs='+', default=["16", "64"],
+                            help="Numbers of (sentence, hypothesis) pairs per batch to benchmark")
+    nli_parser.add_argument('-th', '--threads', default=None,
+                            help="Number of CPU threads used by torch (all of them by default)")
+    nli_parser.add_argument('--multi_class', action="store_true",
+                            help="Score each label independently")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "ridge":
+        ridge_main([int(k) for k in args.ks], float(args.lamda), int(args.repeats), int(args.sbert_dim),
+                   int(args.word_dim), args.gpu)
+    else:
+        nli_main(args.input_path, args.model_name, args.labels, args.hypothesis_template, int(args.max_sents),
+                 [int(batch_size) for batch_size in args.batch_sizes], args.multi_class,
+                 None if args.threads is None else int(args.threads))
@@ -0,0 +1,228 @@
+"""
+On-disk cache of sentence embeddings, so that sentences that were already encoded by a model are never encoded again
+by later evaluations or labeling queries over the same corpus.
+
+Each (model name, model revision, normalization, dtype) combination gets its own folder in the cache folder, with:
+    - embeddings.bin: memory-mapped (capacity x embedding dimension) matrix, one embedding per row
+    - hashes.bin: memory-mapped (capacity x 16) bytes, the hash of the text stored in each row (all zeros if free)
+    - last_used.bin: memory-mapped (capacity,) int64, the tick of the last lookup of each row, for LRU eviction
+    - meta.json: the embedding dimension, capacity, number of rows in use and current tick
+The capacity is given by the size budget. When it is full, the least recently used rows are evicted.
+
+The cache is meant to be used by one process at a time. Changes are persisted by flush() and close().
+"""
+import os
+import json
+from hashlib import blake2b, sha1
+
+import numpy as np
+
+HASH_SIZE = 16
+# Fraction of the capacity evicted at once when the cache is full, so that eviction does not run on every put()
+EVICTION_FRACTION = 0.1
+
+
+def text_hash(text):
+    return blake2b(text.encode("utf-8"), digest_size=HASH_SIZE).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_folder, model_name, model_revision=None, normalize=False, dtype="float32",
+                 max_size_mb=4096):
+        self.model_name = model_name
+        self.model_revision = model_revision
+        self.normalize = normalize
+        self.dtype = np.dtype(dtype)
+        self.max_size_mb = max_size_mb
+
+        model_key = repr((model_name, model_revision, bool(normalize), self.dtype.name))
+        self.folder = os.path.join(cache_folder, sha1(model_key.encode("utf-8")).hexdigest()[:16])
+        os.makedirs(self.folder, exist_ok=True)
+
+        self.dim = None
+        self.capacity = 0
+        self.n_rows = 0
+        self.tick = 0
+        self.embeddings = None
+        self.hashes = None
+        self.last_used = None
+        # Text hash -> row, and rows below n_rows freed by eviction
+        self.rows = {}
+        self.free_rows = []
+
+        meta_fpath = os.path.join(self.folder, "meta.json")
+        if os.path.exists(meta_fpath):
+            with open(meta_fpath, "r") as f:
+                meta = json.load(f)
+            # A larger size budget than the one the cache was created with grows it, a smaller one is ignored
+            self._open(meta["dim"], max(meta["capacity"], self._capacity_for(meta["dim"])), mode="r+")
+            self.n_rows = meta["n_rows"]
+            self.tick = meta["tick"]
+
+            for row in range(self.n_rows):
+                row_hash = self.hashes[row].tobytes()
+                if row_hash == bytes(HASH_SIZE):
+                    self.free_rows.append(row)
+                else:
+                    self.rows[row_hash] = row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, text):
+        return text_hash(text) in self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _fpath(self, fname):
+        return os.path.join(self.folder, fname)
+
+    def _open(self, dim, capacity, mode):
+        """
+        Map the files of a cache of the given capacity, growing them if they are smaller
+        """
+        self.dim = dim
+        self.capacity = capacity
+        files = [("embeddings.bin", self.dtype, (capacity, dim)),
+                 ("hashes.bin", np.uint8, (capacity, HASH_SIZE)),
+                 ("last_used.bin", np.int64, (capacity,))]
+
+        maps = []
+        for fname, dtype, shape in files:
+            fpath = self._fpath(fname)
+            n_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            if mode == "w+" or os.path.getsize(fpath) < n_bytes:
+                # Extending the file with truncate keeps it sparse, so the unused capacity takes no disk space
+                with open(fpath, "wb" if mode == "w+" else "ab") as f:
+                    f.truncate(n_bytes)
+            maps.append(np.memmap(fpath, dtype=dtype, mode="r+", shape=shape))
+
+        self.embeddings, self.hashes, self.last_used = maps
+
+    def _capacity_for(self, dim):
+        return max(1, int(self.max_size_mb * 1024 ** 2) // (dim * self.dtype.itemsize + HASH_SIZE + 8))
+
+    def _evict(self, n_needed, protected_rows):
+        """
+        Free at least n_needed rows, evicting the least recently used ones that are not in protected_rows
+        """
+        candidates = np.setdiff1d(np.arange(self.n_rows), np.fromiter(protected_rows, dtype=np.int64))
+        candidates = np.setdiff1d(candidates, np.asarray(self.free_rows, dtype=np.int64))
+        n_evicted = min(len(candidates), max(n_needed, int(self.capacity * EVICTION_FRACTION)))
+        if n_evicted == 0:
+            return
+
+        evicted = candidates[np.argpartition(self.last_used[candidates], n_evicted - 1)[:n_evicted]]
+        for row in evicted:
+            del self.rows[self.hashes[row].tobytes()]
+        self.hashes[evicted] = 0
+        self.free_rows.extend(evicted.tolist())
+
+    def get(self, texts):
+        """
+        Return a (number of texts x embedding dimension) float32 array with the cached embeddings, and a boolean mask of
+        the texts that were found. Rows of the texts that were not found are zeros
+        """
+        hashes = [text_hash(text) for text in texts]
+        found_rows = np.array([self.rows.get(h, -1) for h in hashes], dtype=np.int64)
+        found = found_rows >= 0
+
+        embeddings = np.zeros((len(texts), self.dim or 0), dtype=np.float32)
+        if found.any():
+            self.tick += 1
+            self.last_used[found_rows[found]] = self.tick
+            embeddings[found] = self.embeddings[found_rows[found]]
+
+        return embeddings, found
+
+    def put(self, texts, embeddings):
+        """
+        Store the embeddings of the texts (normalized first, if the cache was created with normalize=True), evicting
+        the least recently used ones if the size budget is exceeded. Texts already in the cache are overwritten
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.normalize:
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-8)
+
+        if self.embeddings is None:
+            self._open(embeddings.shape[1], self._capacity_for(embeddings.shape[1]), mode="w+")
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"Expected embeddings of dimension {self.dim}, got {embeddings.shape[1]}")
+
+        # Keep only the last occurrence of each text, and at most as many texts as fit in the cache
+        unique = {}
+        for i, text in enumerate(texts):
+            unique[text_hash(text)] = i
+        new_items = list(unique.items())[-self.capacity:]
+
+        self.tick += 1
+        rows = []
+        n_missing = sum(h not in self.rows for h, _ in new_items)
+        n_available = len(self.free_rows) + self.capacity - self.n_rows
+        if n_missing > n_available:
+            self._evict(n_missing - n_available, [self.rows[h] for h, _ in new_items if h in self.rows])
+
+        for h, i in new_items:
+            if h in self.rows:
+                row = self.rows[h]
+            elif self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                row = self.n_rows
+                self.n_rows += 1
+
+            self.rows[h] = row
+            self.hashes[row] = np.frombuffer(h, dtype=np.uint8)
+            rows.append(row)
+
+        rows = np.asarray(rows, dtype=np.int64)
+        self.embeddings[rows] = embeddings[[i for _, i in new_items]]
+        self.last_used[rows] = self.tick
+
+    def encode(self, texts, encode_fn):
+        """
+        Return the embeddings of all the texts as a float32 array, calling encode_fn (i.e. sbert_model.encode) only on
+        the ones that are not cached yet, each distinct text once, and caching its result
+        """
+        texts = list(texts)
+        embeddings, found = self.get(texts)
+        if found.all():
+            return embeddings
+
+        missing = list(dict.fromkeys(text for text, is_found in zip(texts, found) if not is_found))
+        new_embeddings = np.asarray(encode_fn(missing), dtype=np.float32)
+        self.put(missing, new_embeddings)
+
+        if self.normalize:
+            new_embeddings = new_embeddings / np.maximum(np.linalg.norm(new_embeddings, axis=1, keepdims=True), 1e-8)
+
+        if embeddings.shape[1] != new_embeddings.shape[1]:
+            embeddings = np.zeros((len(texts), new_embeddings.shape[1]), dtype=np.float32)
+
+        missing_rows = {text: i for i, text in enumerate(missing)}
+        missing_idx = np.flatnonzero(~found)
+        embeddings[missing_idx] = new_embeddings[[missing_rows[texts[i]] for i in missing_idx]]
+
+        return embeddings
+
+    def flush(self):
+        if self.embeddings is None:
+            return
+
+        for memmap in (self.embeddings, self.hashes, self.last_used):
+            memmap.flush()
+
+        meta = {"model_name": self.model_name, "model_revision": self.model_revision, "normalize": self.normalize,
+                "dtype": self.dtype.name, "dim": self.dim, "capacity": self.capacity, "n_rows": self.n_rows,
+                "tick": self.tick}
+        tmp_fpath = self._fpath(f"meta.json.{os.getpid()}.tmp")
+        with open(tmp_fpath, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_fpath, self._fpath("meta.json"))
+
+    def close(self):
+        self.flush()
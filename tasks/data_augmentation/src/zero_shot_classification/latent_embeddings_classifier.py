@@ -1,22 +1,55 @@
+import os
+import hashlib
 from collections import Counter
-import cupy as cp
 import numpy as np
 import torch
+from scipy.linalg import cho_solve
 from torch.nn import functional as F
 from tqdm import tqdm
 
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 
-def top_k_words(k, document, spacy_model, include_labels=None):
-    doc = spacy_model(document)
 
-    # all tokens that arent stop words or punctuations and are longer than 3 letters
-    words = [token.text.lower() for token in doc if not token.is_stop and not token.is_punct and len(token.text) > 3]
+def gpu_available():
+    if cp is None:
+        return False
 
-    # k most common tokens
-    word_freq = Counter(words)
-    common_words = word_freq.most_common(k)
+    try:
+        return cp.cuda.runtime.getDeviceCount() > 0
+    except cp.cuda.runtime.CUDARuntimeError:
+        return False
+
+
+def get_array_module(*arrays):
+    """
+    cupy if any of the arrays is a cupy array, numpy otherwise (also when cupy is not installed)
+    """
+    return np if cp is None else cp.get_array_module(*arrays)
+
+
+def to_numpy(array):
+    return np.asarray(array) if get_array_module(array) is np else cp.asnumpy(array)
 
-    result = list(list(zip(*common_words))[0])
+
+def top_k_words(k, documents, spacy_model, include_labels=None, batch_size=1000):
+    """
+    Return the k most common words of the documents (a single string or an iterable of strings), plus the labels.
+    Stop words and punctuation are lexical attributes, so only the tokenizer is run: no tagger, parser or NER
+    """
+    if isinstance(documents, str):
+        documents = [documents]
+
+    word_freq = Counter()
+    for doc in spacy_model.tokenizer.pipe(documents, batch_size=batch_size):
+        # all tokens that arent stop words or punctuations and are longer than 3 letters
+        word_freq.update(token.text.lower() for token in doc
+                         if not token.is_stop and not token.is_punct and len(token.text) > 3)
+
+    # k most common tokens
+    result = [word for word, _ in word_freq.most_common(k)]
 
     if include_labels:
         result.extend(include_labels)
@@ -25,41 +58,124 @@ def top_k_words(k, document, spacy_model, include_labels=None):
 
 
 def top_k_word_embeddings(top_k_words, spacy_model):
-    word_embeddings = []
-
-    for word in top_k_words:
-        doc = spacy_model(word)
-        vector = doc.vector
-        word_embeddings.append(vector.reshape(1, vector.shape[0]))
+    """
+    Return a (number of words x vector dimension) matrix with the vector of each word, read from the vocab vectors
+    table. Words of more than one token (i.e. labels) get the average of their token vectors, like doc.vector
+    """
+    vocab = spacy_model.vocab
+    word_embeddings = np.zeros((len(top_k_words), vocab.vectors_length), dtype=np.float32)
+
+    for i, word in enumerate(top_k_words):
+        tokens = spacy_model.tokenizer(word)
+        if len(tokens) == 1:
+            word_embeddings[i] = vocab.get_vector(tokens[0].orth)
+        elif len(tokens) > 1:
+            word_embeddings[i] = np.mean([vocab.get_vector(token.orth) for token in tokens], axis=0)
 
     return word_embeddings
 
 
-def top_k_sbert_embeddings(top_k_words, sbert_model):
-    sbert_embeddings = []
+def top_k_sbert_embeddings(top_k_words, sbert_model, batch_size=256):
+    return sbert_model.encode(list(top_k_words), batch_size=batch_size, convert_to_numpy=True)
 
-    for word in top_k_words:
-        vector = sbert_model.encode([word], convert_to_numpy=True)
-        sbert_embeddings.append(vector)
 
-    return sbert_embeddings
+def ridge_svd(X, y, lamda, xp=np):
+    """
+    Ridge regression through the SVD of X, stable for any conditioning. With lamda = 0 it is the least squares
+    solution, ignoring the singular values that are numerically zero (like np.linalg.lstsq)
+    """
+    U, s, Vt = xp.linalg.svd(X, full_matrices=False)
+    if lamda > 0:
+        d = s / (s ** 2 + lamda)
+    else:
+        d = xp.zeros_like(s)
+        keep = s > s[0] * max(X.shape) * xp.finfo(s.dtype).eps
+        d[keep] = 1 / s[keep]
 
+    return Vt.T @ (d[:, None] * (U.T @ y))
 
-def least_squares_with_reg(X, y, lamda=0.01):
-    # Help from: https://stackoverflow.com/questions/27476933/numpy-linear-regression-with-regularization and https://www.kdnuggets.com/2016/11/linear-regression-least-squares-matrix-multiplication-concise-technical-overview.html
-    # Multiple Linear Regression with OLS parameter estimation with L2 regularization term. lambda = 0 is equivalent to OLS estimation without regularization
-    xp = cp.get_array_module(X, y)
-    # Ensure that the 2 arguments have the same data type
-    X, y = xp.array(X), xp.array(y)
-    return xp.linalg.inv(X.T.dot(X) + lamda * xp.eye(X.shape[1])).dot(X.T).dot(y)
 
+def least_squares_with_reg(X, y, lamda=0.01, use_gpu=False, max_condition=1e10):
+    """
+    Multiple linear regression with OLS parameter estimation and an L2 regularization term (ridge regression).
+    lambda = 0 is equivalent to OLS estimation without regularization.
 
-def calc_proj_matrix(sentences, k, spacy_model, sbert_model, lamda=0.01, include_labels=None):
-    sents_as_str = ". ".join(sentences)
-    top_words = top_k_words(k, sents_as_str, spacy_model, include_labels)
-    word_emb = np.vstack(top_k_word_embeddings(top_words, spacy_model))
-    sent_emb = np.vstack(top_k_sbert_embeddings(top_words, sbert_model))
-    proj_matrix = least_squares_with_reg(sent_emb, word_emb, lamda)
+    Instead of inverting X^T X + lamda I, the normal equations are solved with a Cholesky factorization. When there
+    are fewer samples (words) than features, the smaller equivalent system (X X^T + lamda I) A = y, W = X^T A is
+    solved instead. Falls back to the SVD of X when lamda is 0 or the system is too ill-conditioned for Cholesky.
+
+    Runs on the GPU if use_gpu is True and cupy finds one, or if X and y already are cupy arrays
+    """
+    xp = cp if use_gpu and gpu_available() else get_array_module(X, y)
+    # Ensure that the 2 arguments have the same data type
+    X, y = xp.asarray(X, dtype=xp.float64), xp.asarray(y, dtype=xp.float64)
+    if lamda <= 0:
+        return ridge_svd(X, y, lamda, xp)
+
+    dual = X.shape[0] < X.shape[1]
+    gram = X @ X.T if dual else X.T @ X
+    gram += lamda * xp.eye(gram.shape[0])
+    rhs = y if dual else X.T @ y
+
+    try:
+        L = xp.linalg.cholesky(gram)
+    except np.linalg.LinAlgError:
+        return ridge_svd(X, y, lamda, xp)
+
+    # The condition number of the gram matrix is at least the squared ratio of the extreme diagonal entries of L.
+    # cupy returns NaNs instead of raising when the matrix is not positive definite
+    L_diag = xp.abs(xp.diag(L))
+    if not bool(xp.all(xp.isfinite(L_diag))) or float((L_diag.max() / L_diag.min()) ** 2) > max_condition:
+        return ridge_svd(X, y, lamda, xp)
+
+    coef = cho_solve((L, True), rhs) if xp is np else xp.linalg.solve(gram, rhs)
+    return X.T @ coef if dual else coef
+
+
+def proj_matrix_cache_key(sentences, k, lamda, include_labels=None, spacy_model=None, model_id=None):
+    """
+    Hash of everything the projection matrix depends on: the corpus, k, lambda, the labels and the models
+    """
+    corpus_hash = hashlib.sha1()
+    for sent in sentences:
+        corpus_hash.update(sent.encode("utf-8"))
+        corpus_hash.update(b"\0")
+
+    spacy_id = None if spacy_model is None else f"{spacy_model.meta.get('lang')}_{spacy_model.meta.get('name')}" \
+                                                 f"_{spacy_model.meta.get('version')}"
+    params = repr((corpus_hash.hexdigest(), k, lamda, list(include_labels or []), spacy_id, model_id))
+    return hashlib.sha1(params.encode("utf-8")).hexdigest()
+
+
+def calc_proj_matrix(sentences, k, spacy_model, sbert_model, lamda=0.01, include_labels=None, cache_folder=None,
+                     model_id=None, use_gpu=False):
+    """
+    Fit the projection matrix Z from the S-BERT space to the word vector space, using the k most common words of the
+    sentences (and the labels).
+    If cache_folder is given, Z is stored there and loaded back by later calls with the same sentences, k, lambda,
+    labels and models. The S-BERT weights cannot be hashed cheaply, so model_id (i.e. the path of the model) must
+    identify them: fine-tuned models that share a model_id would share their cached Z.
+    Z is always returned as a numpy array, even when it is fitted on the GPU
+    """
+    sentences = list(sentences)
+    cache_fpath = None
+    if cache_folder is not None:
+        cache_key = proj_matrix_cache_key(sentences, k, lamda, include_labels, spacy_model, model_id)
+        cache_fpath = os.path.join(cache_folder, f"proj_matrix_{cache_key}.npy")
+        if os.path.exists(cache_fpath):
+            return np.load(cache_fpath)
+
+    top_words = top_k_words(k, sentences, spacy_model, include_labels)
+    word_emb = top_k_word_embeddings(top_words, spacy_model)
+    sent_emb = top_k_sbert_embeddings(top_words, sbert_model)
+    proj_matrix = to_numpy(least_squares_with_reg(sent_emb, word_emb, lamda, use_gpu))
+
+    if cache_fpath is not None:
+        # Write to a temporary file first, so that an interrupted run never leaves a truncated cache file
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_fpath = cache_fpath[:-len(".npy")] + f".{os.getpid()}.tmp.npy"
+        np.save(tmp_fpath, proj_matrix)
+        os.replace(tmp_fpath, cache_fpath)
 
     return proj_matrix
 
@@ -95,31 +211,89 @@ def classify_sentence_given_label_reps(sentence, label_names, label_reps, model,
     return calc_cos_similarity(sentence_rep, label_reps, label_names)
 
 
-def calc_all_cos_similarity(all_sents_reps, label_reps, label_names):
-    model_preds, model_scores = [], []
-    for sent_rep in tqdm(all_sents_reps):
-        pred, score = calc_cos_similarity(sent_rep, label_reps, label_names)
-        model_preds.append(pred)
-        model_scores.append(score)
-
-    return model_preds, model_scores
+def normalize_rows(matrix, eps=1e-8):
+    """
+    Divide each row by its L2 norm, so that dot products between rows are cosine similarities
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), eps)
+
+
+def calc_all_cos_similarity(all_sents_reps, label_reps, label_names, top_k=1, threshold=None, memory_budget_mb=256):
+    """
+    Classify all the sentences by the cosine similarity of their representations with the label representations.
+    Both matrices are normalized once, and the (sentences x labels) similarity matrix is computed in chunks of
+    sentences whose size fits in memory_budget_mb.
+
+    Return the predicted labels and their scores as numpy arrays:
+        - By default, the most similar label of each sentence: two arrays of shape (number of sentences,)
+        - With top_k > 1, the top_k most similar labels of each sentence, from most to least similar:
+          two arrays of shape (number of sentences, top_k)
+        - With a threshold, for multi-label assisted labeling: two lists with an array per sentence, holding the labels
+          (among the top_k) whose score is at least the threshold
+    """
+    if not isinstance(all_sents_reps, np.ndarray):
+        all_sents_reps = np.vstack([np.asarray(sent_rep) for sent_rep in all_sents_reps])
+
+    sents_reps = normalize_rows(all_sents_reps)
+    label_reps = normalize_rows(label_reps)
+    label_names = np.asarray(label_names)
+    n_labels = label_reps.shape[0]
+    top_k = min(top_k, n_labels)
+
+    chunk_size = max(1, int(memory_budget_mb * 1024 ** 2) // (n_labels * sents_reps.itemsize))
+    top_indices, top_scores = [], []
+    for start in tqdm(range(0, sents_reps.shape[0], chunk_size)):
+        similarities = sents_reps[start:start + chunk_size] @ label_reps.T
+
+        if top_k == 1:
+            chunk_indices = similarities.argmax(axis=1)[:, np.newaxis]
+        else:
+            # Only sort the top_k candidates of each sentence
+            chunk_indices = np.argpartition(-similarities, top_k - 1, axis=1)[:, :top_k]
+            chunk_order = np.argsort(-np.take_along_axis(similarities, chunk_indices, axis=1), axis=1)
+            chunk_indices = np.take_along_axis(chunk_indices, chunk_order, axis=1)
+
+        top_indices.append(chunk_indices)
+        top_scores.append(np.take_along_axis(similarities, chunk_indices, axis=1))
+
+    top_indices = np.vstack(top_indices) if top_indices else np.empty((0, top_k), dtype=int)
+    top_scores = np.vstack(top_scores) if top_scores else np.empty((0, top_k), dtype=np.float32)
+
+    if threshold is not None:
+        above_threshold = top_scores >= threshold
+        return ([label_names[indices[mask]] for indices, mask in zip(top_indices, above_threshold)],
+                [scores[mask] for scores, mask in zip(top_scores, above_threshold)])
+
+    if top_k == 1:
+        return label_names[top_indices[:, 0]], top_scores[:, 0]
+
+    return label_names[top_indices], top_scores
+
+
+def classify_all_sentences(all_sents, label_names, sbert_model, proj_matrix, batch_size=256, top_k=1, threshold=None,
+                           cache=None, show_progress_bar=False):
+    label_reps = encode_labels(label_names, sbert_model, proj_matrix)
+    all_sents_reps = encode_all_sents(all_sents, sbert_model, proj_matrix, batch_size, cache, show_progress_bar)
 
+    return calc_all_cos_similarity(all_sents_reps, label_reps, label_names, top_k, threshold)
 
-def classify_all_sentences(all_sents, label_names, sbert_model, proj_matrix):
-    model_preds, model_scores = [], []
-    label_reps = encode_labels(label_names, sbert_model, proj_matrix)
 
-    for sent in tqdm(all_sents):
-        pred, score = classify_sentence_given_label_reps(sent, label_names, label_reps, sbert_model, proj_matrix)
-        model_preds.append(pred)
-        model_scores.append(score)
+def encode_all_sents(all_sents, sbert_model, proj_matrix=None, batch_size=256, cache=None, show_progress_bar=False):
+    """
+    Encode all the sentences in batches of batch_size (the model sorts them by length, so that each batch is padded as
+    little as possible), and apply the projection matrix (if any) with a single matrix multiplication. If an
+    EmbeddingCache of the model is given, only the sentences that are not in it are encoded (and then added to it).
+    The cache holds the embeddings before the projection, so it is still valid when the projection matrix changes.
+    Return a contiguous (number of sentences x embedding dimension) float32 numpy array, in the same order as all_sents
+    """
+    def encode(sents):
+        return sbert_model.encode(list(sents), batch_size=batch_size, show_progress_bar=show_progress_bar,
+                                  convert_to_numpy=True)
 
-    return model_preds, model_scores
+    embeddings = encode(all_sents) if cache is None else cache.encode(all_sents, encode)
 
+    if proj_matrix is not None:
+        embeddings = np.matmul(embeddings, proj_matrix)
 
-def encode_all_sents(all_sents, sbert_model, proj_matrix=None):
-    if proj_matrix is None:
-        stacked = np.vstack([sbert_model.encode(sent) for sent in tqdm(all_sents)])
-    else:
-        stacked = np.vstack([encode_sentence(sent, sbert_model, proj_matrix) for sent in tqdm(all_sents)])
-    return [torch.from_numpy(element).reshape((1, element.shape[0])) for element in stacked]
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
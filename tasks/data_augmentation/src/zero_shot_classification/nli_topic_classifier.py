@@ -1,6 +1,13 @@
+from itertools import islice
+
+import numpy as np
+import torch
 from transformers import pipeline
 from tqdm import tqdm
 
+from tasks.data_augmentation.src.zero_shot_classification.latent_embeddings_classifier import calc_all_cos_similarity, \
+    encode_all_sents
+
 
 def create_classfier(model_name):
     return pipeline('zero-shot-classification',
@@ -15,29 +22,233 @@ def classify_sentence(sentence, labels,
                         hypothesis_template=hypothesis,
                         multi_class=allow_multi_class)
 
+    return format_result(result["labels"], result["scores"], allow_multi_class, multi_class_thresh, all_probs)
+
+
+def format_result(labels, scores, allow_multi_class=False, multi_class_thresh=0.5, all_probs=False):
+    """
+    Output of classify_sentence(), given the labels sorted by descending score
+    """
     if all_probs:
-        return list(zip(result["labels"], result["scores"]))
+        return list(zip(labels, scores))
 
     if allow_multi_class:
         multi_labels = []
         multi_scores = []
-        for i, score in enumerate(result["scores"]):
+        for i, score in enumerate(scores):
             if score > multi_class_thresh:
-                multi_labels.append(result["labels"][i])
+                multi_labels.append(labels[i])
                 multi_scores.append(score)
 
         return list(zip(multi_labels, multi_scores))
 
-    return result["labels"][0], result["scores"][0]
+    return labels[0], scores[0]
+
+
+class BatchedNLIClassifier:
+    """
+    Zero-shot classification of many sentences with an NLI model, giving the same scores as the zero-shot pipeline
+    (up to padding effects) without calling it once per sentence:
+        - The hypotheses are built and tokenized once, not once per sentence
+        - Sentences are tokenized in batches, and each (sentence, hypothesis) pair is assembled from the token ids
+        - Pairs are sorted by length within a window of sentences, so that each batch is padded as little as possible
+        - Results are yielded in the input order as soon as their window is done, so any iterable can be classified
+    """
+
+    def __init__(self, model, tokenizer, labels, hypothesis_template="This example is {}.", batch_size=64,
+                 max_length=256, window_size=2048, device=None):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.labels = list(labels)
+        self.batch_size = batch_size
+        self.window_size = window_size
+        self.device = device if device is not None else next(model.parameters()).device
+        self.model.to(self.device)
+
+        label2id = {label.lower(): i for label, i in model.config.label2id.items()}
+        self.entailment_id = next(i for label, i in label2id.items() if label.startswith("entail"))
+        self.contradiction_id = next(i for label, i in label2id.items() if label.startswith("contra"))
+
+        hypotheses = [hypothesis_template.format(label) for label in self.labels]
+        self.hypotheses_ids = tokenizer(hypotheses, add_special_tokens=False)["input_ids"]
+        self.use_token_type_ids = "token_type_ids" in tokenizer.model_input_names
+
+        # Room left for the sentence in each pair, which is truncated like the pipeline does ("only_first")
+        n_special_tokens = tokenizer.num_special_tokens_to_add(pair=True)
+        self.max_sentence_lengths = [max(1, max_length - n_special_tokens - len(ids)) for ids in self.hypotheses_ids]
+
+    @classmethod
+    def from_pipeline(cls, classifier, labels, hypothesis_template="This example is {}.", **kwargs):
+        """
+        Reuse the model and tokenizer of a zero-shot pipeline, i.e. the one built by create_classfier()
+        """
+        return cls(classifier.model, classifier.tokenizer, labels, hypothesis_template, device=classifier.device,
+                   **kwargs)
+
+    def _build_pair(self, sentence_ids, label_idx):
+        sentence_ids = sentence_ids[:self.max_sentence_lengths[label_idx]]
+        hypothesis_ids = self.hypotheses_ids[label_idx]
+
+        pair = {"input_ids": self.tokenizer.build_inputs_with_special_tokens(sentence_ids, hypothesis_ids)}
+        if self.use_token_type_ids:
+            pair["token_type_ids"] = self.tokenizer.create_token_type_ids_from_sequences(sentence_ids, hypothesis_ids)
+
+        return pair
+
+    def _pair_logits(self, pairs):
+        """
+        Return the (number of pairs x number of NLI classes) logits, running the model in batches of sorted lengths
+        """
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i]["input_ids"]))
+        logits = torch.empty((len(pairs), self.model.config.num_labels))
+
+        with torch.no_grad():
+            for start in range(0, len(order), self.batch_size):
+                batch_idx = order[start:start + self.batch_size]
+                inputs = self.tokenizer.pad([pairs[i] for i in batch_idx], return_tensors="pt")
+                inputs = {name: tensor.to(self.device) for name, tensor in inputs.items()}
+                logits[batch_idx] = self.model(**inputs)[0].float().cpu()
+
+        return logits
+
+    def _scores(self, logits, allow_multi_class):
+        """
+        Turn the (sentences x labels x NLI classes) logits into (sentences x labels) scores, like the pipeline:
+        softmax of the entailment logits over the labels, or entailment vs contradiction for each label independently.
+        As in the pipeline, a single label is always scored independently, since a softmax over it would always be 1
+        """
+        if allow_multi_class or logits.shape[-2] == 1:
+            entail_contr_logits = logits[..., [self.contradiction_id, self.entailment_id]]
+            return entail_contr_logits.softmax(dim=-1)[..., 1]
+
+        return logits[..., self.entailment_id].softmax(dim=-1)
+
+    def classify(self, sentences, allow_multi_class=False, multi_class_thresh=0.5, all_probs=False,
+                 candidate_labels=None):
+        """
+        Yield the result of each sentence, in the format of classify_sentence(), in the same order as sentences.
+        candidate_labels can give, for each sentence, the indices of the only labels to score it against
+        (i.e. the ones kept by a prefilter). Scores are then normalized over those labels only, like the pipeline does
+        with the labels it is given
+        """
+        sentences = iter(sentences)
+        all_label_indices = list(range(len(self.labels)))
+        candidate_labels = iter(candidate_labels) if candidate_labels is not None else None
+
+        while True:
+            window = list(islice(sentences, self.window_size))
+            if not window:
+                return
+
+            if candidate_labels is None:
+                window_label_indices = [all_label_indices] * len(window)
+            else:
+                window_label_indices = [list(label_indices) for label_indices in islice(candidate_labels, len(window))]
+
+            sentences_ids = self.tokenizer(window, add_special_tokens=False)["input_ids"]
+            pairs = [self._build_pair(sentence_ids, label_idx)
+                     for sentence_ids, label_indices in zip(sentences_ids, window_label_indices)
+                     for label_idx in label_indices]
+            logits = self._pair_logits(pairs)
+
+            start = 0
+            for label_indices in window_label_indices:
+                sent_logits = logits[start:start + len(label_indices)]
+                start += len(label_indices)
+
+                sent_scores, order = self._scores(sent_logits, allow_multi_class).sort(descending=True)
+                yield format_result([self.labels[label_indices[i]] for i in order.tolist()], sent_scores.tolist(),
+                                    allow_multi_class, multi_class_thresh, all_probs)
+
+
+class CascadeTopicClassifier:
+    """
+    Two-stage zero-shot classification for many candidate labels: a cheap cosine similarity prefilter with the
+    S-BERT (latent embeddings) classifier keeps the top_m labels of each sentence, and only those are scored by the
+    NLI model, which takes top_m instead of len(labels) forward passes per sentence.
+    Use prefilter_recall() on a labelled dev set to choose top_m
+    """
+
+    def __init__(self, nli_classifier, sbert_model, proj_matrix=None, top_m=3, sbert_batch_size=256,
+                 embedding_cache=None):
+        self.nli_classifier = nli_classifier
+        self.labels = nli_classifier.labels
+        self.sbert_model = sbert_model
+        self.proj_matrix = proj_matrix
+        self.top_m = top_m
+        self.sbert_batch_size = sbert_batch_size
+        self.embedding_cache = embedding_cache
+
+        self.label_reps = encode_all_sents(self.labels, sbert_model, proj_matrix, sbert_batch_size)
+
+    def prefilter(self, sentences, top_m=None):
+        """
+        Return a (number of sentences x top_m) array with the indices of the labels closest to each sentence,
+        from most to least similar
+        """
+        sents_reps = encode_all_sents(sentences, self.sbert_model, self.proj_matrix, self.sbert_batch_size,
+                                      self.embedding_cache)
+        top_m = top_m or self.top_m
+        top_labels, _ = calc_all_cos_similarity(sents_reps, self.label_reps, np.arange(len(self.labels)), top_k=top_m)
+
+        # With top_k = 1, calc_all_cos_similarity returns one label per sentence instead of a list of them
+        return top_labels.reshape(len(sents_reps), -1)
+
+    def classify(self, sentences, allow_multi_class=False, multi_class_thresh=0.5, all_probs=False):
+        """
+        Yield the result of each sentence, in the format of classify_sentence(), only scoring the labels kept by the
+        prefilter
+        """
+        sentences = iter(sentences)
+        while True:
+            window = list(islice(sentences, self.nli_classifier.window_size))
+            if not window:
+                return
+
+            yield from self.nli_classifier.classify(window, allow_multi_class, multi_class_thresh, all_probs,
+                                                    candidate_labels=self.prefilter(window))
+
+    def prefilter_recall(self, sentences, true_labels, top_ms=(1, 2, 3, 5, 10), allow_multi_class=False):
+        """
+        Measure, for each top_m, how much the prefilter loses on a labelled dev set:
+            - label_recall: fraction of the true labels (a label or a list of labels per sentence) kept by the prefilter
+            - nli_recall: fraction of sentences whose top label with full NLI scoring (all labels) is kept by the
+              prefilter, i.e. how often the cascade can still give the same answer as the full classifier
+            - pairs_fraction: fraction of the (sentence, label) pairs the NLI model still has to score
+        Return a dictionary of {top_m: {"label_recall": ..., "nli_recall": ..., "pairs_fraction": ...}}
+        """
+        sentences = list(sentences)
+        true_labels = [[labels] if isinstance(labels, str) else list(labels) for labels in true_labels]
+        full_preds = [result[0][0] for result in self.nli_classifier.classify(sentences, allow_multi_class,
+                                                                                 all_probs=True)]
+        ranking = self.prefilter(sentences, top_m=len(self.labels))
+
+        label_idx = {label: i for i, label in enumerate(self.labels)}
+        true_label_indices = [[label_idx[label] for label in labels] for labels in true_labels]
+        full_pred_indices = [label_idx[pred] for pred in full_preds]
+        n_true_labels = sum(len(indices) for indices in true_label_indices)
+
+        report = {}
+        for top_m in top_ms:
+            kept = [set(sent_ranking[:top_m].tolist()) for sent_ranking in ranking]
+            report[top_m] = {
+                "label_recall": sum(len(kept_labels.intersection(indices))
+                                    for kept_labels, indices in zip(kept, true_label_indices)) / max(1, n_true_labels),
+                "nli_recall": sum(pred in kept_labels
+                                  for kept_labels, pred in zip(kept, full_pred_indices)) / max(1, len(sentences)),
+                "pairs_fraction": min(top_m, len(self.labels)) / len(self.labels)
+            }
+
+        return report
 
 
 def classify_sentences_topic(dataset_map, topics,
-                             hypothesis_template, classifier):
+                             hypothesis_template, classifier, batch_size=64):
     model_preds = []
     scores = []
-    for sentence in tqdm(dataset_map.values()):
-        model_pred, score = classify_sentence(sentence['text'], topics,
-                                              hypothesis_template, classifier)
+    nli_classifier = BatchedNLIClassifier.from_pipeline(classifier, topics, hypothesis_template, batch_size=batch_size)
+    sentences = (sentence['text'] for sentence in dataset_map.values())
+    for model_pred, score in tqdm(nli_classifier.classify(sentences), total=len(dataset_map)):
         model_preds.append(model_pred)
         scores.append(score)
 
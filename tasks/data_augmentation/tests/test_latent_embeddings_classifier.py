@@ -0,0 +1,28 @@
+import numpy as np
+
+from tasks.data_augmentation.src.zero_shot_classification.latent_embeddings_classifier import encode_all_sents
+
+
+class RecordingModel:
+    """
+    Stand-in for an S-BERT model: the embedding of a text is its length, and the encode() calls are recorded
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True):
+        self.calls.append({"sentences": sentences, "batch_size": batch_size, "show_progress_bar": show_progress_bar})
+        return np.array([[len(sentence), 1.0] for sentence in sentences], dtype=np.float32)
+
+
+def test_encode_all_sents_keeps_the_order_and_hides_the_progress_bar():
+    model = RecordingModel()
+    sentences = ["a short one", "a much longer sentence than the others", "mid length one"]
+    embeddings = encode_all_sents(sentences, model, proj_matrix=np.array([[2.0], [0.0]]), batch_size=2)
+
+    assert embeddings.tolist() == [[2.0 * len(sentence)] for sentence in sentences]
+    assert model.calls == [{"sentences": sentences, "batch_size": 2, "show_progress_bar": False}]
+
+    encode_all_sents(sentences, model, show_progress_bar=True)
+    assert model.calls[-1]["show_progress_bar"] is True
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from tasks.data_augmentation.src.zero_shot_classification.nli_topic_classifier import BatchedNLIClassifier, \
+    CascadeTopicClassifier
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", ",", "the", "a", "this", "example", "is", "about", "credit",
+         "payment", "direct", "tax", "fine", "forest", "water", "farmers", "will", "receive", "money", "for",
+         "planting", "trees"]
+SENTENCES = ["farmers will receive money for planting trees.", "this is about a tax, a fine.",
+             "the forest water is about money."]
+HYPOTHESIS_TEMPLATE = "this example is about {}."
+
+
+class BagOfWordsModel:
+    """
+    Stand-in for an S-BERT model: the embedding of a text is its vocabulary word counts
+    """
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True):
+        words = [sentence.replace(".", " ").replace(",", " ").split() for sentence in sentences]
+        return np.array([[sentence_words.count(word) + 1e-3 for word in VOCAB] for sentence_words in words],
+                        dtype=np.float32)
+
+
+@pytest.fixture(scope="module")
+def zero_shot_pipeline(tmp_path_factory):
+    """
+    Zero-shot pipeline of a tiny, randomly initialized NLI model
+    """
+    model_folder = tmp_path_factory.mktemp("tiny_nli")
+    vocab_fpath = model_folder / "vocab.txt"
+    vocab_fpath.write_text("\n".join(VOCAB) + "\n")
+    tokenizer = transformers.BertTokenizerFast(str(vocab_fpath))
+
+    torch.manual_seed(0)
+    config = transformers.BertConfig(vocab_size=len(VOCAB), hidden_size=32, num_hidden_layers=2,
+                                     num_attention_heads=2, intermediate_size=64,
+                                     id2label={0: "contradiction", 1: "neutral", 2: "entailment"},
+                                     label2id={"contradiction": 0, "neutral": 1, "entailment": 2})
+    transformers.BertForSequenceClassification(config).save_pretrained(model_folder)
+    tokenizer.save_pretrained(model_folder)
+
+    return transformers.pipeline("zero-shot-classification", model=str(model_folder), device=-1)
+
+
+@pytest.mark.parametrize("labels", [["credit"], ["credit", "direct payment", "tax"]])
+def test_batched_classifier_matches_the_pipeline(zero_shot_pipeline, labels):
+    nli_classifier = BatchedNLIClassifier.from_pipeline(zero_shot_pipeline, labels, HYPOTHESIS_TEMPLATE)
+    results = list(nli_classifier.classify(SENTENCES, all_probs=True))
+
+    for sentence, result in zip(SENTENCES, results):
+        expected = zero_shot_pipeline(sentence, labels, hypothesis_template=HYPOTHESIS_TEMPLATE)
+        assert [label for label, _ in result] == expected["labels"]
+        assert [score for _, score in result] == pytest.approx(expected["scores"], abs=1e-5)
+
+
+def test_single_label_is_scored_against_contradiction(zero_shot_pipeline):
+    nli_classifier = BatchedNLIClassifier.from_pipeline(zero_shot_pipeline, ["credit"], HYPOTHESIS_TEMPLATE)
+    scores = [score for _, score in nli_classifier.classify(SENTENCES)]
+
+    assert all(0 < score < 1 for score in scores)
+    assert scores != pytest.approx([1.0] * len(SENTENCES))
+
+
+def test_cascade_with_one_label_matches_the_pipeline_on_that_label(zero_shot_pipeline):
+    labels = ["credit", "direct payment", "tax"]
+    nli_classifier = BatchedNLIClassifier.from_pipeline(zero_shot_pipeline, labels, HYPOTHESIS_TEMPLATE)
+    cascade = CascadeTopicClassifier(nli_classifier, BagOfWordsModel(), top_m=1)
+    kept_labels = [labels[label_indices[0]] for label_indices in cascade.prefilter(SENTENCES)]
+
+    for sentence, kept_label, result in zip(SENTENCES, kept_labels, cascade.classify(SENTENCES, all_probs=True)):
+        expected = zero_shot_pipeline(sentence, [kept_label], hypothesis_template=HYPOTHESIS_TEMPLATE)
+        assert result == [(kept_label, pytest.approx(expected["scores"][0], abs=1e-5))]
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("hnswlib")
+
+from tasks.data_augmentation.src.assisted_labeling.sentence_index import SentenceIndex
+
+
+def random_embeddings(n, dim=8, seed=0):
+    return np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+
+
+class InterruptedSave:
+    """
+    hnswlib index whose save_index() writes part of the file and fails, like a process killed while saving
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def save_index(self, fpath):
+        with open(fpath, "wb") as f:
+            f.write(b"partial")
+        raise OSError("Interrupted")
+
+
+def test_interrupted_first_save_does_not_duplicate_ids(tmp_path, monkeypatch):
+    index = SentenceIndex(str(tmp_path))
+    index.add_embeddings(["s0", "s1", "s2"], random_embeddings(3))
+    monkeypatch.setattr(index, "index", InterruptedSave(index.index))
+    with pytest.raises(OSError):
+        index.save()
+
+    # Without a config, the folder holds no index yet
+    index = SentenceIndex(str(tmp_path))
+    assert len(index) == 0
+    index.add_embeddings(["s3", "s4"], random_embeddings(2))
+    index.save()
+
+    index = SentenceIndex(str(tmp_path))
+    assert index.sent_ids == ["s3", "s4"]
+    assert (tmp_path / "sent_ids.txt").read_text().split() == ["s3", "s4"]
+
+
+def test_interrupted_save_keeps_the_previous_index(tmp_path, monkeypatch):
+    embeddings = random_embeddings(5)
+    index = SentenceIndex(str(tmp_path))
+    index.add_embeddings(["s0", "s1", "s2"], embeddings[:3])
+    index.save()
+
+    index.add_embeddings(["s3", "s4"], embeddings[3:])
+    monkeypatch.setattr(index, "index", InterruptedSave(index.index))
+    with pytest.raises(OSError):
+        index.save()
+
+    index = SentenceIndex(str(tmp_path))
+    assert index.sent_ids == ["s0", "s1", "s2"]
+    assert index.search_embeddings(embeddings[1], k=1)[0][0][0] == "s1"
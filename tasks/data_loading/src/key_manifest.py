@@ -0,0 +1,105 @@
+"""
+Local, persistent list of the keys stored under a prefix of the bucket, so that jobs working on a shard of
+documents can go straight to their keys instead of listing the whole folder for every shard. S3Client lists the
+folder once per process with a full refresh, and then keeps the manifest up to date as it stores new files.
+
+The manifest is stored as a JSON lines file where each line is either an object:
+    {"key": "english_documents/sentences/23effs8765_sents.json", "size": 2345, "etag": "d41d8cd98f00b204e9800998ecf8427e"}
+or the removal of an object:
+    {"key": "english_documents/sentences/23effs8765_sents.json", "deleted": true}
+Lines are only appended while the manifest is updated, and the file is rewritten on every full refresh.
+"""
+import os
+import json
+from bisect import bisect_left, insort
+
+from tasks.data_loading.src.storage_backends import ObjectInfo
+
+
+class KeyManifest:
+    def __init__(self, backend, prefix, manifest_fpath):
+        self.backend = backend
+        self.prefix = prefix
+        self.manifest_fpath = manifest_fpath
+
+        # Key -> ObjectInfo, and the keys in lexicographic order (the same order as S3 listings)
+        self.objects = {}
+        self.keys = []
+
+        if os.path.exists(manifest_fpath):
+            self._load()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        i = bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def _load(self):
+        with open(self.manifest_fpath, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("deleted"):
+                    self.objects.pop(entry["key"], None)
+                else:
+                    self.objects[entry["key"]] = ObjectInfo(entry["key"], entry["size"], entry["etag"])
+
+        self.keys = sorted(self.objects)
+
+    def _write(self, entries, fpath, mode="a"):
+        os.makedirs(os.path.dirname(os.path.abspath(fpath)), exist_ok=True)
+        with open(fpath, mode) as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+
+    def refresh(self, full=False):
+        """
+        Update the manifest with the keys of the bucket.
+        By default, only the keys that come after the last known one are listed. Keys added anywhere else in the
+        listing order (i.e. new document ids that are smaller than the last one) are only found by a full refresh,
+        unless they were added to the manifest with add() when they were stored. So the incremental refresh is only
+        complete for prefixes whose keys are added in listing order, which is not the case of the sentence files.
+        A full refresh only rewrites the manifest file if the listing changed
+        """
+        if full or not self.keys:
+            objects = {obj.key: obj for obj in self.backend.list_objects(self.prefix)}
+            if objects == self.objects and os.path.exists(self.manifest_fpath):
+                return self
+
+            self.objects = objects
+            self.keys = sorted(self.objects)
+
+            # Rewrite the whole file atomically, so an interrupted refresh never leaves a truncated manifest
+            tmp_fpath = self.manifest_fpath + ".tmp"
+            self._write((self.objects[key]._asdict() for key in self.keys), tmp_fpath, mode="w")
+            os.replace(tmp_fpath, self.manifest_fpath)
+        else:
+            new_objects = list(self.backend.list_objects(self.prefix, start_after=self.keys[-1]))
+            for obj in new_objects:
+                self.objects[obj.key] = obj
+            self.keys.extend(obj.key for obj in new_objects)
+            self._write((obj._asdict() for obj in new_objects), self.manifest_fpath)
+
+        return self
+
+    def add(self, key, size, etag=None):
+        """
+        Record an object that was just stored, without listing the bucket again
+        """
+        if key not in self.objects:
+            insort(self.keys, key)
+        self.objects[key] = ObjectInfo(key, size, etag)
+        self._write([self.objects[key]._asdict()], self.manifest_fpath)
+
+    def remove(self, key):
+        if key in self.objects:
+            del self.objects[key]
+            del self.keys[bisect_left(self.keys, key)]
+            self._write([{"key": key, "deleted": True}], self.manifest_fpath)
+
+    def keys_in_range(self, init_doc, end_doc):
+        """
+        Return the keys in positions [init_doc, end_doc) of the listing order, without going through the ones before
+        """
+        return self.keys[init_doc:end_doc]
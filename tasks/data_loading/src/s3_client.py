@@ -1,15 +1,39 @@
 from tasks.data_loading.src.s3_client_utils import *
+from tasks.data_loading.src.storage_backends import *
+from tasks.data_loading.src.key_manifest import KeyManifest
+from tasks.data_loading.src.utils import bounded_ordered_map
+from concurrent.futures import ThreadPoolExecutor
 from pandas import DataFrame, read_excel
 from csv import reader
-from codecs import getreader
+from io import BytesIO, StringIO
+from collections import namedtuple
+import os
+
+# Result of S3Client.move_objects(): the list of object names that were moved,
+# and a map of {object name: error message} for the ones that were not
+MoveResult = namedtuple("MoveResult", ["moved", "failed"])
 
 
 class S3Client:
-    def __init__(self, creds_filepath, bucket_name, language=None):
-        self.aws_id, self.aws_secret = aws_credentials_from_file(creds_filepath)
-        self.s3 = get_s3(self.aws_id, self.aws_secret)
+    def __init__(self, creds_filepath=None, bucket_name="wri-nlp-policy", language=None, backend=None,
+                 manifest_folder=None):
+        """
+        By default, objects are read from and written to the given S3 bucket using the AWS credentials file.
+        Any other StorageBackend can be passed instead (i.e. a LocalBackend or InMemoryBackend), in which
+        case no credentials are needed and nothing goes through the network.
+        If a manifest folder is given, the keys of the sentence folders are cached there (see KeyManifest), so
+        loading a range of documents or the documents of a country does not list the whole folder every time
+        """
         self.bucket_name = bucket_name
+        if backend is None:
+            self.aws_id, self.aws_secret = aws_credentials_from_file(creds_filepath)
+            backend = S3Backend(self.aws_id, self.aws_secret, bucket_name)
+            self.s3 = backend.s3
+
+        self.backend = backend
         self.metadata_folder = f"metadata/"
+        self.manifest_folder = manifest_folder
+        self.manifests = {}
 
         # Language dependent DB names
         self.language = None
@@ -38,77 +62,177 @@ class S3Client:
             self.raw_files_folder = f"{self.base_folder}/raw_pdf"
             self.new_text_files_folder = f"{self.base_folder}/text_files/new"
             self.processed_text_files_folder = f"{self.base_folder}/text_files/processed"
-            self.new_sentences_folder = f"{self.base_folder}/sentences"  #/new
+            self.new_sentences_folder = self._sentences_folder(language)  #/new
             # self.processed_sentences_folder = f"{self.base_folder}/sentences/processed"
             self.assisted_labeling_folder = f"{self.base_folder}/assisted_labeling"
 
             # Files
             self.abbrevs_file = f"abbreviations/{language}_abbreviations.txt"
 
+    @staticmethod
+    def _sentences_folder(language):
+        return f"{language}_documents/sentences"
+
+    def get_manifest(self, folder, refresh=False):
+        """
+        Return the KeyManifest of a folder of the bucket, or None if the client was created without a manifest folder.
+        The whole folder is listed again the first time the manifest is opened by the client (see
+        KeyManifest.refresh()). An incremental refresh is not enough: sentence files are named after random document
+        ids, so most new keys do not come after the last known one, and a stale manifest would shift the ranges of
+        load_sentences() and skip documents in load_country_sentences(). Afterwards, the manifest is kept up to date by
+        store_sentences() and only refreshed when asked to
+        """
+        if self.manifest_folder is None:
+            return None
+
+        if folder not in self.manifests:
+            manifest_fpath = os.path.join(self.manifest_folder, f"{self.bucket_name}_{folder.replace('/', '_')}.jsonl")
+            self.manifests[folder] = KeyManifest(self.backend, folder, manifest_fpath)
+            refresh = True
+
+        if refresh:
+            self.manifests[folder].refresh(full=True)
+
+        return self.manifests[folder]
+
     def move_object(self, obj_name, obj_old_folder, obj_new_folder):
         """
         Move an object from a given S3 folder to another by copying it to the new folder,
         then deleting it from the old one
         """
         try:
-            self.s3.meta.client.copy_object(Bucket=self.bucket_name,
-                                                 CopySource=f"{self.bucket_name}/{obj_old_folder}/{obj_name}",
-                                                 Key=f"{obj_new_folder}/{obj_name}")
-            _ = self.s3.Object(self.bucket_name, f"{obj_old_folder}/{obj_name}").delete()
+            self.backend.copy(f"{obj_old_folder}/{obj_name}", f"{obj_new_folder}/{obj_name}")
+            self.backend.delete(f"{obj_old_folder}/{obj_name}")
         except Exception as e:
             print(f"Error while moving {obj_name} from {obj_old_folder} to {obj_new_folder}.")
             print(e)
 
-    def load_text_files(self, language):
+    def move_objects(self, obj_names, obj_old_folder, obj_new_folder, max_workers=16):
+        """
+        Move several objects from a given S3 folder to another. All the copies are done in parallel, and then the
+        copied objects are deleted from the old folder in batches (up to 1000 objects per request in S3).
+        Objects whose copy failed are not deleted. Return a MoveResult with the objects moved and the ones that failed
+        """
+        failed = {}
+        copied = []
+
+        def copy(obj_name):
+            self.backend.copy(f"{obj_old_folder}/{obj_name}", f"{obj_new_folder}/{obj_name}")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(obj_name, executor.submit(copy, obj_name)) for obj_name in obj_names]
+            for obj_name, future in futures:
+                try:
+                    future.result()
+                    copied.append(obj_name)
+                except Exception as e:
+                    failed[obj_name] = f"Copy failed: {e}"
+
+        failed_deletes = self.backend.delete_many([f"{obj_old_folder}/{obj_name}" for obj_name in copied])
+        for obj_name in copied:
+            key = f"{obj_old_folder}/{obj_name}"
+            if key in failed_deletes:
+                failed[obj_name] = f"Copied, but delete failed: {failed_deletes[key]}"
+
+        return MoveResult([obj_name for obj_name in copied if obj_name not in failed], failed)
+
+    def _get_objects(self, keys, prefetch=0):
+        """
+        Yield the key and the content of each of the given objects, in the same order as the keys.
+        If prefetch > 0, that many objects are downloaded concurrently ahead of the one being consumed
+        """
+        if prefetch <= 0:
+            for key in keys:
+                yield key, self.backend.get(key)
+            return
+
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            fetch = lambda key: (key, self.backend.get(key))
+            yield from bounded_ordered_map(executor, fetch, ((key,) for key in keys), window=prefetch)
+
+    def load_text_files(self, language, prefetch=0):
         """
         Yield a text file id, and the text content of the file itself from the new text files folder
         These should be used for sentence splitting, and then calling the store_sentences() method
+        With prefetch > 0, that many files are downloaded in the background while the current one is processed
         """
         self._update_folder_names(language)
-        for obj in self.s3.Bucket(self.bucket_name).objects.all().filter(Prefix=self.new_text_files_folder):
-            if not obj.key.endswith("/"):
-                file_id = obj.key.replace(self.new_text_files_folder, "").replace(".txt", "")
-                text = obj.get()['Body'].read().decode('utf-8')
-                yield file_id, text
+        # The folder names of the client change whenever it is used with another language while the files are loaded
+        text_files_folder = self.new_text_files_folder
+        keys = (obj.key for obj in self.backend.list_objects(text_files_folder) if not obj.key.endswith("/"))
+        for key, body in self._get_objects(keys, prefetch):
+            file_id = key.replace(text_files_folder, "").replace(".txt", "")
+            text = body.decode('utf-8')
+            yield file_id, text
 
     def store_sentences(self, sents, file_uuid, language):
         """
-        Store a JSON file containing the metadata and sentences for a given text file in the S3 bucket
+        Store a JSON file containing the metadata and sentences for a given text file in the S3 bucket, in the sentences
+        folder of the given language. The folder names of the client are left unchanged
         """
-        self._update_folder_names(language)
+        sentences_folder = self._sentences_folder(language)
         sents_json = {file_uuid: {"metadata":
                                       {"n_sentences": len(sents),
                                        "language": language},
                                   "sentences": sents}}
 
-        self.s3.Object(self.bucket_name, f"{self.new_sentences_folder}/{file_uuid}_sents.json") \
-            .put(Body=(json.dumps(sents_json, indent=4)))
+        key = f"{sentences_folder}/{file_uuid}_sents.json"
+        body = json.dumps(sents_json, indent=4)
+        self.backend.put(key, body)
+
+        if sentences_folder in self.manifests:
+            self.manifests[sentences_folder].add(key, len(body.encode("utf-8")))
 
-    def load_sentences(self, language, init_doc, end_doc):
+    def load_sentences(self, language, init_doc, end_doc, prefetch=0):
         """
         Yield a sentence id and a sentence dictionary in the format
             {"text": "Sample sentence text", "labels": [0]}
         from the JSON files in the sentence folder of the S3 bucket
+        With prefetch > 0, that many files are downloaded in the background while the current one is processed
         """
         self._update_folder_names(language)
-        for i, obj in enumerate(self.s3.Bucket(self.bucket_name).objects.all().filter(Prefix=self.new_sentences_folder)):
-            if not obj.key.endswith("/") and init_doc <= i < end_doc:
-                sents = labeled_sentences_from_json(json.loads(obj.get()['Body'].read()))
-                for sent_id, sent_labels_map in sents.items():
-                    yield sent_id, sent_labels_map
+        manifest = self.get_manifest(self.new_sentences_folder)
+        if manifest is not None:
+            keys = (key for key in manifest.keys_in_range(init_doc, end_doc) if not key.endswith("/"))
+        else:
+            keys = (obj.key for i, obj in enumerate(self.backend.list_objects(self.new_sentences_folder))
+                    if not obj.key.endswith("/") and init_doc <= i < end_doc)
+
+        yield from self._sentences_from_keys(keys, prefetch)
+
+    def load_country_sentences(self, language, country, prefetch=0):
+        """
+        Same as load_sentences(), for the documents of a given country (see doc_ids_per_country()).
+        Documents of the country that do not have a sentences file yet are skipped
+        """
+        self._update_folder_names(language)
+        manifest = self.get_manifest(self.new_sentences_folder)
+        if manifest is not None:
+            stored_keys = manifest
+        else:
+            stored_keys = set(obj.key for obj in self.backend.list_objects(self.new_sentences_folder))
+
+        keys = [f"{self.new_sentences_folder}/{doc_id}_sents.json" for doc_id in self.doc_ids_per_country(country)]
+        yield from self._sentences_from_keys([key for key in keys if key in stored_keys], prefetch)
+
+    def _sentences_from_keys(self, keys, prefetch=0):
+        for _, body in self._get_objects(keys, prefetch):
+            sents = labeled_sentences_from_json(json.loads(body))
+            for sent_id, sent_labels_map in sents.items():
+                yield sent_id, sent_labels_map
 
     def store_assisted_labeling_csv(self, results_dictionary, queries_dictionary, init_doc, results_limit):
         """
         Store a CSV file containing the sentence id, similarity score and sentence text as columns.
         In addition, there's an empty column for the labeling of each sentence
         """
-        path = f"s3://{self.bucket_name}/{self.assisted_labeling_folder}"
         col_headers = ["sentence_id", "similarity_score", "text"]
         for i, query in enumerate(results_dictionary.keys()):
-            filename = f"{path}/query_{queries_dictionary[query]}_{i}_results_{init_doc}.csv"
-            DataFrame(results_dictionary[query], columns=col_headers) \
+            filename = f"{self.assisted_labeling_folder}/query_{queries_dictionary[query]}_{i}_results_{init_doc}.csv"
+            csv_str = DataFrame(results_dictionary[query], columns=col_headers) \
                 .head(results_limit) \
-                .to_csv(filename, storage_options={"key": self.aws_id, "secret": self.aws_secret})
+                .to_csv()
+            self.backend.put(filename, csv_str)
 
     def doc_ids_per_country(self, country):
         """
@@ -116,10 +240,8 @@ class S3Client:
         In the CSV, the file id is the file name without the file extension ("23sd45fg.txt" without the ".txt")
         """
         metadata_fname = f"{self.metadata_folder}/{country}_metadata.csv"
-        obj = self.s3.Object(bucket_name=self.bucket_name, key=metadata_fname)
-
         doc_ids = []
-        for row in reader(getreader("utf-8")(obj.get()['Body'])):
+        for row in reader(StringIO(self.backend.get(metadata_fname).decode("utf-8"))):
             # Add original file ID without the file format
             doc_ids.append(row[3][:-4])
 
@@ -130,8 +252,7 @@ class S3Client:
         Gets the set of abbreviations for a given language, from the text file in the S3 bucket
         """
         self._update_folder_names(language)
-        obj = self.s3.Object(bucket_name=self.bucket_name, key=self.abbrevs_file)
-        abbreviations_str = obj.get()['Body'].read().decode('utf-8')
+        abbreviations_str = self.backend.get(self.abbrevs_file).decode('utf-8')
         return set(abbreviations_str.split("\n"))
 
     def get_queries(self, language):
@@ -139,5 +260,4 @@ class S3Client:
         Return a pandas dataframe with the queries stored as an excel file for assisted labeling.
         """
         self._update_folder_names(language)
-        return read_excel(f"s3://{self.bucket_name}/assisted_labeling_queries/english_queries.xlsx",
-                      storage_options={"key": self.aws_id, "secret": self.aws_secret})
+        return read_excel(BytesIO(self.backend.get("assisted_labeling_queries/english_queries.xlsx")))
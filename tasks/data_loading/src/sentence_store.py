@@ -0,0 +1,197 @@
+""" Sample usage:
+    -  Format
+        $ python sentence_store.py -c [path_to_aws_credentials_json] -l [english | spanish] -co [country ...]
+    -  Convert the JSON sentence files of the Chilean and Mexican documents to the columnar store
+        $ python sentence_store.py -c /Users/some_user/credentials.json -l spanish -co Chile Mexico
+
+    Columnar alternative to the per-document JSON sentence files. Sentences are stored in Parquet files with the columns
+        doc_id | sent_id | text | labels
+    sharded by language and country, i.e. spanish_documents/sentence_store/country=Chile/part-00000.parquet
+    Labels are stored as lists of integers, like in the JSON files. Converting a country again replaces its shard.
+"""
+import argparse
+from io import BytesIO
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from tasks.data_loading.src.s3_client import S3Client
+
+SENTENCE_STORE_COLUMNS = ["doc_id", "sent_id", "text", "labels"]
+
+
+def check_pyarrow():
+    if pa is None:
+        raise ImportError("The columnar sentence store needs pyarrow. Install it with: pip install pyarrow")
+
+
+def sentence_store_folder(language, country=None):
+    folder = f"{language}_documents/sentence_store"
+    return folder if country is None else f"{folder}/country={country}"
+
+
+def sentence_store_schema():
+    check_pyarrow()
+    return pa.schema([("doc_id", pa.string()),
+                      ("sent_id", pa.string()),
+                      ("text", pa.string()),
+                      ("labels", pa.list_(pa.int64()))])
+
+
+class SentenceStoreWriter:
+    """
+    Buffer the sentences of the documents of one language and country, and write them as a new Parquet part file
+    every rows_per_file sentences (and when closed). Existing part files of the shard are kept and new ones are added
+    after them, unless overwrite is True: then the shard is written from its first part file, and the previous part
+    files that were not rewritten are deleted when the writer is closed
+    """
+
+    def __init__(self, backend, language, country, rows_per_file=500000, row_group_size=50000, overwrite=False):
+        check_pyarrow()
+        self.backend = backend
+        self.folder = sentence_store_folder(language, country)
+        self.rows_per_file = rows_per_file
+        self.row_group_size = row_group_size
+
+        existing_keys = [obj.key for obj in backend.list_objects(self.folder + "/") if obj.key.endswith(".parquet")]
+        self.stale_keys = set(existing_keys) if overwrite else set()
+        self.n_parts = 0 if overwrite else len(existing_keys)
+        self.rows = {column: [] for column in SENTENCE_STORE_COLUMNS}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The buffered sentences of a failed conversion are not written, so that it can simply be run again
+        if exc_type is None:
+            self.close()
+
+    def add_document(self, doc_id, sents):
+        """
+        Add the sentences of a document, in the format {sent_id: {"text": "sentence text", "labels": []}}
+        """
+        for sent_id, sent_labels_map in sents.items():
+            self.rows["doc_id"].append(doc_id)
+            self.rows["sent_id"].append(sent_id)
+            self.rows["text"].append(sent_labels_map["text"])
+            # The sentence splitting output uses "label" instead of "labels"
+            labels = sent_labels_map.get("labels", sent_labels_map.get("label", []))
+            self.rows["labels"].append([int(label) for label in labels])
+
+        if len(self.rows["sent_id"]) >= self.rows_per_file:
+            self.flush()
+
+    def flush(self):
+        if not self.rows["sent_id"]:
+            return
+
+        table = pa.Table.from_pydict(self.rows, schema=sentence_store_schema())
+        buffer = BytesIO()
+        pq.write_table(table, buffer, row_group_size=self.row_group_size)
+        key = f"{self.folder}/part-{self.n_parts:05d}.parquet"
+        self.backend.put(key, buffer.getvalue())
+        self.stale_keys.discard(key)
+
+        self.n_parts += 1
+        self.rows = {column: [] for column in SENTENCE_STORE_COLUMNS}
+
+    def close(self):
+        self.flush()
+
+        failed = self.backend.delete_many(sorted(self.stale_keys))
+        if failed:
+            raise OSError(f"Could not delete the previous part files of {self.folder}: {failed}")
+        self.stale_keys = set()
+
+
+class SentenceStoreReader:
+    def __init__(self, backend):
+        check_pyarrow()
+        self.backend = backend
+
+    def shard_keys(self, language, country=None):
+        """
+        Keys of the Parquet part files of a language, optionally only the ones of a given country
+        """
+        folder = sentence_store_folder(language, country)
+        return [obj.key for obj in self.backend.list_objects(folder + "/") if obj.key.endswith(".parquet")]
+
+    def iter_batches(self, language, country=None, columns=None, batch_size=10000):
+        """
+        Yield pyarrow RecordBatches of at most batch_size sentences, reading only the given columns (all by default).
+        Only one row group of one part file is decoded at a time
+        """
+        for key in self.shard_keys(language, country):
+            parquet_file = pq.ParquetFile(BytesIO(self.backend.get(key)))
+            yield from parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+
+    def iter_sentences(self, language, country=None, batch_size=10000):
+        """
+        Yield a sentence id and a sentence dictionary in the format {"text": "Sample sentence text", "labels": [0]},
+        like S3Client.load_sentences() does from the JSON files
+        """
+        for batch in self.iter_batches(language, country, ["sent_id", "text", "labels"], batch_size):
+            columns = batch.to_pydict()
+            for sent_id, text, labels in zip(columns["sent_id"], columns["text"], columns["labels"]):
+                yield sent_id, {"text": text, "labels": labels}
+
+
+def doc_id_from_sent_id(sent_id):
+    """
+    Sentence ids are built as "{doc_id}_sent_{i}" during sentence splitting
+    """
+    return sent_id.rsplit("_sent_", 1)[0]
+
+
+def json_to_sentence_store(s3_client, language, country, prefetch=0):
+    """
+    Copy the sentences of the JSON files of a country's documents to the columnar store, replacing the previous shard
+    of the country if any. Return the number of sentences
+    """
+    n_sents = 0
+    current_doc_id = None
+    doc_sents = {}
+    with SentenceStoreWriter(s3_client.backend, language, country, overwrite=True) as writer:
+        for sent_id, sent_labels_map in s3_client.load_country_sentences(language, country, prefetch):
+            doc_id = doc_id_from_sent_id(sent_id)
+            if doc_id != current_doc_id and doc_sents:
+                writer.add_document(current_doc_id, doc_sents)
+                doc_sents = {}
+
+            current_doc_id = doc_id
+            doc_sents[sent_id] = sent_labels_map
+            n_sents += 1
+
+        if doc_sents:
+            writer.add_document(current_doc_id, doc_sents)
+
+    return n_sents
+
+
+def main(credentials_fpath, language, countries, prefetch):
+    s3_client = S3Client(creds_filepath=credentials_fpath, bucket_name="wri-nlp-policy", language=language)
+
+    for country in countries:
+        n_sents = json_to_sentence_store(s3_client, language, country, prefetch)
+        print(f"{country}: stored {n_sents} sentences in {sentence_store_folder(language, country)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-c', '--creds_file', required=True,
+                        help="AWS credentials JSON file")
+    parser.add_argument('-l', '--language', required=True,
+                        help="Language of the documents. Current options are: english, spanish")
+    parser.add_argument('-co', '--countries', required=True, nargs='+',
+                        help="Countries whose documents are converted, as named in the metadata files")
+    parser.add_argument('-f', '--prefetch', default=8,
+                        help="Number of JSON files to download concurrently")
+
+    args = parser.parse_args()
+
+    main(args.creds_file, args.language, args.countries, int(args.prefetch))
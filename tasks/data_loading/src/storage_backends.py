@@ -0,0 +1,178 @@
+"""
+Storage backends used by the S3Client to read and write objects.
+
+    - S3Backend: the actual S3 bucket, through boto3
+    - LocalBackend: a local folder, where each key is a path relative to that folder
+    - InMemoryBackend: a dictionary of keys to bytes, useful for tests and benchmarks without network access
+
+All of them work with S3-like keys, i.e. "english_documents/text_files/new/23effs8765.txt"
+"""
+import os
+from collections import namedtuple
+from hashlib import md5
+
+from tasks.data_loading.src.s3_client_utils import get_s3
+
+# Key, size in bytes and ETag of a stored object, as returned by list_objects()
+ObjectInfo = namedtuple("ObjectInfo", ["key", "size", "etag"])
+
+
+class StorageBackend:
+    """
+    Interface of the storage backends. Keys are always listed in lexicographic order, like S3 does
+    """
+
+    def list_objects(self, prefix, start_after=None):
+        """
+        Yield an ObjectInfo for each object whose key starts with the given prefix.
+        If start_after is given, only the keys that come after it are listed
+        """
+        raise NotImplementedError
+
+    def get(self, key):
+        """
+        Return the content of an object as bytes
+        """
+        raise NotImplementedError
+
+    def put(self, key, body):
+        """
+        Store an object, given its content as bytes or string
+        """
+        raise NotImplementedError
+
+    def copy(self, source_key, target_key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        """
+        Delete several objects, and return a map of {key: error message} for the ones that could not be deleted
+        """
+        failed = {}
+        for key in keys:
+            try:
+                self.delete(key)
+            except Exception as e:
+                failed[key] = str(e)
+
+        return failed
+
+
+class S3Backend(StorageBackend):
+    def __init__(self, aws_id, aws_secret, bucket_name):
+        self.s3 = get_s3(aws_id, aws_secret)
+        self.bucket_name = bucket_name
+
+    def list_objects(self, prefix, start_after=None):
+        paginator = self.s3.meta.client.get_paginator("list_objects_v2")
+        list_params = {"Bucket": self.bucket_name, "Prefix": prefix}
+        if start_after is not None:
+            list_params["StartAfter"] = start_after
+
+        for page in paginator.paginate(**list_params):
+            for obj in page.get("Contents", []):
+                yield ObjectInfo(obj["Key"], obj["Size"], obj["ETag"].strip('"'))
+
+    def get(self, key):
+        # The boto3 client (unlike the resource) is thread safe, so objects can be fetched concurrently
+        return self.s3.meta.client.get_object(Bucket=self.bucket_name, Key=key)["Body"].read()
+
+    def put(self, key, body):
+        self.s3.meta.client.put_object(Bucket=self.bucket_name, Key=key, Body=body)
+
+    def copy(self, source_key, target_key):
+        self.s3.meta.client.copy_object(Bucket=self.bucket_name,
+                                        CopySource=f"{self.bucket_name}/{source_key}",
+                                        Key=target_key)
+
+    def delete(self, key):
+        self.s3.meta.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def delete_many(self, keys):
+        # A single delete_objects request accepts up to 1000 keys
+        failed = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            chunk = keys[i:i + 1000]
+            try:
+                response = self.s3.meta.client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={"Objects": [{"Key": key} for key in chunk], "Quiet": True})
+                for error in response.get("Errors", []):
+                    failed[error["Key"]] = f"{error.get('Code')}: {error.get('Message')}"
+            except Exception as e:
+                failed.update({key: str(e) for key in chunk})
+
+        return failed
+
+
+class LocalBackend(StorageBackend):
+    """
+    Mirror of the bucket in a local folder, i.e. the key "metadata/Chile_metadata.csv" is stored in
+    "{root_path}/metadata/Chile_metadata.csv"
+    """
+
+    def __init__(self, root_path):
+        self.root_path = os.path.abspath(root_path)
+
+    def _path(self, key):
+        return os.path.join(self.root_path, *key.split("/"))
+
+    def list_objects(self, prefix, start_after=None):
+        # Only walk the deepest folder fully contained in the prefix
+        prefix_folder = prefix.rsplit("/", 1)[0] if "/" in prefix else ""
+        keys = []
+        for dir_path, _, file_names in os.walk(self._path(prefix_folder)):
+            rel_dir = os.path.relpath(dir_path, self.root_path).replace(os.sep, "/")
+            for file_name in file_names:
+                key = file_name if rel_dir == "." else f"{rel_dir}/{file_name}"
+                if key.startswith(prefix) and (start_after is None or key > start_after):
+                    keys.append(key)
+
+        for key in sorted(keys):
+            stat = os.stat(self._path(key))
+            yield ObjectInfo(key, stat.st_size, f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+    def get(self, key):
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def put(self, key, body):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(body.encode("utf-8") if isinstance(body, str) else body)
+
+    def copy(self, source_key, target_key):
+        self.put(target_key, self.get(source_key))
+
+    def delete(self, key):
+        os.remove(self._path(key))
+
+
+class InMemoryBackend(StorageBackend):
+    def __init__(self, objects=None):
+        self.objects = {}
+        for key, body in (objects or {}).items():
+            self.put(key, body)
+
+    def list_objects(self, prefix, start_after=None):
+        for key in sorted(self.objects):
+            if key.startswith(prefix) and (start_after is None or key > start_after):
+                body = self.objects[key]
+                yield ObjectInfo(key, len(body), md5(body).hexdigest())
+
+    def get(self, key):
+        return self.objects[key]
+
+    def put(self, key, body):
+        self.objects[key] = body.encode("utf-8") if isinstance(body, str) else bytes(body)
+
+    def copy(self, source_key, target_key):
+        self.objects[target_key] = self.objects[source_key]
+
+    def delete(self, key):
+        del self.objects[key]
@@ -2,10 +2,27 @@ import json
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
+from collections import deque
 from os import listdir
 from os.path import isfile, join
 
 
+def bounded_ordered_map(executor, fn, args_iterable, window):
+    """
+    Yield fn(*args) for each tuple of args, in the same order as the given iterable, while keeping
+    at most `window` calls in flight in the executor (a concurrent.futures thread or process pool).
+    The iterable is only consumed as results are yielded, so memory stays bounded for long (or lazy) inputs.
+    """
+    in_flight = deque()
+    for args in args_iterable:
+        in_flight.append(executor.submit(fn, *args))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
 def country_labeled_sentences(excel_map):
     result = {}
     sent_num = 0
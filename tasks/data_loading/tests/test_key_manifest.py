@@ -0,0 +1,23 @@
+import json
+
+from tasks.data_loading import S3Client
+from tasks.data_loading.src.storage_backends import InMemoryBackend
+
+
+def sentences_file(doc_id):
+    return json.dumps({doc_id: {"metadata": {"n_sentences": 1, "language": "english"},
+                                "sentences": {f"{doc_id}_sent_0": {"text": f"Sentence of {doc_id}", "labels": [0]}}}})
+
+
+def test_new_client_finds_keys_stored_before_the_last_known_one(tmp_path):
+    backend = InMemoryBackend({f"english_documents/sentences/{doc_id}_sents.json": sentences_file(doc_id)
+                               for doc_id in ["b2", "d4"]})
+    s3_client = S3Client(backend=backend, manifest_folder=str(tmp_path))
+    assert [sent_id for sent_id, _ in s3_client.load_sentences("english", 0, 10)] == ["b2_sent_0", "d4_sent_0"]
+
+    # Stored by another process, with a document id smaller than the last one of the manifest
+    backend.put("english_documents/sentences/a1_sents.json", sentences_file("a1"))
+
+    s3_client = S3Client(backend=backend, manifest_folder=str(tmp_path))
+    assert [sent_id for sent_id, _ in s3_client.load_sentences("english", 0, 2)] == ["a1_sent_0", "b2_sent_0"]
+    assert [sent_id for sent_id, _ in s3_client.load_sentences("english", 2, 3)] == ["d4_sent_0"]
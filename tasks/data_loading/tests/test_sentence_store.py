@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from tasks.data_loading import S3Client
+from tasks.data_loading.src.sentence_store import SentenceStoreReader, json_to_sentence_store
+from tasks.data_loading.src.storage_backends import InMemoryBackend
+
+DOCUMENT_LABELS = {"a1": [[0], [1, 3]], "b2": [[], [2]]}
+
+
+def sentences_file(doc_id, labels_per_sent):
+    sents = {f"{doc_id}_sent_{i}": {"text": f"Sentence {i} of {doc_id}", "labels": labels}
+             for i, labels in enumerate(labels_per_sent)}
+    return json.dumps({doc_id: {"metadata": {"n_sentences": len(sents), "language": "spanish"}, "sentences": sents}})
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    backend = InMemoryBackend({f"spanish_documents/sentences/{doc_id}_sents.json": sentences_file(doc_id, labels)
+                               for doc_id, labels in DOCUMENT_LABELS.items()})
+    s3_client = S3Client(backend=backend)
+    monkeypatch.setattr(s3_client, "doc_ids_per_country", lambda country: list(DOCUMENT_LABELS))
+    return s3_client
+
+
+def test_sentence_store_yields_the_same_sentences_as_the_json_files(s3_client):
+    assert json_to_sentence_store(s3_client, "spanish", "Chile") == 4
+
+    stored_sents = list(SentenceStoreReader(s3_client.backend).iter_sentences("spanish", "Chile"))
+    assert stored_sents == list(s3_client.load_sentences("spanish", 0, len(DOCUMENT_LABELS)))
+    assert stored_sents[1] == ("a1_sent_1", {"text": "Sentence 1 of a1", "labels": [1, 3]})
+
+
+def test_converting_a_country_again_replaces_its_shard(s3_client):
+    json_to_sentence_store(s3_client, "spanish", "Chile")
+    json_to_sentence_store(s3_client, "spanish", "Chile")
+
+    reader = SentenceStoreReader(s3_client.backend)
+    assert len(reader.shard_keys("spanish", "Chile")) == 1
+    assert len(list(reader.iter_sentences("spanish", "Chile"))) == 4
@@ -2,7 +2,10 @@ from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
 import seaborn as sns
 import pandas as pd
-import wandb
+try:
+    import wandb
+except ImportError:
+    wandb = None
 import numpy as np
 import matplotlib.pyplot as plt
 import scprep
@@ -73,7 +76,8 @@ def visualize_embeddings_2D(embs, numeric_labels, tsne_perplexity, pca_k_n_comps
     # wandb code
     fig = plt.gcf()
     fig.set_size_inches(15, 10)  # enlarging embeddings
-    wandb.log({"PCA_2D_embedding": wandb.Image(fig)})
+    if wandb is not None and wandb.run is not None:  # only logged within a wandb run
+        wandb.log({"PCA_2D_embedding": wandb.Image(fig)})
     plt.close()  # to prevent plotting at testing time
 
 
@@ -0,0 +1,118 @@
+"""
+Length-bucketed batches for fine-tuning and evaluating S-BERT models.
+
+Sentences go from a few tokens to more than 300, and a batch is padded to its longest sentence. So random batches are
+mostly padding. LengthBucketBatchSampler groups sentences of similar length, and sizes each batch by a token budget
+(batch size x longest sentence) instead of a fixed number of sentences. Each epoch, the sentences are shuffled, split in
+buckets of many batches, sorted by length within each bucket, and the batches are shuffled, so batches still differ
+between epochs.
+"""
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def sentence_token_lengths(texts, sbert_model, batch_size=1000):
+    """
+    Number of tokens of each text as fed to the model (with the special tokens, truncated to its max_seq_length)
+    """
+    tokenizer = sbert_model._first_module().tokenizer
+    max_seq_length = sbert_model.get_max_seq_length()
+    lengths = []
+    for start in range(0, len(texts), batch_size):
+        encoded = tokenizer(list(texts[start:start + batch_size]), truncation=True, max_length=max_seq_length)
+        lengths.extend(len(input_ids) for input_ids in encoded["input_ids"])
+
+    return np.asarray(lengths, dtype=np.int64)
+
+
+def pack_by_tokens(indices, lengths, max_tokens, max_batch_size=None):
+    """
+    Split indices, sorted by length, into consecutive batches whose size x longest length is at most max_tokens.
+    A sentence longer than max_tokens gets a batch of its own
+    """
+    batches = []
+    batch = []
+    batch_max_length = 0
+    for i in indices:
+        new_max_length = max(batch_max_length, lengths[i])
+        if batch and ((len(batch) + 1) * new_max_length > max_tokens or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+            new_max_length = lengths[i]
+        batch.append(int(i))
+        batch_max_length = new_max_length
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def padding_ratio(batches, lengths):
+    """
+    Fraction of the (batch size x longest length) tokens of the batches that are padding
+    """
+    n_tokens = sum(int(lengths[batch].sum()) for batch in map(np.asarray, batches))
+    n_padded_tokens = sum(len(batch) * int(lengths[batch].max()) for batch in map(np.asarray, batches))
+    return 1 - n_tokens / n_padded_tokens if n_padded_tokens else 0.0
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler (the batch_sampler argument of a DataLoader) that yields batches of sentences of similar length, with
+    at most max_tokens tokens (and max_batch_size sentences) each.
+
+    Without shuffle, the batches are taken from all the sentences sorted by length, which is the tightest packing and is
+    what evaluation should use. With shuffle, the randomness comes from the global torch RNG (or from generator), like
+    in torch's RandomSampler, so set_seeds() and resumed trainings apply to it as well. The number of batches of an
+    epoch then varies a little: len() is the one of the sorted packing
+    """
+
+    def __init__(self, lengths, max_tokens=4096, max_batch_size=None, shuffle=True, bucket_size=100, generator=None):
+        """
+        :param lengths: token length of each sentence of the dataset, i.e. from sentence_token_lengths()
+        :param bucket_size: number of batches per bucket. Larger buckets pad less, and smaller ones shuffle more
+        """
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.generator = generator
+
+        self.sorted_batches = pack_by_tokens(np.argsort(self.lengths, kind="stable"), self.lengths, max_tokens,
+                                             max_batch_size)
+
+    def __len__(self):
+        return len(self.sorted_batches)
+
+    def __iter__(self):
+        if not self.shuffle:
+            yield from self.sorted_batches
+            return
+
+        generator = self.generator
+        if generator is None:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        order = torch.randperm(len(self.lengths), generator=generator).numpy()
+        mean_batch_size = len(self.lengths) / max(len(self.sorted_batches), 1)
+        sentences_per_bucket = max(1, int(mean_batch_size * self.bucket_size))
+
+        batches = []
+        for start in range(0, len(order), sentences_per_bucket):
+            bucket = order[start:start + sentences_per_bucket]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches.extend(pack_by_tokens(bucket, self.lengths, self.max_tokens, self.max_batch_size))
+
+        for batch_idx in torch.randperm(len(batches), generator=generator).tolist():
+            yield batches[batch_idx]
+
+    def subset(self, indices, shuffle=False):
+        """
+        Sampler with the same token budget over the given indices of the dataset, i.e. for a Subset of it
+        """
+        return LengthBucketBatchSampler(self.lengths[np.asarray(indices, dtype=np.int64)], self.max_tokens,
+                                        self.max_batch_size, shuffle, self.bucket_size)
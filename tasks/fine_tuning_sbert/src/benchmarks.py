@@ -0,0 +1,185 @@
+""" Sample usage:
+    -  Format
+        $ python benchmarks.py onnx -m [path_to_saved_sbert_model] -x [onnx_folder] -i [path_to_txt_file]
+        $ python benchmarks.py batching -m [sbert_model] -i [path_to_txt_file] -b [any integer] -t [any integer]
+    -  Compare the PyTorch and ONNX (fp32 and int8) encoders of a fine-tuned model on 1000 sentences, with 4 threads
+        $ python benchmarks.py onnx -m ../output/fine_tuned_model/ -x ../output/fine_tuned_model_onnx/ -i sentences.txt
+                                    -n 1000 -th 4
+    -  Compare random batches of 16 sentences with length-bucketed batches of at most 2048 tokens, over 50 steps
+        $ python benchmarks.py batching -m xlm-r-bert-base-nli-stsb-mean-tokens -i sentences.txt -b 16 -t 2048 -s 50
+
+    onnx: the ONNX folder is the output of onnx_encoder.py. For each encoder, prints:
+        - the throughput in sentences/sec, encoding all the sentences in batches of batch_size
+        - the median and 95th percentile latency of encoding a single sentence, as when serving queries one by one
+        - the parity of its cosine scores with the PyTorch model (see onnx_encoder.check_parity())
+
+    batching: for the fixed-size random batches used before and for LengthBucketBatchSampler, with the batch size as
+    its maximum number of sentences (as in the fine-tuning loop) and without it, prints the number of batches of an
+    epoch, their padding ratio, and the training steps/sec and sentences/sec of a softmax classifier on top of the model
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+from sentence_transformers import SentenceTransformer, SentencesDataset, InputExample
+
+from tasks.fine_tuning_sbert.src.batch_sampler import LengthBucketBatchSampler, sentence_token_lengths, padding_ratio
+from tasks.fine_tuning_sbert.src.custom_evaluator import batch_to_device
+from tasks.fine_tuning_sbert.src.onnx_encoder import ONNXSentenceEncoder, check_parity, load_sentences
+
+
+def throughput(encoder, sentences, batch_size):
+    start = time.perf_counter()
+    encoder.encode(sentences, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+    return len(sentences) / (time.perf_counter() - start)
+
+
+def latencies(encoder, sentences, n_queries):
+    """
+    Return the time in milliseconds of encoding each of the first n_queries sentences on its own
+    """
+    times = []
+    for sentence in sentences[:n_queries]:
+        start = time.perf_counter()
+        encoder.encode(sentence, show_progress_bar=False, convert_to_numpy=True)
+        times.append((time.perf_counter() - start) * 1000)
+
+    return np.asarray(times)
+
+
+def onnx_main(model_path, onnx_folder, input_path, max_sents, batch_size, n_queries, n_threads):
+    torch.set_num_threads(n_threads)
+    sentences = load_sentences(input_path, max_sents)
+    print(f"{len(sentences)} sentences, batch size {batch_size}, {n_threads} CPU threads")
+
+    pytorch_model = SentenceTransformer(model_path, device="cpu")
+    encoders = {"PyTorch": pytorch_model,
+                "ONNX fp32": ONNXSentenceEncoder(onnx_folder, quantized=False, n_threads=n_threads),
+                "ONNX int8": ONNXSentenceEncoder(onnx_folder, quantized=True, n_threads=n_threads)}
+
+    for name, encoder in encoders.items():
+        # Warm up, so that the first batch does not count the initialization of the session
+        encoder.encode(sentences[:batch_size], batch_size=batch_size, show_progress_bar=False)
+
+        sents_per_sec = throughput(encoder, sentences, batch_size)
+        query_times = latencies(encoder, sentences, n_queries)
+        print(f"{name}")
+        print(f"    Throughput: {sents_per_sec:.2f} sentences/sec")
+        print(f"    Latency: p50 {np.percentile(query_times, 50):.2f} ms, p95 {np.percentile(query_times, 95):.2f} ms")
+
+        if encoder is not pytorch_model:
+            parity = check_parity(pytorch_model, encoder, sentences, batch_size)
+            print("    Parity: " + ", ".join(f"{name}: {value:.4f}" for name, value in parity.items()))
+
+
+def training_speed(model, dataloader, n_labels, n_steps):
+    """
+    Return the steps/sec and sentences/sec of the first n_steps training steps of a softmax classifier over the batches
+    of dataloader
+    """
+    classifier = nn.Linear(model.get_sentence_embedding_dimension(), n_labels).to(model.device)
+    optimizer = torch.optim.AdamW(list(model.parameters()) + list(classifier.parameters()), lr=2e-5)
+    loss_fct = nn.CrossEntropyLoss()
+    model.train()
+
+    n_sents = 0
+    batches = iter(dataloader)
+    for step in range(n_steps + 1):
+        if step == 1:
+            # The first step is a warm-up
+            start = time.perf_counter()
+            n_sents = 0
+
+        features, labels = batch_to_device(next(batches), model.device)
+        loss = loss_fct(classifier(model(features[0])['sentence_embedding']), labels.view(-1))
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        n_sents += len(labels)
+
+    if model.device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    return n_steps / elapsed, n_sents / elapsed
+
+
+def batching_main(model_name, input_path, max_sents, batch_size, max_tokens, n_steps, n_labels):
+    sentences = load_sentences(input_path, max_sents)
+    model = SentenceTransformer(model_name)
+    lengths = sentence_token_lengths(sentences, model)
+    print(f"{len(sentences)} sentences of {lengths.min()} to {lengths.max()} tokens (mean {lengths.mean():.1f})")
+
+    # Random labels, the speed of a training step does not depend on them
+    examples = [InputExample(texts=[sentence], label=i % n_labels) for i, sentence in enumerate(sentences)]
+    dataset = SentencesDataset(examples, model=model)
+    samplers = {f"Random batches of {batch_size} sentences": None,
+                f"Length-bucketed batches of at most {max_tokens} tokens and {batch_size} sentences":
+                    LengthBucketBatchSampler(lengths, max_tokens, batch_size),
+                f"Length-bucketed batches of at most {max_tokens} tokens":
+                    LengthBucketBatchSampler(lengths, max_tokens)}
+
+    torch.manual_seed(42)
+    for name, sampler in samplers.items():
+        if sampler is None:
+            dataloader = DataLoader(dataset, shuffle=True, batch_size=batch_size)
+        else:
+            dataloader = DataLoader(dataset, batch_sampler=sampler)
+        dataloader.collate_fn = model.smart_batching_collate
+        batches = list(dataloader.batch_sampler)
+
+        steps_per_sec, sents_per_sec = training_speed(model, dataloader, n_labels, min(n_steps, len(dataloader) - 1))
+        print(f"{name}")
+        print(f"    {len(batches)} batches per epoch, {np.mean([len(batch) for batch in batches]):.1f} sentences each")
+        print(f"    Padding ratio: {padding_ratio(batches, lengths):.3f}")
+        print(f"    Training: {steps_per_sec:.2f} steps/sec, {sents_per_sec:.2f} sentences/sec")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    onnx_parser = subparsers.add_parser("onnx", help="PyTorch and ONNX encoders of a fine-tuned model")
+    onnx_parser.add_argument('-m', '--model_path', required=True,
+                             help="Folder of the saved SentenceTransformer model")
+    onnx_parser.add_argument('-x', '--onnx_folder', required=True,
+                             help="Folder of the same model exported with onnx_encoder.py")
+    onnx_parser.add_argument('-i', '--input_path', required=True,
+                             help="Text file with one sentence per line")
+    onnx_parser.add_argument('-n', '--max_sents', default=1000,
+                             help="Number of sentences to encode")
+    onnx_parser.add_argument('-b', '--batch_size', default=32,
+                             help="Number of sentences per batch")
+    onnx_parser.add_argument('-q', '--queries', default=100,
+                             help="Number of single sentence queries of the latency benchmark")
+    onnx_parser.add_argument('-th', '--threads', default=torch.get_num_threads(),
+                             help="Number of CPU threads, for both PyTorch and ONNX Runtime")
+
+    batching_parser = subparsers.add_parser("batching", help="Random and length-bucketed training batches")
+    batching_parser.add_argument('-m', '--model_name', default="xlm-r-bert-base-nli-stsb-mean-tokens",
+                                 help="Name or path of the SentenceTransformer model")
+    batching_parser.add_argument('-i', '--input_path', required=True,
+                                 help="Text file with one sentence per line")
+    batching_parser.add_argument('-n', '--max_sents', default=2000,
+                                 help="Number of sentences of the training set")
+    batching_parser.add_argument('-b', '--batch_size', default=16,
+                                 help="Number of sentences of the random batches, and maximum number of sentences "
+                                      "of the capped length-bucketed batches")
+    batching_parser.add_argument('-t', '--max_tokens', default=2048,
+                                 help="Token budget of the length-bucketed batches")
+    batching_parser.add_argument('-s', '--steps', default=50,
+                                 help="Number of timed training steps")
+    batching_parser.add_argument('-l', '--n_labels', default=8,
+                                 help="Number of labels of the classifier")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "onnx":
+        onnx_main(args.model_path, args.onnx_folder, args.input_path, int(args.max_sents), int(args.batch_size),
+                  int(args.queries), int(args.threads))
+    else:
+        batching_main(args.model_name, args.input_path, int(args.max_sents), int(args.batch_size),
+                      int(args.max_tokens), int(args.steps), int(args.n_labels))
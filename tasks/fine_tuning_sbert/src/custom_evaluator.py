@@ -5,14 +5,13 @@ Added:
     - F1 score calculation
     - Visualization of confusion matrix
     - `call()` function now returns a dict instead of a float, to access more metrics
+    - Logging of the confusion matrix through an ExperimentLogger, only drawn if the logger logs figures
 """
 import itertools
 from typing import Dict
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
-import wandb
 from torch.utils.data import DataLoader
 from torch import device
 import logging
@@ -20,6 +19,8 @@ from tqdm import tqdm
 from sklearn.metrics import f1_score, confusion_matrix
 from sentence_transformers.evaluation import SentenceEvaluator
 
+from tasks.fine_tuning_sbert.src.experiment_logger import ExperimentLogger
+
 
 def batch_to_device(batch, target_device: device):
     """
@@ -37,10 +38,17 @@ def batch_to_device(batch, target_device: device):
 
 def plot_confusion_matrix(cm, label_names, title='Confusion matrix',
                           color_map=None,
-                          normalize=True):
+                          normalize=True,
+                          logger=None):
     """
     Adapted from: https://stackoverflow.com/questions/19233771/sklearn-plot-confusion-matrix-with-labels
+    Nothing is drawn unless the logger logs figures
     """
+    if logger is None or not logger.log_figures:
+        return
+
+    import matplotlib.pyplot as plt
+
     if color_map is None:
         color_map = plt.get_cmap('Blues')
 
@@ -73,10 +81,9 @@ def plot_confusion_matrix(cm, label_names, title='Confusion matrix',
     plt.tight_layout()
     plt.xlabel('Predicted label')
     plt.ylabel('True label')
-    # wandb code
     fig = plt.gcf()
     fig.set_size_inches(15, 10)  # enlarging CM
-    wandb.log({"confusion matrix": wandb.Image(fig)})
+    logger.log_figure("confusion matrix", fig)
     plt.close()  # this should prevent output of plt.imshow above
 
 
@@ -89,17 +96,21 @@ class CustomLabelAccuracyEvaluator(SentenceEvaluator):
     The results are written in a CSV. If a CSV already exists, then values are appended.
     """
 
-    def __init__(self, dataloader: DataLoader, name: str = "", label_names: list = None, softmax_model=None):
+    def __init__(self, dataloader: DataLoader, name: str = "", label_names: list = None, softmax_model=None,
+                 logger: ExperimentLogger = None):
         """
         Constructs an evaluator for the given dataset
 
         :param dataloader:
             the data for the evaluation
+        :param logger:
+            the experiment logger of the confusion matrix (none by default)
         """
         self.dataloader = dataloader
         self.name = name
         self.softmax_model = softmax_model
         self.label_names = label_names
+        self.logger = logger if logger is not None else ExperimentLogger()
 
     def __call__(self, model, epoch: int = -1, steps: int = -1) -> dict:
         model.eval()
@@ -145,6 +156,6 @@ class CustomLabelAccuracyEvaluator(SentenceEvaluator):
         logging.info(f"Macro F1: {macro_f1}")
         logging.info(f"Weighted F1: {weighted_f1}")
 
-        plot_confusion_matrix(cm, self.label_names)
+        plot_confusion_matrix(cm, self.label_names, logger=self.logger)
 
         return score_dict
@@ -0,0 +1,225 @@
+"""
+Experiment loggers for the fine-tuning loop, so that training does not depend on wandb and logging never blocks a
+training step.
+
+All loggers have the interface of wandb.log():
+    logger.log({"validation_acc": 0.8, "epoch": 3})
+    logger.log_figure("confusion matrix", fig)
+The backends are:
+    - ExperimentLogger: logs nothing, and figures are not even drawn
+    - JSONLLogger: one JSON object per log() call in [log_folder]/[run id]/metrics.jsonl, figures as PNG files
+    - CSVLogger: one (time, record, metric, value) row per metric in [log_folder]/[run id]/metrics.csv, figures as PNG
+      files
+    - WandbLogger: the current wandb run, or a new one
+create_logger() wraps the backend in a QueueLogger, which hands the records over to a background thread.
+"""
+import os
+import csv
+import json
+import time
+import logging
+import threading
+from io import BytesIO
+from queue import Queue
+
+try:
+    import wandb
+except ImportError:
+    wandb = None
+
+LOGGER_BACKENDS = ["none", "jsonl", "csv", "wandb"]
+
+
+def check_wandb():
+    if wandb is None:
+        raise ImportError("The wandb logger needs wandb. Install it with: pip install wandb")
+
+
+def figure_to_png(fig):
+    """
+    Render a matplotlib figure as PNG bytes. Matplotlib is not thread safe, so this must run in the thread that drew it
+    """
+    buffer = BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+class ExperimentLogger:
+    """
+    Logger that logs nothing. log_figures tells the callers whether figures should be drawn at all
+    """
+    log_figures = False
+    run_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def log(self, metrics):
+        """
+        Log a dictionary of {metric name: value}, like wandb.log()
+        """
+        pass
+
+    def log_figure(self, name, fig):
+        if self.log_figures:
+            self._log_png(name, figure_to_png(fig))
+
+    def _log_png(self, name, png):
+        pass
+
+    def save_file(self, fpath):
+        """
+        Keep a file (i.e. the saved model) with the logs of the run
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class FileLogger(ExperimentLogger):
+    """
+    Base class of the loggers that write to a folder of their own in log_folder
+    """
+
+    def __init__(self, log_folder, log_figures=True, run_id=None):
+        self.log_figures = log_figures
+        self.run_id = run_id or time.strftime("%Y%m%d-%H%M%S")
+        self.folder = os.path.join(log_folder, self.run_id)
+        os.makedirs(self.folder, exist_ok=True)
+        self.n_figures = 0
+
+    def _log_png(self, name, png):
+        fpath = os.path.join(self.folder, f"{name.replace(' ', '_')}_{self.n_figures}.png")
+        self.n_figures += 1
+        with open(fpath, "wb") as f:
+            f.write(png)
+        self.log({name: fpath})
+
+
+class JSONLLogger(FileLogger):
+    def __init__(self, log_folder, log_figures=True, run_id=None):
+        super().__init__(log_folder, log_figures, run_id)
+        self.file = open(os.path.join(self.folder, "metrics.jsonl"), "a", encoding="utf-8")
+
+    def log(self, metrics):
+        self.file.write(json.dumps({"time": time.time(), **metrics}, default=float) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CSVLogger(FileLogger):
+    def __init__(self, log_folder, log_figures=True, run_id=None):
+        super().__init__(log_folder, log_figures, run_id)
+        fpath = os.path.join(self.folder, "metrics.csv")
+        write_header = not os.path.exists(fpath)
+        self.file = open(fpath, "a", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file)
+        if write_header:
+            self.writer.writerow(["time", "record", "metric", "value"])
+        self.n_records = 0
+
+    def log(self, metrics):
+        now = time.time()
+        for name, value in metrics.items():
+            self.writer.writerow([now, self.n_records, name, value])
+        self.n_records += 1
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class WandbLogger(ExperimentLogger):
+    """
+    Log to the current wandb run, or to a new one started with the given wandb.init() arguments, which is finished
+    when the logger is closed
+    """
+
+    def __init__(self, log_figures=True, **init_kwargs):
+        check_wandb()
+        self.log_figures = log_figures
+        self.owns_run = bool(init_kwargs) or wandb.run is None
+        self.run = wandb.init(**init_kwargs) if self.owns_run else wandb.run
+        self.run_id = self.run.id
+
+    def log(self, metrics):
+        wandb.log(metrics)
+
+    def _log_png(self, name, png):
+        from PIL import Image
+
+        wandb.log({name: wandb.Image(Image.open(BytesIO(png)))})
+
+    def save_file(self, fpath):
+        wandb.save(fpath)
+
+    def close(self):
+        if self.owns_run:
+            wandb.finish()
+
+
+class QueueLogger(ExperimentLogger):
+    """
+    Hand the records over to a background thread that logs them to the backend, so that a slow backend (i.e. wandb
+    over the network) never blocks the caller. Figures are rendered by the caller. close() waits for every record
+    to be logged, then closes the backend
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.log_figures = backend.log_figures
+        self.run_id = backend.run_id
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            method, args = item
+            try:
+                method(*args)
+            except Exception:
+                # A logging failure should not stop the training
+                logging.exception(f"{type(self.backend).__name__} failed to log")
+
+    def log(self, metrics):
+        self.queue.put((self.backend.log, (dict(metrics),)))
+
+    def _log_png(self, name, png):
+        self.queue.put((self.backend._log_png, (name, png)))
+
+    def save_file(self, fpath):
+        self.queue.put((self.backend.save_file, (fpath,)))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.backend.close()
+
+
+def create_logger(backend="none", log_folder=None, log_figures=True, **wandb_init_kwargs):
+    """
+    Create a logger given the name of its backend (see LOGGER_BACKENDS). log_folder is needed by the jsonl and csv
+    backends, and wandb_init_kwargs are only used by the wandb one
+    """
+    if backend == "none":
+        return ExperimentLogger()
+    elif backend == "jsonl":
+        return QueueLogger(JSONLLogger(log_folder, log_figures))
+    elif backend == "csv":
+        return QueueLogger(CSVLogger(log_folder, log_figures))
+    elif backend == "wandb":
+        return QueueLogger(WandbLogger(log_figures, **wandb_init_kwargs))
+    else:
+        raise ValueError(f"Unknown logger backend: {backend}. Options are: {', '.join(LOGGER_BACKENDS)}")
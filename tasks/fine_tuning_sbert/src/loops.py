@@ -1,5 +1,4 @@
 import math
-import wandb
 import time
 from pathlib import Path
 import os
@@ -7,7 +6,6 @@ import random
 import subprocess
 from typing import Iterable, Dict
 
-import cupy as cp
 import spacy
 import torch
 from sentence_transformers import SentencesDataset, SentenceTransformer, InputExample
@@ -16,11 +14,19 @@ from sklearn.model_selection import train_test_split
 from torch import nn, Tensor
 from torch.utils.data import DataLoader
 
+try:
+    import wandb
+except ImportError:
+    wandb = None
+
 from tasks.data_augmentation.src.zero_shot_classification.latent_embeddings_classifier import *
 from tasks.data_loading.src.utils import *
 from tasks.data_visualization.src.plotting import *
 from tasks.fine_tuning_sbert.src.sentence_transformer import EarlyStoppingSentenceTransformer
 from tasks.fine_tuning_sbert.src.custom_evaluator import CustomLabelAccuracyEvaluator
+from tasks.fine_tuning_sbert.src.batch_sampler import LengthBucketBatchSampler, sentence_token_lengths
+from tasks.fine_tuning_sbert.src.experiment_logger import check_wandb, create_logger
+from tasks.fine_tuning_sbert.src.tokenized_dataset import TokenizedCorpus
 from tasks.model_evaluation.src.model_evaluator import *
 
 if spacy.prefer_gpu():
@@ -33,6 +39,12 @@ train_sents = None
 train_labels = None
 label_names = None
 
+# Token budget of a training batch (batch size x longest sentence), i.e. 16 sentences of 128 tokens
+DEFAULT_MAX_TOKENS = 2048
+# Batch size used before the token budget, so that batches of short sentences (and the number of training steps on
+# them, which the warm-up and learning rate schedule depend on) stay the same as before
+DEFAULT_MAX_BATCH_SIZE = 16
+
 
 class SoftmaxClassifier(nn.Module):
     """
@@ -61,6 +73,8 @@ class SoftmaxClassifier(nn.Module):
         loss_fct = nn.CrossEntropyLoss()
 
         if labels is not None:
+            # Kept so that fit() can compute the training accuracy without another forward pass
+            self.last_logits = output.detach()
             loss = loss_fct(output, labels.view(-1))
             return loss
         else:
@@ -73,7 +87,9 @@ def train(config=None):
     """
 
     # this will write to the same project every time
+    check_wandb()
     wandb.init(config=config, magic=True)
+    logger = create_logger("wandb")
 
     config = wandb.config
 
@@ -86,38 +102,26 @@ def train(config=None):
 
     wandb.run.notes = model_deets
 
-    X_train, X_dev, y_train, y_dev = train_test_split(train_sents, train_labels, test_size=config.dev_perc,
-                                                      stratify=train_labels, random_state=100)
-
-    # Load data samples into batches
-    train_batch_size = 16
-    train_samples = build_data_samples(X_train, label2int, y_train)
-    dev_samples = build_data_samples(X_dev, label2int, y_dev)
-
-    # Train set config
+    # Train and dev set config
     model = EarlyStoppingSentenceTransformer(config.model_name)
-    train_dataset = SentencesDataset(train_samples, model=model)
-    train_dataloader = DataLoader(
-        train_dataset, shuffle=True, batch_size=train_batch_size)
-
-    # Dev set config
-    dev_dataset = SentencesDataset(dev_samples, model=model)
-    dev_dataloader = DataLoader(
-        dev_dataset, shuffle=True, batch_size=train_batch_size)
+    train_dataloader, dev_dataloader = build_dataloaders(model, train_sents, train_labels, label2int, config.dev_perc,
+                                                         config.get('max_tokens', DEFAULT_MAX_TOKENS),
+                                                         config.get('tokenized_cache_folder'),
+                                                         config.get('max_batch_size', DEFAULT_MAX_BATCH_SIZE))
 
     # Define the way the loss is computed
     classifier = SoftmaxClassifier(model=model,
                                    sentence_embedding_dimension=model.get_sentence_embedding_dimension(),
                                    num_labels=len(label2int))
     warmup_steps = math.ceil(
-        len(train_dataset) * config.max_num_epochs / train_batch_size * 0.1)  # 10% of train data for warm-up
+        len(train_dataloader) * config.max_num_epochs * 0.1)  # 10% of train data for warm-up
 
     set_seeds(config.seeds)
 
     # Train the model
     start = time.time()
     dev_evaluator = CustomLabelAccuracyEvaluator(dataloader=dev_dataloader, softmax_model=classifier,
-                                                 name='lae-dev', label_names=label_names)
+                                                 name='lae-dev', label_names=label_names, logger=logger)
 
     model.fit(train_objectives=[(train_dataloader, classifier)],
               evaluator=dev_evaluator,
@@ -128,7 +132,9 @@ def train(config=None):
               optimizer_params={'lr': config.learning_rate, 'correct_bias': True},
               baseline=config.baseline,
               patience=config.patience,
+              logger=logger,
               )
+    logger.close()
 
     end = time.time()
     hours, rem = divmod(end - start, 3600)
@@ -140,6 +146,8 @@ def train(config=None):
 def single_run_fine_tune(train_params, train_sents, train_labels, label_names):
     """
     Find the optimal SBERT model by doing a hyperparameter search over random seeds, dev percentage, and different types of SBERT models
+    The metrics are logged to wandb, unless train_params["logger"] is another backend of create_logger()
+    With train_params["tokenized_cache_folder"], all the runs over the same sentences share a single tokenization
     """
     output_path = train_params["output_path"]
     dev_perc = train_params["all_dev_perc"]
@@ -154,43 +162,32 @@ def single_run_fine_tune(train_params, train_sents, train_labels, label_names):
 
     label2int = dict(zip(label_names, range(len(label_names))))
 
-    X_train, X_dev, y_train, y_dev = train_test_split(train_sents, train_labels, test_size=dev_perc,
-                                                      stratify=train_labels, random_state=100)
-
-    # Load data samples into batches
-    train_batch_size = 16
-    train_samples = build_data_samples(X_train, label2int, y_train)
-    dev_samples = build_data_samples(X_dev, label2int, y_dev)
-
-    # Train set config
+    # Train and dev set config
     model = EarlyStoppingSentenceTransformer(model_name)
-    train_dataset = SentencesDataset(train_samples, model=model)
-    train_dataloader = DataLoader(
-        train_dataset, shuffle=True, batch_size=train_batch_size)
-
-    # Dev set config
-    dev_dataset = SentencesDataset(dev_samples, model=model)
-    dev_dataloader = DataLoader(
-        dev_dataset, shuffle=True, batch_size=train_batch_size)
+    train_dataloader, dev_dataloader = build_dataloaders(model, train_sents, train_labels, label2int, dev_perc,
+                                                         train_params.get('max_tokens', DEFAULT_MAX_TOKENS),
+                                                         train_params.get('tokenized_cache_folder'),
+                                                         train_params.get('max_batch_size', DEFAULT_MAX_BATCH_SIZE))
 
     # Define the way the loss is computed
     classifier = SoftmaxClassifier(model=model,
                                    sentence_embedding_dimension=model.get_sentence_embedding_dimension(),
                                    num_labels=len(label2int))
     warmup_steps = math.ceil(
-        len(train_dataset) * max_num_epochs / train_batch_size * 0.1)  # 10% of train data for warm-up
+        len(train_dataloader) * max_num_epochs * 0.1)  # 10% of train data for warm-up
 
     set_seeds(seed)
     model_deets = f"{train_params['eval_classifier']}_model={model_name}_test-perc={dev_perc}_seed={seed}"
 
+    # this will write to the same project every time
+    logger = create_logger(train_params.get('logger', 'wandb'), log_folder=os.path.join(output_path, 'logs'),
+                           log_figures=train_params.get('log_figures', True),
+                           notes=model_deets, project='WRI', tags=['baseline', 'training'], entity='ramanshsharma')
+
     # Train the model
     start = time.time()
     dev_evaluator = CustomLabelAccuracyEvaluator(dataloader=dev_dataloader, softmax_model=classifier,
-                                                 name='lae-dev', label_names=label_names)
-
-    # this will write to the same project every time
-    run = wandb.init(notes=model_deets, project='WRI', tags=['baseline', 'training'],
-                     entity='ramanshsharma')
+                                                 name='lae-dev', label_names=label_names, logger=logger)
 
     model.fit(train_objectives=[(train_dataloader, classifier)],
               evaluator=dev_evaluator,
@@ -201,16 +198,19 @@ def single_run_fine_tune(train_params, train_sents, train_labels, label_names):
               optimizer_params={'lr': learning_rate, 'correct_bias': True},
               baseline=baseline,
               patience=patience,
-              show_progress_bar=False
+              show_progress_bar=False,
+              checkpoint_path=train_params.get('checkpoint_path'),
+              checkpoint_save_steps=train_params.get('checkpoint_save_steps', 0),
+              resume_from=train_params.get('resume_from'),
+              logger=logger,
               )
 
-    run.save()
-    run_name = run.id
+    run_name = logger.run_id
 
     torch.save(model, output_path+'/saved_model.pt')
-    wandb.save(output_path+'/saved_model.pt')
+    logger.save_file(output_path+'/saved_model.pt')
 
-    wandb.finish()
+    logger.close()
 
     end = time.time()
     hours, rem = divmod(end - start, 3600)
@@ -229,6 +229,38 @@ def make_dataset_public(train_sents_, train_labels_, label_names_):
 
 
 
+def build_dataloaders(model, sents, labels, label2int, dev_perc, max_tokens=DEFAULT_MAX_TOKENS,
+                      tokenized_cache_folder=None, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+    """
+    Split the sentences into train and dev sets, and load them into batches of sentences of similar length, with at most
+    max_tokens tokens and max_batch_size sentences each. With a tokenized_cache_folder, the sentences are tokenized once and for all (see
+    TokenizedCorpus) instead of in every batch
+    """
+    if tokenized_cache_folder is None:
+        X_train, X_dev, y_train, y_dev = train_test_split(sents, labels, test_size=dev_perc,
+                                                          stratify=labels, random_state=100)
+        train_dataset = SentencesDataset(build_data_samples(X_train, label2int, y_train), model=model)
+        dev_dataset = SentencesDataset(build_data_samples(X_dev, label2int, y_dev), model=model)
+        train_lengths = sentence_token_lengths(X_train, model)
+        dev_lengths = sentence_token_lengths(X_dev, model)
+    else:
+        corpus = TokenizedCorpus.build(sents, model, tokenized_cache_folder)
+        # The same split as above, since it only depends on the number of sentences and their labels
+        train_rows, dev_rows, y_train, y_dev = train_test_split(np.arange(len(sents)), labels, test_size=dev_perc,
+                                                                stratify=labels, random_state=100)
+        train_dataset = corpus.dataset(train_rows, [label2int[label] for label in y_train])
+        dev_dataset = corpus.dataset(dev_rows, [label2int[label] for label in y_dev])
+        train_lengths = train_dataset.lengths
+        dev_lengths = dev_dataset.lengths
+
+    train_dataloader = DataLoader(train_dataset, batch_sampler=LengthBucketBatchSampler(train_lengths, max_tokens,
+                                                                                        max_batch_size))
+    dev_dataloader = DataLoader(dev_dataset, batch_sampler=LengthBucketBatchSampler(dev_lengths, max_tokens,
+                                                                                    max_batch_size, shuffle=False))
+
+    return train_dataloader, dev_dataloader
+
+
 def build_data_samples(X_train, label2int, y_train):
     train_samples = []
     for sent, label in zip(X_train, y_train):
@@ -252,13 +284,16 @@ def set_seeds(seed):
     torch.backends.cudnn.enabled = False
 
 
-def evaluate_using_sbert(model, test_sents, test_labels, label_names, numeric_labels):
+def evaluate_using_sbert(model, test_sents, test_labels, label_names, numeric_labels, proj_matrix_cache_folder=None,
+                         model_id=None, embedding_cache=None):
     """
     Evaluate an S-BERT model on a previously unseen test set, visualizing the embeddings, confusion matrix,
     and returning. Evaluation method:
      - Calculate cosine similarity between label and sentence embeddings
      #A-latent-embedding-approach
      - Includes the projection matrix approach used in https://joeddav.github.io/blog/2020/05/29/ZSL.html
+    If proj_matrix_cache_folder is given, the projection matrix of a model (identified by model_id) is only fitted once,
+    and with an EmbeddingCache of the model, the test sentences are only encoded once
 
     """
     # Projection matrix Z low-dim projection
@@ -266,9 +301,9 @@ def evaluate_using_sbert(model, test_sents, test_labels, label_names, numeric_la
     subprocess.check_call(["pip", "install", "--quiet", "download", "spacy==3.0.5"])
     subprocess.check_call(["python", "-m", "spacy", "download", "es_core_news_lg"])
     es_nlp = spacy.load('es_core_news_lg')
-    proj_matrix = cp.asnumpy(calc_proj_matrix(
-        test_sents, 50, es_nlp, model, 0.01))
-    test_embs = encode_all_sents(test_sents, model, proj_matrix)
+    proj_matrix = calc_proj_matrix(
+        test_sents, 50, es_nlp, model, 0.01, cache_folder=proj_matrix_cache_folder, model_id=model_id)
+    test_embs = encode_all_sents(test_sents, model, proj_matrix, cache=embedding_cache)
     label_embs = encode_labels(label_names, model, proj_matrix)
 
     model_preds, model_scores = calc_all_cos_similarity(
@@ -287,16 +322,18 @@ def evaluate_using_sbert(model, test_sents, test_labels, label_names, numeric_la
     return evaluator.avg_f1.tolist()
 
 
-def evaluate_using_sklearn(clf, model, train_sents, train_labels, test_sents, test_labels, label_names):
+def evaluate_using_sklearn(clf, model, train_sents, train_labels, test_sents, test_labels, label_names,
+                           embedding_cache=None):
     """
     Evaluate an S-BERT model on a previously unseen test set, visualizing the embeddings, confusion matrix,
     and returning. Evaluation method:
      - A sklearn classifier, such as a RandomForest or SVM
+    With an EmbeddingCache of the model, the sentences are only encoded once across evaluations
     """
     # Sentence encoding
     print("Classifying sentences...")
-    train_embs = encode_all_sents(train_sents, model)
-    test_embs = encode_all_sents(test_sents, model)
+    train_embs = encode_all_sents(train_sents, model, cache=embedding_cache)
+    test_embs = encode_all_sents(test_sents, model, cache=embedding_cache)
 
     # Classifier training
     clf.fit(np.vstack(train_embs), train_labels)
@@ -0,0 +1,260 @@
+""" Sample usage:
+    -  Format
+        $ python onnx_encoder.py -m [path_to_saved_sbert_model] -o [output_folder] -i [path_to_txt_file]
+    -  Export a fine-tuned model, quantize it to int8 and check its cosine scores on 500 validation sentences
+        $ python onnx_encoder.py -m ../output/fine_tuned_model/ -o ../output/fine_tuned_model_onnx/ -i sentences.txt
+
+    Exports a saved S-BERT model (the transformer and its pooling, and normalization if any) to ONNX, and quantizes
+    its weights to int8 with dynamic quantization, for CPU inference with ONNX Runtime. The output folder contains:
+        - model.onnx and model_int8.onnx
+        - the tokenizer files
+        - encoder_config.json, with the maximum sequence length and whether the input is lower cased
+    ONNXSentenceEncoder loads it back with the same encode() interface as SentenceTransformer.
+"""
+import os
+import json
+import inspect
+import argparse
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional as F
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:
+    ort = None
+
+ONNX_FNAME = "model.onnx"
+QUANTIZED_ONNX_FNAME = "model_int8.onnx"
+ENCODER_CONFIG_FNAME = "encoder_config.json"
+# Pooling modes of sentence_transformers.models.Pooling that PooledTransformer implements, in concatenation order
+SUPPORTED_POOLING_MODES = ["cls_token", "max_tokens", "mean_tokens", "mean_sqrt_len_tokens"]
+
+
+def check_onnxruntime():
+    if ort is None:
+        raise ImportError("The ONNX encoder needs onnxruntime. Install it with: pip install onnxruntime onnx")
+
+
+class PooledTransformer(nn.Module):
+    """
+    The transformer of a SentenceTransformer followed by its pooling (and normalization), as a single module that
+    takes the input ids and attention mask and returns the sentence embeddings, so that it can be exported to ONNX
+    """
+
+    def __init__(self, auto_model, pooling, normalize=False):
+        super().__init__()
+        self.auto_model = auto_model
+        self.pooling_modes = [mode for mode in SUPPORTED_POOLING_MODES
+                              if getattr(pooling, f"pooling_mode_{mode}", False)]
+        self.normalize = normalize
+
+    def forward(self, input_ids, attention_mask):
+        token_embeddings = self.auto_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+        mask = attention_mask.unsqueeze(-1).to(token_embeddings.dtype)
+
+        # Same order as the concatenation of sentence_transformers.models.Pooling
+        outputs = []
+        for mode in self.pooling_modes:
+            if mode == "cls_token":
+                outputs.append(token_embeddings[:, 0])
+            elif mode == "max_tokens":
+                outputs.append(token_embeddings.masked_fill(mask == 0, -1e9).max(dim=1)[0])
+            else:
+                summed = (token_embeddings * mask).sum(dim=1)
+                counts = mask.sum(dim=1).clamp(min=1e-9)
+                outputs.append(summed / counts if mode == "mean_tokens" else summed / counts.sqrt())
+
+        embeddings = torch.cat(outputs, dim=1)
+        if self.normalize:
+            embeddings = F.normalize(embeddings, p=2, dim=1)
+
+        return embeddings
+
+
+def export_to_onnx(sbert_model, output_folder, quantize=True, opset_version=None):
+    """
+    Export a SentenceTransformer (a Transformer module, a Pooling module and optionally a Normalize module) to
+    output_folder, and quantize it to int8 if quantize is True. By default, the ONNX opset is the default one of the
+    installed torch version
+    """
+    check_onnxruntime()
+    modules = list(sbert_model)
+    module_names = [type(module).__name__ for module in modules]
+    if module_names[:2] != ["Transformer", "Pooling"] or module_names[2:] not in ([], ["Normalize"]):
+        raise ValueError(f"Only Transformer + Pooling (+ Normalize) models can be exported, got {module_names}")
+
+    # Newer versions of sentence-transformers add pooling modes (i.e. weightedmean_tokens or lasttoken), which would
+    # otherwise be silently left out of the exported embeddings
+    pooling_modes = [name[len("pooling_mode_"):] for name, enabled in vars(modules[1]).items()
+                     if name.startswith("pooling_mode_") and enabled]
+    unsupported_modes = [mode for mode in pooling_modes if mode not in SUPPORTED_POOLING_MODES]
+    if unsupported_modes or not pooling_modes:
+        raise ValueError(f"Pooling modes {unsupported_modes} can't be exported, only combinations of "
+                         f"{', '.join(SUPPORTED_POOLING_MODES)} are supported")
+
+    transformer = modules[0]
+    model = PooledTransformer(transformer.auto_model, modules[1], normalize=len(modules) == 3).cpu().eval()
+
+    os.makedirs(output_folder, exist_ok=True)
+    transformer.tokenizer.save_pretrained(output_folder)
+    with open(os.path.join(output_folder, ENCODER_CONFIG_FNAME), "w") as f:
+        json.dump({"max_seq_length": transformer.max_seq_length,
+                   "do_lower_case": getattr(transformer, "do_lower_case", False)}, f)
+
+    dummy_input = transformer.tokenizer(["A sample sentence to trace the model"], return_tensors="pt")
+    export_kwargs = {} if opset_version is None else {"opset_version": opset_version}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # Recent versions of torch default to the dynamo exporter, which does not support dynamic_axes
+        export_kwargs["dynamo"] = False
+
+    onnx_fpath = os.path.join(output_folder, ONNX_FNAME)
+    with torch.no_grad():
+        torch.onnx.export(model, (dummy_input["input_ids"], dummy_input["attention_mask"]), onnx_fpath,
+                          input_names=["input_ids", "attention_mask"],
+                          output_names=["sentence_embedding"],
+                          dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                        "attention_mask": {0: "batch", 1: "sequence"},
+                                        "sentence_embedding": {0: "batch"}},
+                          **export_kwargs)
+
+    if quantize:
+        quantize_dynamic(onnx_fpath, os.path.join(output_folder, QUANTIZED_ONNX_FNAME), weight_type=QuantType.QInt8)
+
+
+class ONNXSentenceEncoder:
+    """
+    Sentence encoder served by ONNX Runtime on CPU, from a folder written by export_to_onnx(). encode() can be used
+    wherever SentenceTransformer.encode() is, i.e. by encode_all_sents() or as the S-BERT model of the classifiers
+    """
+
+    def __init__(self, model_folder, quantized=True, n_threads=None):
+        check_onnxruntime()
+        with open(os.path.join(model_folder, ENCODER_CONFIG_FNAME), "r") as f:
+            config = json.load(f)
+        self.max_seq_length = config["max_seq_length"]
+        self.do_lower_case = config["do_lower_case"]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_folder)
+
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if n_threads is not None:
+            session_options.intra_op_num_threads = n_threads
+
+        model_fpath = os.path.join(model_folder, QUANTIZED_ONNX_FNAME if quantized else ONNX_FNAME)
+        self.session = ort.InferenceSession(model_fpath, session_options, providers=["CPUExecutionProvider"])
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True,
+               convert_to_tensor=False, normalize_embeddings=False, **kwargs):
+        """
+        Return the embeddings of the sentences as a (number of sentences x embedding dimension) float32 array, or a
+        single embedding if sentences is a string. Like SentenceTransformer.encode(), sentences are encoded in batches
+        sorted by length, and returned in the input order
+        """
+        single_sentence = isinstance(sentences, str)
+        sentences = [sentences] if single_sentence else list(sentences)
+        if self.do_lower_case:
+            sentences = [sentence.lower() for sentence in sentences]
+
+        length_order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        embeddings = [None] * len(sentences)
+        for start in tqdm(range(0, len(sentences), batch_size), disable=not show_progress_bar):
+            batch_idx = length_order[start:start + batch_size]
+            inputs = self.tokenizer([sentences[i] for i in batch_idx], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors="np")
+            batch_embeddings = self.session.run(None, {"input_ids": inputs["input_ids"].astype(np.int64),
+                                                       "attention_mask": inputs["attention_mask"].astype(np.int64)})[0]
+            for i, embedding in zip(batch_idx, batch_embeddings):
+                embeddings[i] = embedding
+
+        embeddings = np.vstack(embeddings).astype(np.float32) if embeddings else np.empty((0, 0), dtype=np.float32)
+        if normalize_embeddings:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+        if single_sentence:
+            embeddings = embeddings[0]
+
+        return torch.from_numpy(embeddings) if convert_to_tensor else embeddings
+
+
+def cosine_matrix(a, b):
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return a @ b.T
+
+
+def check_parity(reference_model, encoder, sentences, batch_size=32):
+    """
+    Compare the embeddings of an encoder with the ones of the reference (PyTorch) model. Return a dictionary with:
+        - min_cosine and mean_cosine: cosine similarity between the two embeddings of each sentence
+        - max_score_diff: maximum absolute difference between the sentence-sentence cosine scores of both models,
+          which is what the classifiers use
+        - top1_agreement: fraction of sentences whose most similar other sentence is the same with both models
+    """
+    reference_embs = reference_model.encode(sentences, batch_size=batch_size, convert_to_numpy=True)
+    encoder_embs = encoder.encode(sentences, batch_size=batch_size, convert_to_numpy=True)
+
+    self_cosines = np.sum(reference_embs * encoder_embs, axis=1) / np.maximum(
+        np.linalg.norm(reference_embs, axis=1) * np.linalg.norm(encoder_embs, axis=1), 1e-12)
+    reference_scores = cosine_matrix(reference_embs, reference_embs)
+    encoder_scores = cosine_matrix(encoder_embs, encoder_embs)
+    off_diagonal = ~np.eye(len(sentences), dtype=bool)
+    score_diffs = np.abs(reference_scores - encoder_scores)[off_diagonal]
+
+    # A sentence is always its own nearest neighbor, so it is excluded
+    np.fill_diagonal(reference_scores, -np.inf)
+    np.fill_diagonal(encoder_scores, -np.inf)
+
+    return {"min_cosine": float(self_cosines.min()),
+            "mean_cosine": float(self_cosines.mean()),
+            "max_score_diff": float(score_diffs.max(initial=0)),
+            "top1_agreement": float(np.mean(reference_scores.argmax(axis=1) == encoder_scores.argmax(axis=1)))}
+
+
+def load_sentences(input_path, max_sents):
+    """
+    Read the non-empty lines of a text file, up to max_sents of them
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        sentences = [line.strip() for line in f if line.strip()]
+
+    return sentences[:max_sents]
+
+
+def main(model_path, output_folder, input_path, max_sents, quantize):
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_path, device="cpu")
+    export_to_onnx(model, output_folder, quantize)
+    print(f"Exported {model_path} to {output_folder}")
+
+    if input_path is not None:
+        sentences = load_sentences(input_path, max_sents)
+        for quantized in ([False, True] if quantize else [False]):
+            parity = check_parity(model, ONNXSentenceEncoder(output_folder, quantized), sentences)
+            print(f"{'int8' if quantized else 'fp32'} parity on {len(sentences)} sentences: " +
+                  ", ".join(f"{name}: {value:.4f}" for name, value in parity.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-m', '--model_path', required=True,
+                        help="Folder of a saved SentenceTransformer model, or the name of a pretrained one")
+    parser.add_argument('-o', '--output_folder', required=True,
+                        help="Folder where the ONNX models and tokenizer are stored")
+    parser.add_argument('-i', '--input_path', default=None,
+                        help="Text file with one sentence per line, to check the parity of the exported models")
+    parser.add_argument('-n', '--max_sents', default=500,
+                        help="Number of sentences of the parity check")
+    parser.add_argument('--no_quantization', action="store_true",
+                        help="Only export the fp32 model")
+
+    args = parser.parse_args()
+
+    main(args.model_path, args.output_folder, args.input_path, int(args.max_sents), not args.no_quantization)
@@ -7,18 +7,27 @@ Original source code: https://github.com/UKPLab/sentence-transformers/blob/maste
 
 from typing import Iterable, Dict, Tuple, Type, Callable
 import os
+import random
+import inspect
+import numpy as np
 import transformers
-import wandb
 from sentence_transformers import SentenceTransformer
 
 from sentence_transformers.evaluation import LabelAccuracyEvaluator, SentenceEvaluator
 from torch import nn
 import torch
 from torch.optim import Optimizer
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm.autonotebook import trange
 from statistics import mean
 
+from tasks.fine_tuning_sbert.src.batch_sampler import LengthBucketBatchSampler
+from tasks.fine_tuning_sbert.src.custom_evaluator import batch_to_device
+from tasks.fine_tuning_sbert.src.experiment_logger import ExperimentLogger
+from tasks.fine_tuning_sbert.src.tokenized_dataset import TokenizedExample, collate_tokenized
+
+TRAINING_STATE_FNAME = "training_state.pt"
+
 
 class EarlyStoppingSentenceTransformer(SentenceTransformer):
 
@@ -41,6 +50,12 @@ class EarlyStoppingSentenceTransformer(SentenceTransformer):
             show_progress_bar: bool = True,
             baseline: float = 0.01,
             patience: int = 5,
+            train_acc_mode: str = 'running',
+            train_acc_samples: int = 1000,
+            checkpoint_path: str = None,
+            checkpoint_save_steps: int = 0,
+            resume_from: str = None,
+            logger: ExperimentLogger = None,
             ):
         """
         Train the model with the given training objective
@@ -67,15 +82,31 @@ class EarlyStoppingSentenceTransformer(SentenceTransformer):
         :param show_progress_bar: If True, output a tqdm progress bar
         :param baseline: minimum improvement in the accuracy for a new model to be saved and best_score to be updated
         :param patience: maximum number of epochs to go without an improvement in the accuracy
+        :param train_acc_mode: How the training accuracy of each epoch is computed:
+                'running': from the logits of the training steps of the epoch (no extra forward pass). Requires the
+                loss model of the first objective to store them as last_logits, like SoftmaxClassifier does,
+                otherwise 'subsample' is used
+                'subsample': evaluating the model on train_acc_samples random training samples at the end of the epoch
+                'full': evaluating the model on the whole training set at the end of the epoch
+        :param train_acc_samples: Number of training samples evaluated at the end of each epoch with 'subsample'
+        :param checkpoint_path: Folder where the full training state (model, optimizers, schedulers, AMP scaler,
+                early stopping state, data iterator positions and RNG states) is stored at the end of each epoch,
+                replacing the previous one atomically
+        :param checkpoint_save_steps: If > 0, the training state is also stored after each number of training steps
+        :param resume_from: Folder (or file) of a training state stored by a previous fit with the same arguments.
+                Training continues from it as if it had not been interrupted. Checkpoints keep being stored there
+                if checkpoint_path is None
+        :param logger: Experiment logger of the training and validation metrics (none by default). It is not closed
         """
+        if train_acc_mode not in ('running', 'subsample', 'full'):
+            raise ValueError(f"Unknown train_acc_mode: {train_acc_mode}. Options are: running, subsample, full")
+
         self.acc_list = [1e-6]  # stores the accuracy while training
         training_acc_list = []
 
-        t_evaluator = LabelAccuracyEvaluator(dataloader=train_objectives[0][0], softmax_model=train_objectives[0][1],
-                                             name='lae-training')
-
         self.baseline = baseline
         self.patience = patience
+        self.logger = logger if logger is not None else ExperimentLogger()
 
         if use_amp:
             from torch.cuda.amp import autocast
@@ -126,19 +157,80 @@ class EarlyStoppingSentenceTransformer(SentenceTransformer):
             schedulers.append(scheduler_obj)
 
         global_step = 0
-        data_iterators = [iter(dataloader) for dataloader in dataloaders]
+        start_epoch = 0
+        start_step = 0
+        n_train_correct = 0
+        n_train_seen = 0
+        skip_scheduler = False
+
+        # The torch RNG state before each data iterator was created and the number of batches taken from it since,
+        # so that a resumed training can create it again at the same position
+        iterator_rng_states = [None] * len(dataloaders)
+        n_batches_taken = [0] * len(dataloaders)
+        data_iterators = []
+        for train_idx, dataloader in enumerate(dataloaders):
+            iterator_rng_states[train_idx] = torch.get_rng_state()
+            data_iterators.append(iter(dataloader))
+
+        if resume_from is not None:
+            state = self._load_training_state(resume_from, loss_models, optimizers, schedulers,
+                                              scaler if use_amp else None)
+            if state['finished']:
+                print('Training had already finished.')
+                return
+
+            start_epoch = state['epoch']
+            start_step = state['training_steps']
+            global_step = state['global_step']
+            skip_scheduler = state['skip_scheduler']
+            n_train_correct = state['n_train_correct']
+            n_train_seen = state['n_train_seen']
+            training_acc_list = state['training_acc_list']
+            iterator_rng_states = state['iterator_rng_states']
+            n_batches_taken = state['n_batches_taken']
+
+            # Shuffling happens when a data iterator is created, so it is created again from the same RNG state
+            # and advanced past the batches that were already used
+            for train_idx, dataloader in enumerate(dataloaders):
+                torch.set_rng_state(iterator_rng_states[train_idx])
+                data_iterators[train_idx] = iter(dataloader)
+                for _ in range(n_batches_taken[train_idx]):
+                    next(data_iterators[train_idx])
+
+            self._set_rng_states(state['rng_states'])
+
+            if checkpoint_path is None:
+                checkpoint_path = resume_from if os.path.isdir(resume_from) else os.path.dirname(resume_from)
+
+        def save_training_state(epoch, training_steps, finished=False):
+            self._save_training_state(checkpoint_path, loss_models, optimizers, schedulers,
+                                      scaler if use_amp else None,
+                                      {'epoch': epoch,
+                                       'training_steps': training_steps,
+                                       'global_step': global_step,
+                                       'skip_scheduler': skip_scheduler,
+                                       'n_train_correct': int(n_train_correct),
+                                       'n_train_seen': n_train_seen,
+                                       'training_acc_list': training_acc_list,
+                                       'iterator_rng_states': iterator_rng_states,
+                                       'n_batches_taken': n_batches_taken,
+                                       'finished': finished})
 
         num_train_objectives = len(train_objectives)
 
-        skip_scheduler = False
-        for epoch in trange(epochs, desc="Epoch", disable=not show_progress_bar):
-            training_steps = 0
+        for epoch in trange(start_epoch, epochs, desc="Epoch", disable=not show_progress_bar):
+            # A resumed epoch continues from the step (and running training accuracy) of the checkpoint
+            training_steps = start_step if epoch == start_epoch else 0
+            if training_steps == 0:
+                n_train_correct = 0
+                n_train_seen = 0
 
             for loss_model in loss_models:
                 loss_model.zero_grad()
                 loss_model.train()
 
-            for _ in trange(steps_per_epoch, desc="Iteration", smoothing=0.05, disable=not show_progress_bar):
+            for _ in trange(training_steps, steps_per_epoch, desc="Iteration", smoothing=0.05,
+                            disable=not show_progress_bar):
                 for train_idx in range(num_train_objectives):
                     loss_model = loss_models[train_idx]
                     optimizer = optimizers[train_idx]
@@ -148,9 +240,12 @@ class EarlyStoppingSentenceTransformer(SentenceTransformer):
                     try:
                         data = next(data_iterator)
                     except StopIteration:
+                        iterator_rng_states[train_idx] = torch.get_rng_state()
+                        n_batches_taken[train_idx] = 0
                         data_iterator = iter(dataloaders[train_idx])
                         data_iterators[train_idx] = data_iterator
                         data = next(data_iterator)
+                    n_batches_taken[train_idx] += 1
 
                     features, labels = data
 
@@ -179,6 +274,12 @@ class EarlyStoppingSentenceTransformer(SentenceTransformer):
                     if not skip_scheduler:
                         scheduler.step()
 
+                    logits = getattr(loss_model, 'last_logits', None)
+                    if train_acc_mode == 'running' and train_idx == 0 and logits is not None:
+                        # Kept as a tensor, so that there is no device synchronization at every step
+                        n_train_correct += (logits.argmax(dim=1) == labels.view(-1)).sum()
+                        n_train_seen += labels.numel()
+
                 training_steps += 1
                 global_step += 1
 
@@ -187,13 +288,21 @@ class EarlyStoppingSentenceTransformer(SentenceTransformer):
                         loss_model.zero_grad()
                         loss_model.train()
 
+                if checkpoint_path is not None and checkpoint_save_steps > 0 and \
+                        global_step % checkpoint_save_steps == 0:
+                    save_training_state(epoch, training_steps)
+
             # training evaluation
-            training_acc_evaluated = t_evaluator(
-                self, output_path=output_path, epoch=epoch, steps=-1)
+            if train_acc_mode == 'running' and n_train_seen > 0:
+                training_acc_evaluated = float(n_train_correct) / n_train_seen
+            else:
+                training_acc_evaluated = self._evaluate_training_accuracy(
+                    train_objectives[0], None if train_acc_mode == 'full' else train_acc_samples,
+                    output_path, epoch)
             training_acc_list.append(training_acc_evaluated)
 
-            wandb.log({"train_acc": training_acc_evaluated,
-                      "epoch": epoch})
+            self.logger.log({"train_acc": training_acc_evaluated,
+                             "epoch": epoch})
 
             # validation evaluation
             flag = self._eval_during_training(evaluator, output_path, epoch, -1)
@@ -207,12 +316,134 @@ class EarlyStoppingSentenceTransformer(SentenceTransformer):
                 print(f'Epoch: {epoch}')
                 print(f"Best score: {self.best_score}")
                 print('=' * 60)
+                if checkpoint_path is not None:
+                    save_training_state(epoch + 1, 0, finished=True)
                 return
 
             # removing the unnecessary first element in ACC_LIST that needed to be there for epoch 1
             if epoch == 0:
                 del self.acc_list[0]
 
+            if checkpoint_path is not None:
+                save_training_state(epoch + 1, 0)
+
+    def smart_batching_collate(self, batch):
+        """
+        Batches of a TokenizedDataset are already tokenized, the rest are tokenized by SentenceTransformer.
+        Like the ones of SentenceTransformer, they are moved to the device of the model, as fit() uses them as they are
+        """
+        if batch and isinstance(batch[0], TokenizedExample):
+            return batch_to_device(collate_tokenized(batch), self._target_device)
+
+        return super().smart_batching_collate(batch)
+
+    @staticmethod
+    def _get_rng_states():
+        rng_states = {'python': random.getstate(),
+                      'numpy': np.random.get_state(),
+                      'torch': torch.get_rng_state()}
+        if torch.cuda.is_available():
+            rng_states['cuda'] = torch.cuda.get_rng_state_all()
+
+        return rng_states
+
+    @staticmethod
+    def _set_rng_states(rng_states):
+        random.setstate(rng_states['python'])
+        np.random.set_state(rng_states['numpy'])
+        torch.set_rng_state(rng_states['torch'])
+        if 'cuda' in rng_states and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng_states['cuda'])
+
+    def _shared_state_keys(self, loss_model):
+        """
+        Keys of the state of a loss model whose tensors are the ones of this model (i.e. SoftmaxClassifier.model)
+        """
+        model_tensors = {tensor.data_ptr() for tensor in self.state_dict().values()}
+        return {name for name, tensor in loss_model.state_dict().items() if tensor.data_ptr() in model_tensors}
+
+    def _loss_model_state_dict(self, loss_model):
+        """
+        State of a loss model without the tensors of this model, which are stored only once
+        """
+        shared_keys = self._shared_state_keys(loss_model)
+        return {name: tensor for name, tensor in loss_model.state_dict().items() if name not in shared_keys}
+
+    def _save_training_state(self, checkpoint_path, loss_models, optimizers, schedulers, scaler, state):
+        """
+        Store the full training state in checkpoint_path. It is written to a temporary file first, so an interrupted
+        save never leaves a partial checkpoint behind
+        """
+        os.makedirs(checkpoint_path, exist_ok=True)
+        state = dict(state,
+                     model=self.state_dict(),
+                     loss_models=[self._loss_model_state_dict(loss_model) for loss_model in loss_models],
+                     optimizers=[optimizer.state_dict() for optimizer in optimizers],
+                     schedulers=[scheduler.state_dict() for scheduler in schedulers],
+                     scaler=scaler.state_dict() if scaler is not None else None,
+                     acc_list=self.acc_list,
+                     best_score=self.best_score,
+                     rng_states=self._get_rng_states())
+
+        fpath = os.path.join(checkpoint_path, TRAINING_STATE_FNAME)
+        tmp_fpath = f"{fpath}.{os.getpid()}.tmp"
+        torch.save(state, tmp_fpath)
+        os.replace(tmp_fpath, fpath)
+
+    def _load_training_state(self, resume_from, loss_models, optimizers, schedulers, scaler):
+        """
+        Restore the model, loss models, optimizers, schedulers, AMP scaler and early stopping state stored by
+        _save_training_state(), and return the rest of the state
+        """
+        fpath = os.path.join(resume_from, TRAINING_STATE_FNAME) if os.path.isdir(resume_from) else resume_from
+        load_kwargs = {'map_location': 'cpu'}
+        if 'weights_only' in inspect.signature(torch.load).parameters:
+            # The RNG states are not just tensors
+            load_kwargs['weights_only'] = False
+        state = torch.load(fpath, **load_kwargs)
+
+        if len(state['loss_models']) != len(loss_models):
+            raise ValueError(f"The training state has {len(state['loss_models'])} training objectives, "
+                             f"got {len(loss_models)}")
+
+        self.load_state_dict(state['model'])
+        for loss_model, loss_model_state in zip(loss_models, state['loss_models']):
+            # Only the tensors of this model, restored above, are expected to be missing
+            incompatible_keys = loss_model.load_state_dict(loss_model_state, strict=False)
+            unexpected_missing_keys = set(incompatible_keys.missing_keys) - self._shared_state_keys(loss_model)
+            if unexpected_missing_keys or incompatible_keys.unexpected_keys:
+                raise ValueError(f"The training state does not match the loss model {type(loss_model).__name__}: "
+                                 f"missing keys {sorted(unexpected_missing_keys)}, "
+                                 f"unexpected keys {sorted(incompatible_keys.unexpected_keys)}")
+        for optimizer, optimizer_state in zip(optimizers, state['optimizers']):
+            optimizer.load_state_dict(optimizer_state)
+        for scheduler, scheduler_state in zip(schedulers, state['schedulers']):
+            scheduler.load_state_dict(scheduler_state)
+        if scaler is not None and state['scaler'] is not None:
+            scaler.load_state_dict(state['scaler'])
+
+        self.acc_list = state['acc_list']
+        self.best_score = state['best_score']
+
+        return state
+
+    def _evaluate_training_accuracy(self, train_objective, n_samples, output_path, epoch):
+        """
+        Accuracy of the loss model of a training objective on n_samples random samples of its training set,
+        or on all of them if n_samples is None
+        """
+        dataloader, loss_model = train_objective
+        if n_samples is not None and n_samples < len(dataloader.dataset):
+            indices = random.sample(range(len(dataloader.dataset)), n_samples)
+            subset = Subset(dataloader.dataset, indices)
+            if isinstance(dataloader.batch_sampler, LengthBucketBatchSampler):
+                dataloader = DataLoader(subset, batch_sampler=dataloader.batch_sampler.subset(indices))
+            else:
+                dataloader = DataLoader(subset, batch_size=dataloader.batch_size, shuffle=False)
+
+        t_evaluator = LabelAccuracyEvaluator(dataloader=dataloader, softmax_model=loss_model, name='lae-training')
+        return t_evaluator(self, output_path=output_path, epoch=epoch, steps=-1)
+
     def _eval_during_training(self, evaluator, output_path, epoch, steps):
         """Runs evaluation during the training"""
 
@@ -221,10 +452,10 @@ class EarlyStoppingSentenceTransformer(SentenceTransformer):
         score = score_dict["accuracy"]
         self.acc_list.append(score)
 
-        wandb.log({"validation_acc": score, "epoch": epoch})
-        wandb.log(
+        self.logger.log({"validation_acc": score, "epoch": epoch})
+        self.logger.log(
             {"Macro F1 validation": score_dict['macro_f1'], "epoch": epoch})
-        wandb.log(
+        self.logger.log(
             {"Weighted F1 validation": score_dict['weighted_f1'], "epoch": epoch})
 
         prev_score = self.acc_list[-2]
@@ -0,0 +1,160 @@
+"""
+Pre-tokenized training sentences, so that hyperparameter searches over the same sentences tokenize them only once
+instead of in every batch of every epoch of every run.
+
+The sentences are tokenized once per (tokenizer, max_seq_length, sentences) in their own folder of the cache folder:
+    - input_ids.bin: memory-mapped int32 token ids of all the sentences (with the special tokens), one after the other
+    - offsets.npy: (number of sentences + 1) int64, sentence i is input_ids[offsets[i]:offsets[i + 1]]
+    - meta.json: the tokenizer, max_seq_length, padding id and number of sentences, written last
+Train and dev splits are TokenizedDatasets over rows of the same TokenizedCorpus, so any split of the sentences (i.e.
+any dev percentage) uses the same cache. Their batches are padded directly from the memory map by collate_tokenized(),
+which EarlyStoppingSentenceTransformer.smart_batching_collate() calls, so they work with fit() and the evaluators.
+"""
+import os
+import json
+from collections import namedtuple
+from hashlib import sha1
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+# An item of a TokenizedDataset, the collate function reads the token ids of the row from the corpus
+TokenizedExample = namedtuple("TokenizedExample", ["corpus", "row", "label"])
+
+
+def tokenizer_key(sbert_model):
+    """
+    Everything that changes the token ids of a sentence
+    """
+    transformer = sbert_model._first_module()
+    tokenizer = transformer.tokenizer
+    return {"tokenizer": tokenizer.name_or_path,
+            "tokenizer_class": type(tokenizer).__name__,
+            "vocab_size": len(tokenizer),
+            "max_seq_length": sbert_model.get_max_seq_length(),
+            "do_lower_case": bool(getattr(transformer, "do_lower_case", False))}
+
+
+def texts_hash(texts):
+    text_hash = sha1()
+    for text in texts:
+        text_hash.update(text.encode("utf-8") + b"\0")
+
+    return text_hash.hexdigest()
+
+
+class TokenizedCorpus:
+    def __init__(self, folder):
+        """
+        Open a corpus written by TokenizedCorpus.build()
+        """
+        self.folder = folder
+        with open(os.path.join(folder, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+
+        self.offsets = np.load(os.path.join(folder, "offsets.npy"))
+        n_tokens = int(self.offsets[-1])
+        # An empty file cannot be memory-mapped
+        self.input_ids = np.memmap(os.path.join(folder, "input_ids.bin"), dtype=np.int32, mode="r",
+                                   shape=(n_tokens,)) if n_tokens else np.zeros(0, dtype=np.int32)
+        self.lengths = np.diff(self.offsets)
+        self.pad_token_id = self.meta["pad_token_id"]
+        self.token_type_ids = self.meta["token_type_ids"]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, texts, sbert_model, cache_folder, batch_size=1000):
+        """
+        Tokenize the texts with the tokenizer of the model, or open their cached token ids if they were already
+        tokenized the same way
+        """
+        texts = list(texts)
+        key = tokenizer_key(sbert_model)
+        key["texts"] = texts_hash(texts)
+        folder = os.path.join(cache_folder, sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16])
+        if os.path.exists(os.path.join(folder, "meta.json")):
+            return cls(folder)
+
+        os.makedirs(folder, exist_ok=True)
+        tokenizer = sbert_model._first_module().tokenizer
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+
+        # Every file is written to a temporary file first, and meta.json is written last, so a partially written
+        # corpus is never opened
+        ids_fpath = os.path.join(folder, "input_ids.bin")
+        tmp_ids_fpath = f"{ids_fpath}.{os.getpid()}.tmp"
+        with open(tmp_ids_fpath, "wb") as f:
+            for start in range(0, len(texts), batch_size):
+                batch = texts[start:start + batch_size]
+                if key["do_lower_case"]:
+                    batch = [text.lower() for text in batch]
+
+                encoded = tokenizer(batch, truncation=True, max_length=key["max_seq_length"])["input_ids"]
+                for i, input_ids in enumerate(encoded, start + 1):
+                    offsets[i] = offsets[i - 1] + len(input_ids)
+                if encoded:
+                    f.write(np.concatenate(encoded).astype(np.int32).tobytes())
+        os.replace(tmp_ids_fpath, ids_fpath)
+
+        offsets_fpath = os.path.join(folder, "offsets.npy")
+        tmp_offsets_fpath = f"{offsets_fpath}.{os.getpid()}.tmp.npy"
+        np.save(tmp_offsets_fpath, offsets)
+        os.replace(tmp_offsets_fpath, offsets_fpath)
+
+        meta = dict(key, n_sents=len(texts), pad_token_id=tokenizer.pad_token_id,
+                    token_type_ids="token_type_ids" in tokenizer.model_input_names)
+        meta_fpath = os.path.join(folder, "meta.json")
+        tmp_meta_fpath = f"{meta_fpath}.{os.getpid()}.tmp"
+        with open(tmp_meta_fpath, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta_fpath, meta_fpath)
+
+        return cls(folder)
+
+    def dataset(self, rows, labels):
+        """
+        Dataset of the given rows of the corpus (i.e. a train or dev split), with their integer labels
+        """
+        return TokenizedDataset(self, rows, labels)
+
+
+class TokenizedDataset(Dataset):
+    def __init__(self, corpus, rows, labels):
+        self.corpus = corpus
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        # Token lengths of the sentences, i.e. for LengthBucketBatchSampler
+        self.lengths = corpus.lengths[self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        return TokenizedExample(self.corpus, self.rows[idx], self.labels[idx])
+
+
+def collate_tokenized(batch):
+    """
+    Pad the token ids of a batch of TokenizedExamples straight from the memory map of their corpus, and return the
+    features and labels in the format of SentenceTransformer.smart_batching_collate()
+    """
+    corpus = batch[0].corpus
+    rows = np.fromiter((example.row for example in batch), dtype=np.int64, count=len(batch))
+    lengths = corpus.lengths[rows]
+
+    input_ids = np.full((len(batch), lengths.max()), corpus.pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros_like(input_ids)
+    for i, (row, length) in enumerate(zip(rows, lengths)):
+        input_ids[i, :length] = corpus.input_ids[corpus.offsets[row]:corpus.offsets[row + 1]]
+        attention_mask[i, :length] = 1
+
+    # torch.from_numpy shares the memory of the arrays
+    features = {"input_ids": torch.from_numpy(input_ids), "attention_mask": torch.from_numpy(attention_mask)}
+    if corpus.token_type_ids:
+        features["token_type_ids"] = torch.zeros_like(features["input_ids"])
+
+    labels = torch.from_numpy(np.fromiter((example.label for example in batch), dtype=np.int64, count=len(batch)))
+    return [features], labels
@@ -0,0 +1,75 @@
+import pytest
+import torch
+import transformers
+from torch import nn
+from sentence_transformers import SentenceTransformer, models
+
+pytest.importorskip("onnxruntime")
+
+from tasks.fine_tuning_sbert.src.onnx_encoder import ONNXSentenceEncoder, check_parity, export_to_onnx
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", ",", "the", "a", "of", "for", "will", "receive", "money",
+         "farmers", "planting", "trees", "forest", "water", "tax", "credit", "fine", "payment", "direct", "program",
+         "land", "owners", "protect", "rivers", "government", "pays", "each", "hectare", "year", "loans", "low",
+         "interest", "small", "businesses", "pollution", "is", "charged", "on"]
+SENTENCES = ["farmers will receive money for planting trees.", "the government pays a tax credit.",
+             "land owners protect the forest.", "a fine is charged for water pollution.",
+             "small businesses will receive low interest loans.", "each hectare of forest, each year.",
+             "direct payment for land owners.", "the program will protect rivers and water.",
+             "farmers receive a direct payment each year.", "a tax on pollution of rivers.",
+             "loans for planting trees on small land.", "the government will fine businesses."]
+
+
+class Transformer(nn.Module):
+    """
+    Stand-in for the Transformer module, the pooling modes are checked before it is used
+    """
+
+
+@pytest.fixture(scope="module")
+def tiny_sbert_model(tmp_path_factory):
+    """
+    SentenceTransformer with a tiny, randomly initialized BERT and mean pooling
+    """
+    model_folder = tmp_path_factory.mktemp("tiny_bert")
+    vocab_fpath = model_folder / "vocab.txt"
+    vocab_fpath.write_text("\n".join(VOCAB) + "\n")
+    transformers.BertTokenizerFast(str(vocab_fpath)).save_pretrained(model_folder)
+
+    torch.manual_seed(0)
+    config = transformers.BertConfig(vocab_size=len(VOCAB), hidden_size=64, num_hidden_layers=2,
+                                     num_attention_heads=2, intermediate_size=128)
+    transformers.BertModel(config).save_pretrained(model_folder)
+
+    transformer = models.Transformer(str(model_folder), max_seq_length=32)
+    pooling = models.Pooling(transformer.get_word_embedding_dimension(), pooling_mode_mean_tokens=True)
+    return SentenceTransformer(modules=[transformer, pooling], device="cpu")
+
+
+@pytest.fixture(scope="module")
+def onnx_folder(tiny_sbert_model, tmp_path_factory):
+    onnx_folder = tmp_path_factory.mktemp("tiny_bert_onnx")
+    export_to_onnx(tiny_sbert_model, str(onnx_folder))
+    return str(onnx_folder)
+
+
+@pytest.mark.parametrize("quantized, min_cosine, max_score_diff", [(False, 0.9999, 1e-4), (True, 0.99, 0.05)])
+def test_onnx_encoder_matches_the_pytorch_model(tiny_sbert_model, onnx_folder, quantized, min_cosine,
+                                                 max_score_diff):
+    encoder = ONNXSentenceEncoder(onnx_folder, quantized=quantized, n_threads=1)
+    parity = check_parity(tiny_sbert_model, encoder, SENTENCES, batch_size=4)
+
+    assert parity["min_cosine"] >= min_cosine
+    assert parity["max_score_diff"] <= max_score_diff
+    assert parity["top1_agreement"] == 1.0
+
+
+@pytest.mark.parametrize("pooling_mode", ["weightedmean", "lasttoken"])
+def test_export_rejects_unsupported_pooling_modes(tmp_path, pooling_mode):
+    pooling = models.Pooling(4, pooling_mode=pooling_mode)
+    if not any(name.startswith("pooling_mode_") and enabled for name, enabled in vars(pooling).items()):
+        pytest.skip(f"This version of sentence-transformers has no {pooling_mode} pooling")
+
+    with pytest.raises(ValueError, match=pooling_mode):
+        export_to_onnx([Transformer(), pooling], str(tmp_path))
+    assert not list(tmp_path.iterdir())
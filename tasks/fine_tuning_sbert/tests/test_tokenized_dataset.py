@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from tasks.fine_tuning_sbert.src.sentence_transformer import EarlyStoppingSentenceTransformer
+from tasks.fine_tuning_sbert.src.tokenized_dataset import TokenizedExample
+
+
+def small_corpus():
+    """
+    The attributes of a TokenizedCorpus that collate_tokenized() reads, for three sentences of 3, 5 and 2 tokens
+    """
+    offsets = np.array([0, 3, 8, 10])
+    return SimpleNamespace(input_ids=np.arange(1, 11, dtype=np.int32), offsets=offsets, lengths=np.diff(offsets),
+                           pad_token_id=0, token_type_ids=True)
+
+
+def collate_on(device):
+    corpus = small_corpus()
+    batch = [TokenizedExample(corpus, row, label) for row, label in [(0, 1), (1, 0), (2, 3)]]
+    model = SimpleNamespace(_target_device=torch.device(device))
+    return EarlyStoppingSentenceTransformer.smart_batching_collate(model, batch)
+
+
+def test_collate_tokenized_pads_from_the_corpus():
+    features, labels = collate_on("cpu")
+
+    assert features[0]["input_ids"].tolist() == [[1, 2, 3, 0, 0], [4, 5, 6, 7, 8], [9, 10, 0, 0, 0]]
+    assert features[0]["attention_mask"].tolist() == [[1, 1, 1, 0, 0], [1, 1, 1, 1, 1], [1, 1, 0, 0, 0]]
+    assert features[0]["token_type_ids"].tolist() == [[0] * 5] * 3
+    assert labels.tolist() == [1, 0, 3]
+
+
+@pytest.mark.parametrize("device", ["meta", pytest.param("cuda", marks=pytest.mark.skipif(
+    not torch.cuda.is_available(), reason="No GPU"))])
+def test_collate_tokenized_moves_the_batch_to_the_model_device(device):
+    features, labels = collate_on(device)
+
+    assert labels.device.type == device
+    assert all(tensor.device.type == device for tensor in features[0].values())
@@ -0,0 +1,53 @@
+import pytest
+import torch
+from torch import nn
+from sentence_transformers import models
+
+from tasks.fine_tuning_sbert.src.sentence_transformer import EarlyStoppingSentenceTransformer
+
+
+class LossModel(nn.Module):
+    """
+    Loss model sharing the tensors of the S-BERT model, like SoftmaxClassifier
+    """
+
+    def __init__(self, model, head_name="classifier"):
+        super().__init__()
+        self.model = model
+        setattr(self, head_name, nn.Linear(4, 2))
+
+
+def small_model():
+    model = EarlyStoppingSentenceTransformer(modules=[models.Dense(4, 4)], device="cpu")
+    model.acc_list = [0.5]
+    model.best_score = 0.5
+    return model
+
+
+def save_training_state(tmp_path):
+    torch.manual_seed(0)
+    model = small_model()
+    loss_model = LossModel(model)
+    model._save_training_state(str(tmp_path), [loss_model], [], [], None, {})
+    return model, loss_model
+
+
+def test_training_state_restores_the_loss_model(tmp_path):
+    saved_model, saved_loss_model = save_training_state(tmp_path)
+
+    torch.manual_seed(1)
+    model = small_model()
+    loss_model = LossModel(model)
+    model._load_training_state(str(tmp_path), [loss_model], [], [], None)
+
+    for name, tensor in saved_loss_model.state_dict().items():
+        assert torch.equal(loss_model.state_dict()[name], tensor)
+    assert model.acc_list == saved_model.acc_list
+
+
+def test_training_state_of_another_loss_model_is_rejected(tmp_path):
+    save_training_state(tmp_path)
+
+    model = small_model()
+    with pytest.raises(ValueError, match="missing keys.*head.weight.*unexpected keys.*classifier.weight"):
+        model._load_training_state(str(tmp_path), [LossModel(model, head_name="head")], [], [], None)
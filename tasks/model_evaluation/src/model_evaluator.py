@@ -7,7 +7,10 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import itertools
 from itertools import cycle
-import wandb
+try:
+    import wandb
+except ImportError:
+    wandb = None
 
 import sys
 
@@ -189,7 +192,8 @@ class ModelEvaluator:
 
         fig = plt.gcf()
         fig.set_size_inches(15, 10)  # enlarging CM
-        wandb.log({"Test set CM": wandb.Image(fig)})
+        if wandb is not None and wandb.run is not None:  # only logged within a wandb run
+            wandb.log({"Test set CM": wandb.Image(fig)})
         plt.close()
 
     def plot_precision_recall_curve(self, y_true, y_pred, bin_class=False, all_classes=False,
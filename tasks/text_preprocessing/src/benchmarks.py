@@ -0,0 +1,174 @@
+""" Sample usage:
+    -  Format
+        $ python benchmarks.py -i [path_to_folder_with_txt_files ...] -r [any integer]
+    -  Benchmark on a folder of official gazette dumps, best of 3 runs per file
+        $ python benchmarks.py -i /Users/some_user/gazettes/ -r 3
+    -  Benchmark on English and Spanish sample documents, one report per folder
+        $ python benchmarks.py -i /Users/some_user/english_docs/ /Users/some_user/spanish_docs/
+
+    Prints the throughput in MB/s of each preprocessing step, before (legacy implementation) and after.
+    Both implementations must return the same output, except for the expected divergences of the emails and acronyms
+    parsing (see EXPECTED_DIVERGENCES), which are counted per step.
+"""
+import re
+import time
+import argparse
+from difflib import SequenceMatcher
+from os.path import join
+
+from tasks.data_loading.src.utils import list_files_from_dir
+from tasks.text_preprocessing.src.sentence_splitting import normalize_periods
+from tasks.text_preprocessing.src.utils import *
+
+# (text, legacy output, new output) of the cases where TextCleaner.parse_emails_and_acronyms() is expected to differ
+# from parse_emails() + parse_acronyms(). The legacy functions call str.replace() over the whole text for every email
+# and acronym found, so one that is contained in another is also replaced inside it, and only the matched spans are
+# rewritten now
+EXPECTED_DIVERGENCES = [
+    # "U.S." is replaced inside "U.S.C." first, which is then not found anymore and keeps its last period
+    ("U.S. and U.S.C.", "US and USC.", "US and USC"),
+    # "A.B." is replaced inside "XA.B.", which is not an acronym
+    ("A.B. and XA.B.", "AB and XAB", "AB and XA.B."),
+    # The email "un@un.org " is replaced inside "j.un@un.org ", which is then not found anymore and keeps its first
+    # period
+    ("Write to un@un.org or j.un@un.org now", "Write to un@unorg or j.un@unorg now",
+     "Write to un@unorg or jun@unorg now"),
+]
+
+
+def legacy_normalize_periods(txt: str) -> str:
+    """
+    Period filtering as it was done in preprocess_text, building the new text one character at a time.
+    Only kept here as the baseline of the benchmark.
+    """
+    new_txt = ""
+    all_period_idx = set([indices.start() for indices in re.finditer(r"\.", txt)])
+
+    for i, char in enumerate(txt):
+        if i in all_period_idx:
+            if i + 1 < len(txt) and txt[i + 1] != " ":
+                continue
+
+            if i + 2 < len(txt) and txt[i + 2].isnumeric():
+                continue
+
+        new_txt += char
+
+    return new_txt
+
+
+def legacy_clean(txt: str) -> str:
+    """
+    Cleaning steps of preprocess_text, done with the standalone functions of text_preprocessing.utils
+    """
+    txt = replace_links(remove_html_tags(txt)).strip()
+    txt = remove_multiple_spaces(txt)
+    return parse_acronyms(parse_emails(txt))
+
+
+def check_expected_divergences(cleaner):
+    """
+    Check that the listed divergences are still the output of both implementations
+    """
+    for txt, legacy_output, new_output in EXPECTED_DIVERGENCES:
+        assert parse_acronyms(parse_emails(txt)) == legacy_output, f"Legacy output changed for {txt!r}"
+        assert legacy_clean(txt) == legacy_output, f"Legacy output changed for {txt!r}"
+        assert cleaner.parse_emails_and_acronyms(txt) == new_output, f"New output changed for {txt!r}"
+        assert cleaner.clean(txt) == new_output, f"New output changed for {txt!r}"
+
+
+def only_periods_differ(baseline_output: str, new_output: str) -> bool:
+    """
+    Whether the outputs only differ by periods added or removed, which is the case of all the EXPECTED_DIVERGENCES
+    """
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, baseline_output, new_output, autojunk=False).get_opcodes():
+        if tag != "equal" and set(baseline_output[i1:i2] + new_output[j1:j2]) != {"."}:
+            return False
+
+    return True
+
+
+def load_corpus(input_path):
+    """
+    Read all the .txt files in the given folder
+    """
+    corpus = []
+    for fname in sorted(list_files_from_dir(input_path)):
+        if fname.endswith(".txt"):
+            with open(join(input_path, fname), "r", encoding="utf-8") as f:
+                corpus.append(f.read())
+
+    return corpus
+
+
+def time_function(fn, corpus, n_repeats):
+    """
+    Return the best total time (in seconds) out of n_repeats runs of fn over all the texts in the corpus
+    """
+    best_time = float("inf")
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        for txt in corpus:
+            fn(txt)
+        best_time = min(best_time, time.perf_counter() - start)
+
+    return best_time
+
+
+def compare(name, baseline_fn, new_fn, corpus, n_repeats, expected_divergence=None):
+    """
+    Check that both functions return the same output on the corpus, then print their throughput.
+    With expected_divergence, the outputs may also differ where expected_divergence(baseline output, new output) is True
+    """
+    n_divergent = 0
+    for txt in corpus:
+        baseline_output, new_output = baseline_fn(txt), new_fn(txt)
+        if baseline_output == new_output:
+            continue
+
+        if expected_divergence is None or not expected_divergence(baseline_output, new_output):
+            raise AssertionError(f"{name}: the new implementation does not match the baseline output")
+        n_divergent += 1
+
+    corpus_mb = sum(len(txt.encode("utf-8")) for txt in corpus) / 1e6
+    baseline_time = time_function(baseline_fn, corpus, n_repeats)
+    new_time = time_function(new_fn, corpus, n_repeats)
+
+    print(f"{name} ({corpus_mb:.2f} MB)")
+    print(f"    Before: {corpus_mb / baseline_time:.2f} MB/s")
+    print(f"    After:  {corpus_mb / new_time:.2f} MB/s")
+    print(f"    Speed up: {baseline_time / new_time:.1f}x")
+    if expected_divergence is not None:
+        print(f"    Expected divergences: {n_divergent}/{len(corpus)} documents")
+
+
+def main(input_paths, n_repeats):
+    cleaner = TextCleaner()
+    check_expected_divergences(cleaner)
+
+    for input_path in input_paths:
+        corpus = load_corpus(input_path)
+        print("=============================================================")
+        print(f"Loaded {len(corpus)} text files from {input_path}")
+        print("=============================================================")
+
+        compare("Period normalization", legacy_normalize_periods, normalize_periods, corpus, n_repeats)
+        compare("HTML tags removal", remove_html_tags, cleaner.remove_html_tags, corpus, n_repeats)
+        compare("Links replacement", replace_links, cleaner.replace_links, corpus, n_repeats)
+        compare("Multiple spaces removal", remove_multiple_spaces, cleaner.remove_multiple_spaces, corpus, n_repeats)
+        compare("Emails and acronyms parsing", lambda txt: parse_acronyms(parse_emails(txt)),
+                cleaner.parse_emails_and_acronyms, corpus, n_repeats, only_periods_differ)
+        compare("Full cleaning", legacy_clean, cleaner.clean, corpus, n_repeats, only_periods_differ)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-i', '--input_paths', required=True, nargs='+',
+                        help="Folders with the .txt files to benchmark on, i.e. one for English and one for Spanish")
+    parser.add_argument('-r', '--repeats', default=3,
+                        help="Number of runs per benchmark, the best one is reported")
+
+    args = parser.parse_args()
+
+    main(args.input_paths, int(args.repeats))
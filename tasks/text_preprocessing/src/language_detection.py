@@ -0,0 +1,107 @@
+"""
+Fast language detection of the documents, to send each one to the right preprocessing and sentence splitting path.
+
+Character trigram profiles are compared with the "out-of-place" rank distance of:
+    Cavnar, W. B. and Trenkle, J. M. (1994), N-Gram-Based Text Categorization
+Only the first few KB of a document are used, which is enough to tell English and Spanish policy documents apart.
+
+The profiles below are the 200 most common trigrams of the English (USA) and Spanish (Chile, El Salvador) sample
+documents of this task, built with build_language_profile(). More languages can be added the same way.
+"""
+import re
+from collections import Counter
+from typing import Dict, List
+
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+PROFILE_SIZE = 200
+DETECTION_PREFIX_LENGTH = 4096
+
+LANGUAGE_PROFILES = {
+    "english": [
+        " th", "the", "he ", "ion", "tio", "es ", "ent", "on ", "ed ", " an", "and", " re", " in", "er ", "nd ",
+        "ing", " of", "ng ", "of ", "al ", " pr", " se", "ati", " co", "or ", "ons", "to ", " to", "for", "men",
+        "pro", "le ", " fo", "ce ", "nt ", "act", "ter", "at ", "cti", "ate", "ts ", "ns ", "in ", "is ", "der",
+        "ect", " ac", " wi", "ule", " ru", "rul", "ies", "tat", "ry ", "con", "nce", " ma", " st", "ot ", "enc",
+        "ten", " a ", " or", "nte", "sta", "ct ", "reg", "ve ", " be", " sp", " no", "com", "tri", "age", "res",
+        "ice", " de", "re ", "se ", "iti", "te ", "ly ", "art", "lat", "tha", " tr", "th ", "as ", "hat", "spe",
+        "st ", "eme", "ist", " en", "cie", "pec", " ha", "tiv", "ral", "ser", "erv", " da", " is", " ex", "rea",
+        "eci", "era", " as", "thi", "ive", " un", "ula", "nal", "not", "und", " fr", "ces", "ith", " fi", "wit",
+        "her", " su", "sec", "spo", "omm", "est", "his", "bit", " fe", " on", "man", "str", "all", "tin", "gul",
+        "ris", "sen", "ess", "egu", "ll ", "ty ", "wil", "nde", "dar", "nts", " we", "ere", "isp", "ose", "ver",
+        "ted", "red", "ary", "sed", "rte", "ede", "ay ", "fic", "ide", " wh", "fed", "pos", "abl", "ble", "tor",
+        " ar", "ste", "tic", " go", "gov", "gen", " ad", "ica", "are", "pot", "ove", "vic", "en ", "ant", "ity",
+        "ana", " d ", "abi", "ine", " pu", "nti", "end", " al", "et ", "by ", "ifi", "nta", "rov", "ovi", "int",
+        " ta", "mme", "per", " s ", "vis"
+    ],
+    "spanish": [
+        " de", "de ", "os ", " la", "es ", "el ", "as ", " co", "la ", "ent", "ón ", "ión", "ció", "en ", "nte",
+        "aci", " el", " en", "que", " re", " se", "res", " pr", "con", "est", "do ", "ue ", "al ", " y ", " qu",
+        " lo", "del", "to ", "te ", " a ", "los", "sta", "ado", " in", " es", "ra ", "ica", "lo ", "ion", "ien",
+        "art", "pro", "ter", "cio", "las", " po", "les", "ida", " su", "or ", " ar", "se ", "io ", "por", " o ",
+        "ici", "par", "nto", "pre", "men", "nes", " pa", "da ", "cul", "nci", "ale", "ar ", "ada", "des", "ta ",
+        "rá ", "rio", "tiv", "dad", "for", " ca", "dos", "ara", "one", "ona", "ulo", "era", "min", "ste", " fo",
+        "nta", "enc", "ten", " le", "tar", "eri", "cia", "re ", " si", "per", "ect", "ant", "tra", " un", "tal",
+        "ist", " me", "edi", "den", "cor", " ma", "ble", "ido", "rac", " di", " ac", "an ", " cu", " na", "fic",
+        "ícu", "rtí", "reg", "tíc", "ser", "das", "on ", "ia ", "ore", "com", "tes", "esp", "erá", " no", "tos",
+        "ro ", "ari", " pe", "pla", "na ", "cre", "no ", " al", "orm", " mi", "lic", "ad ", "ene", "abl", " pl",
+        "ivo", "str", "er ", "ons", "ese", "ini", " bo", " m ", "tur", "so ", "ral", "ura", " so", "ita", "rec",
+        "cto", "dic", "eci", "lan", "ndo", "ina", "ade", "iza", "ont", "sen", "nal", "ley", "sti", "ifi", "ora",
+        "nis", "ey ", "tor", "ria", "man", "vo ", "nat", "jo ", "gen", "ner", "deb", "lec", "ndi", "ame", "tro",
+        "ca ", " tr", "tab", "ane", "mie"
+    ],
+}
+
+
+def count_trigrams(text: str) -> Counter:
+    """
+    Count the character trigrams of the words of a text, padding each word with spaces (" the" and "he " are counted)
+    """
+    trigrams = Counter()
+    for word in WORD_PATTERN.findall(text.lower()):
+        padded_word = f" {word} "
+        for i in range(len(padded_word) - 2):
+            trigrams[padded_word[i:i + 3]] += 1
+
+    return trigrams
+
+
+def build_language_profile(texts: List[str], profile_size: int = PROFILE_SIZE) -> List[str]:
+    """
+    Return the most common trigrams of a set of texts of the same language, from most to least common
+    """
+    trigrams = Counter()
+    for text in texts:
+        trigrams.update(count_trigrams(text))
+
+    return [trigram for trigram, _ in trigrams.most_common(profile_size)]
+
+
+PROFILE_RANKS = {language: {trigram: rank for rank, trigram in enumerate(profile)}
+                 for language, profile in LANGUAGE_PROFILES.items()}
+
+
+def language_distances(text: str, prefix_length: int = DETECTION_PREFIX_LENGTH) -> Dict[str, int]:
+    """
+    Out-of-place distance between the first prefix_length characters of a text and each language profile.
+    The lower the distance, the closer the text is to the language
+    """
+    doc_profile = [trigram for trigram, _ in count_trigrams(text[:prefix_length]).most_common(PROFILE_SIZE)]
+
+    distances = {}
+    for language, ranks in PROFILE_RANKS.items():
+        distances[language] = sum(abs(ranks[trigram] - rank) if trigram in ranks else PROFILE_SIZE
+                                  for rank, trigram in enumerate(doc_profile))
+
+    return distances
+
+
+def detect_language(text: str, default: str = None, prefix_length: int = DETECTION_PREFIX_LENGTH) -> str:
+    """
+    Return the language ("english" or "spanish") closest to the beginning of the text.
+    If the text has no words to compare (i.e. an empty or only numeric file), the default language is returned
+    """
+    distances = language_distances(text, prefix_length)
+    if all(distance == 0 for distance in distances.values()):
+        return default
+
+    return min(distances, key=distances.get)
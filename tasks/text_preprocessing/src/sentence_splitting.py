@@ -3,6 +3,10 @@
         $ python sentence_splitting.py -c [path_to_aws_credentials_json] -l [english | spanish] -n [any integer]
     -  English documents, 5 words minimum for a sentence to be stored
         $ python sentence_splitting.py -c /Users/some_user/credentials.json -l english -n 5
+    -  Same as above, splitting the documents with 8 processes
+        $ python sentence_splitting.py -c /Users/some_user/credentials.json -l english -n 5 -w 8
+    -  Same as above, reading and writing files in a local copy of the bucket instead of S3
+        $ python sentence_splitting.py -s /Users/some_user/wri-nlp-policy/ -l english -n 5 -w 8
 
     Expected format for JSON credentials file:
     {
@@ -30,18 +34,34 @@
     }
 
 """
-from typing import Dict, List, Any, Set
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from hashlib import sha1
+from threading import Lock
+from typing import Dict, List, Any, Set, Tuple
 
 from tasks.text_preprocessing.src.utils import *
-from tasks.data_loading import S3Client
+from tasks.text_preprocessing.src.language_detection import detect_language, LANGUAGE_PROFILES
+from tasks.data_loading import S3Client, LocalBackend, bounded_ordered_map
 
+import os
+import copy
 import nltk
 import json
+import pickle
 import argparse
 import unidecode
 
-EN_TOKENIZER = nltk.data.load("tokenizers/punkt/english.pickle")
-ES_TOKENIZER = nltk.data.load("tokenizers/punkt/spanish.pickle")
+TEXT_CLEANER = TextCleaner()
+# Punkt tokenizers built by get_punkt_tokenizer(), by (language, hash of the abbreviations)
+PUNKT_TOKENIZERS = {}
+PUNKT_TOKENIZERS_LOCK = Lock()
+PUNKT_CACHE_FOLDER = "../output/punkt_tokenizers"
+# Tokenizers used by split_document() in the current process, by language, set up by init_splitting_worker()
+WORKER_TOKENIZERS = {}
+
+# Ids of the documents of a language whose sentences are stored, but whose text files are not moved yet
+CHECKPOINT_FILE = "../output/sentence_splitting_checkpoint_{language}.txt"
 
 
 def format_sents_for_output(sents: List[str], doc_id: str) -> Dict[str, Dict[str, Any]]:
@@ -68,37 +88,36 @@ def preprocess_text(txt: str, remove_new_lines: bool = False) -> str:
         4. Remove excessive spaces (more than 1 occurrence)
         5. Parse emails and abreviations
     """
-    txt = replace_links(remove_html_tags(txt)).strip()
-    if remove_new_lines:
-        txt = txt.replace("\n", " ").replace("\t", " ").strip()
-
-    txt = remove_multiple_spaces(txt)
-    txt = parse_emails(txt)
-    txt = parse_acronyms(txt)
+    return normalize_periods(TEXT_CLEANER.clean(txt, remove_new_lines))
 
-    new_txt = ""
-    all_period_idx = set([indices.start() for indices in re.finditer("\.", txt)])
 
-    for i, char in enumerate(txt):
-        if i in all_period_idx:
-            # Any char following a period that is NOT a space means that we should not add that period
-            if i + 1 < len(txt) and txt[i + 1] != " ":
-                continue
+def normalize_periods(txt: str) -> str:
+    """
+    Remove the periods that should not end a sentence, in a single pass over the text.
+    Kept text is collected in slices between the dropped periods and joined once at the end.
+    """
+    chunks = []
+    txt_len = len(txt)
+    last_idx = 0
+    i = txt.find(".")
 
-            # NOTE: Any char that is a number following a period will not count.
-            # For enumerations, we're counting on docs being enumerated as "(a)" or "(ii)", and if not,
-            # they will be separated by the "." after the number:
-            # "Before bullet point. 3. Bullet point text" will just be "Before bullet point 3." and "Bullet point text" as the sentences
-            if i + 2 < len(txt) and txt[i + 2].isnumeric():
-                continue
+    while i != -1:
+        # Any char following a period that is NOT a space means that we should not add that period
+        # NOTE: Any char that is a number following a period will not count.
+        # For enumerations, we're counting on docs being enumerated as "(a)" or "(ii)", and if not,
+        # they will be separated by the "." after the number:
+        # "Before bullet point. 3. Bullet point text" will just be "Before bullet point 3." and "Bullet point text" as the sentences
+        # If we wanted to have all numbered lists together, replace the second condition by:
+        # i + 2 < txt_len and not txt[i + 2].isalpha()
+        if (i + 1 < txt_len and txt[i + 1] != " ") or (i + 2 < txt_len and txt[i + 2].isnumeric()):
+            chunks.append(txt[last_idx:i])
+            last_idx = i + 1
 
-            # If we wanted to have all numbered lists together, uncomment this, and comment out the previous condition
-            # if i + 2 < len(txt) and not txt[i + 2].isalpha():
-            #     continue
+        i = txt.find(".", i + 1)
 
-        new_txt += char
+    chunks.append(txt[last_idx:])
 
-    return new_txt
+    return "".join(chunks)
 
 
 def preprocess_english_text(txt: str, remove_new_lines: bool = False) -> str:
@@ -109,6 +128,10 @@ def preprocess_spanish_text(txt: str, remove_new_lines: bool = False) -> str:
     return unidecode.unidecode(preprocess_text(txt, remove_new_lines))
 
 
+PREPROCESSING_FUNCTIONS = {"english": preprocess_english_text,
+                           "spanish": preprocess_spanish_text}
+
+
 def remove_short_sents(sents: List[str], min_num_words: int = 4) -> List[str]:
     """
     Remove sentences that are made of less than a given number of words. Default is 4
@@ -116,51 +139,243 @@ def remove_short_sents(sents: List[str], min_num_words: int = 4) -> List[str]:
     return [sent for sent in sents if len(sent.split()) >= min_num_words]
 
 
+def with_abbreviations(tokenizer: nltk.PunktSentenceTokenizer, abbreviations: Set[str]) -> nltk.PunktSentenceTokenizer:
+    """
+    Return a copy of the tokenizer whose abbreviations also include the given ones, stored as a frozenset.
+    The original tokenizer is left untouched, and the rest of the Punkt parameters are shared with it
+    """
+    new_params = copy.copy(tokenizer._params)
+    new_params.abbrev_types = frozenset(tokenizer._params.abbrev_types) | frozenset(abbreviations)
+
+    new_tokenizer = copy.copy(tokenizer)
+    new_tokenizer._params = new_params
+    return new_tokenizer
+
+
+def get_punkt_tokenizer(language: str, abbreviations: Set[str] = None,
+                        cache_folder: str = PUNKT_CACHE_FOLDER) -> nltk.PunktSentenceTokenizer:
+    """
+    Return the Punkt tokenizer of a language, with the given extra abbreviations (i.e. from S3Client.get_abbreviations()).
+    Each variant is only built once per process: it is kept in memory, and pickled to the cache folder with a name
+    that includes a hash of the abbreviations, so other processes and later runs load it directly.
+    The tokenizers returned should not be modified, which makes them safe to share between threads
+    """
+    abbreviations = frozenset(abbreviations or [])
+    abbrevs_hash = sha1("\n".join(sorted(abbreviations)).encode("utf-8")).hexdigest()[:16]
+    key = (language, abbrevs_hash)
+
+    with PUNKT_TOKENIZERS_LOCK:
+        if key not in PUNKT_TOKENIZERS:
+            cache_fpath = os.path.join(cache_folder, f"{language}_{abbrevs_hash}.pickle")
+            if os.path.exists(cache_fpath):
+                with open(cache_fpath, "rb") as f:
+                    tokenizer = pickle.load(f)
+            else:
+                tokenizer = with_abbreviations(nltk.data.load(f"tokenizers/punkt/{language}.pickle"), abbreviations)
+                os.makedirs(cache_folder, exist_ok=True)
+                tmp_fpath = f"{cache_fpath}.{os.getpid()}.tmp"
+                with open(tmp_fpath, "wb") as f:
+                    pickle.dump(tokenizer, f)
+                os.replace(tmp_fpath, cache_fpath)
+
+            PUNKT_TOKENIZERS[key] = tokenizer
+
+        return PUNKT_TOKENIZERS[key]
+
+
 def get_nltk_sents(txt: str, tokenizer: nltk.PunktSentenceTokenizer, extra_abbreviations: Set[str] = None) -> List[str]:
-    if extra_abbreviations is not None:
-        tokenizer._params.abbrev_types.update(extra_abbreviations)
+    """
+    Split a text into sentences. Extra abbreviations are better merged once with get_punkt_tokenizer(), but if they
+    are given here, the tokenizer is copied with them instead of being modified
+    """
+    if extra_abbreviations is not None and not set(extra_abbreviations) <= tokenizer._params.abbrev_types:
+        tokenizer = with_abbreviations(tokenizer, extra_abbreviations)
 
     return tokenizer.tokenize(txt)
 
 
-def main(credentials_fpath, language, min_num_words, print_every):
+def init_splitting_worker(abbrevs_per_language: Dict[str, Set[str]]) -> None:
+    """
+    Set up the Punkt tokenizers of a worker process once, one per language with its extra abbreviations
+    already merged, instead of updating them for every document
+    """
+    for language, abbrevs in abbrevs_per_language.items():
+        WORKER_TOKENIZERS[language] = get_punkt_tokenizer(language, abbrevs)
+
+
+def split_document(file_id: str, text: str, min_num_words: int, language: str,
+                   detect_languages: bool = False) -> Tuple[str, str, Dict[str, Dict[str, Any]], Exception]:
+    """
+    Preprocess and split a single text file into sentences, using the tokenizers set up by init_splitting_worker().
+    If detect_languages is True, the preprocessing and tokenizer are chosen by the language detected at the beginning
+    of the text, and the given language is only used when it can't be detected.
+    Return the file id, the language of the document, the formatted sentences and the exception raised while
+    processing, if any
+    """
+    try:
+        file_id = file_id.replace("/", "")
+        if detect_languages:
+            language = detect_language(text, default=language)
+
+        preprocessed_text = PREPROCESSING_FUNCTIONS[language](text)
+        sents = get_nltk_sents(preprocessed_text, WORKER_TOKENIZERS[language])
+        return file_id, language, format_sents_for_output(remove_short_sents(sents, min_num_words), file_id), None
+
+    except Exception as e:
+        return file_id, language, None, e
+
+
+def load_checkpoint(checkpoint_fpath: str) -> List[str]:
+    """
+    Get the ids of the documents whose sentences were stored by a previous run, but whose text files were not moved to
+    the processed folder yet
+    """
+    if not os.path.exists(checkpoint_fpath):
+        return []
+
+    with open(checkpoint_fpath, "r") as f:
+        return list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+
+def update_checkpoint(checkpoint_file, file_ids: List[str]) -> None:
+    """
+    Append the ids of stored documents to the checkpoint, and make sure they reach the disk before moving on
+    """
+    checkpoint_file.write("".join(file_id + "\n" for file_id in file_ids))
+    checkpoint_file.flush()
+    os.fsync(checkpoint_file.fileno())
+
+
+def clear_checkpoint(checkpoint_file) -> None:
+    """
+    Empty the checkpoint, once the text files of all the documents in it were moved
+    """
+    checkpoint_file.seek(0)
+    checkpoint_file.truncate()
+    checkpoint_file.flush()
+    os.fsync(checkpoint_file.fileno())
+
+
+def commit_stored_documents(s3_client: S3Client, stored_ids: List[str], language: str, checkpoint_file,
+                            error_files: List[Dict[str, Any]]) -> None:
+    """
+    Move the text files of a batch of documents whose sentences are already stored to the processed folder,
+    then clear the checkpoint. Files that could not be moved are added to the error files, and as they are still in the
+    new folder, the next run splits and moves them again
+    """
+    move_result = s3_client.move_objects([file_id + ".txt" for file_id in stored_ids],
+                                         f"{language}_documents/text_files/new",
+                                         f"{language}_documents/text_files/processed")
+    for obj_name, move_error in move_result.failed.items():
+        error_files.append({obj_name[:-len(".txt")]: move_error})
+
+    clear_checkpoint(checkpoint_file)
+
+
+def resume_from_checkpoint(s3_client: S3Client, language: str, checkpoint_fpath: str, checkpoint_file,
+                           error_files: List[Dict[str, Any]]) -> None:
+    """
+    Move the text files of the documents that a previous run stored but did not move, instead of splitting them again.
+    Documents whose text file is not in the new folder anymore (i.e. it was moved right before that run stopped) are
+    left out
+    """
+    pending_ids = load_checkpoint(checkpoint_fpath)
+    if not pending_ids:
+        return
+
+    new_folder = f"{language}_documents/text_files/new/"
+    new_keys = set(obj.key for obj in s3_client.backend.list_objects(new_folder))
+    pending_ids = [file_id for file_id in pending_ids if f"{new_folder}{file_id}.txt" in new_keys]
+    print(f"Resuming from checkpoint {checkpoint_fpath}: moving {len(pending_ids)} documents that were already split")
+
+    if pending_ids:
+        commit_stored_documents(s3_client, pending_ids, language, checkpoint_file, error_files)
+    else:
+        clear_checkpoint(checkpoint_file)
+
+
+def main(credentials_fpath, language, min_num_words, print_every, n_workers=1, checkpoint_fpath=None,
+         storage_path=None, prefetch=0, move_batch_size=100, detect_languages=False):
     """
     1. Set up S3 bucket object using credentials from given file
     2. Iterate through new text files in given language folder (i.e english_documents/text_files/new/)
     3. For each file, split the text into sentences and store the JSON sentences file to the sentences folder in the bucket (i.e english_documents/sentences/)
-    4. Move the text file from the new to the processed folder (i.e english_documents/text_files/processed/)
+    4. Every move_batch_size files, move the text files from the new to the processed folder (i.e english_documents/text_files/processed/)
+
+    With more than one worker, step 3 is split across a pool of processes, while results are still stored in order.
+    Every stored file id is appended to the checkpoint file of the language until its text file is moved, so a run
+    that crashed moves them first when started again, instead of splitting them again.
+    If a storage path is given, a local copy of the bucket in that folder is used instead of S3.
+    With prefetch > 0, that many text files are downloaded in the background while the current ones are split.
+    With detect_languages, each document is preprocessed, split and stored according to its own language
+    (i.e. a spanish document found in english_documents/text_files/new/ is stored in spanish_documents/sentences/).
     """
 
+    backend = LocalBackend(storage_path) if storage_path else None
     s3_client = S3Client(creds_filepath=credentials_fpath,
-                         bucket_name="wri-nlp-policy", language="spanish")
+                         bucket_name="wri-nlp-policy", language=language, backend=backend)
+
+    if detect_languages:
+        abbrevs = {lang: s3_client.get_abbreviations(lang) for lang in LANGUAGE_PROFILES}
+    else:
+        abbrevs = {language: s3_client.get_abbreviations(language)}
 
-    abbrevs = s3_client.get_abbreviations("spanish")
-    tokenizer = ES_TOKENIZER if language == "spanish" else EN_TOKENIZER
+    if checkpoint_fpath is None:
+        checkpoint_fpath = CHECKPOINT_FILE.format(language=language)
 
-    new_text_files_folder = f"{language}_documents/text_files/new"
-    processed_text_files_folder = f"{language}_documents/text_files/processed"
+    split_fn = partial(split_document, min_num_words=min_num_words, language=language,
+                       detect_languages=detect_languages)
+
+    # Also builds the cached tokenizer before the workers start, so they only need to load it
+    init_splitting_worker(abbrevs)
 
     i = 0
     error_files = []
-    for file_id, text in s3_client.load_text_files(language):
+    stored_ids = []
+    with open(checkpoint_fpath, "a") as checkpoint_file:
+        resume_from_checkpoint(s3_client, language, checkpoint_fpath, checkpoint_file, error_files)
+
+        documents = s3_client.load_text_files(language, prefetch)
+        executor = None
         try:
-            file_id = file_id.replace("/", "")
-            preprocessed_text = preprocess_spanish_text(text)
-            sents = get_nltk_sents(preprocessed_text, tokenizer, abbrevs)
-            postprocessed_sents = format_sents_for_output(remove_short_sents(sents, min_num_words), file_id)
-            s3_client.store_sentences(postprocessed_sents, file_id, language)
-            s3_client.move_object(file_id + ".txt", new_text_files_folder, processed_text_files_folder)
+            if n_workers > 1:
+                executor = ProcessPoolExecutor(max_workers=n_workers, initializer=init_splitting_worker,
+                                               initargs=(abbrevs,))
+                results = bounded_ordered_map(executor, split_fn, documents, window=2 * n_workers)
+            else:
+                results = (split_fn(file_id, text) for file_id, text in documents)
+
+            for file_id, doc_language, postprocessed_sents, error in results:
+                try:
+                    if error is not None:
+                        raise error
+
+                    s3_client.store_sentences(postprocessed_sents, file_id, doc_language)
+                    update_checkpoint(checkpoint_file, [file_id])
+                    stored_ids.append(file_id)
+
+                except Exception as e:
+                    error_files.append({file_id: e})
+
+                i += 1
+
+                if len(stored_ids) >= move_batch_size:
+                    commit_stored_documents(s3_client, stored_ids, language, checkpoint_file, error_files)
+                    stored_ids = []
 
-        except Exception as e:
-            error_files.append({file_id: e})
+                if i % print_every == 0:
+                    print("----------------------------------------------")
+                    print(f"Processing {i} documents...")
+                    print(f"Number of errors so far: {len(error_files)}")
+                    print("----------------------------------------------")
 
-        i += 1
+            if stored_ids:
+                commit_stored_documents(s3_client, stored_ids, language, checkpoint_file, error_files)
 
-        if i % print_every == 0:
-            print("----------------------------------------------")
-            print(f"Processing {i} documents...")
-            print(f"Number of errors so far: {len(error_files)}")
-            print("----------------------------------------------")
+        finally:
+            # Also stops the workers when storing or moving the documents fails
+            if executor is not None:
+                executor.shutdown()
 
     with open("../output/sentence_splitting_errors.json", "w") as f:
         json.dump(error_files, f)
@@ -174,15 +389,32 @@ def main(credentials_fpath, language, min_num_words, print_every):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('-c', '--creds_file', required=True,
-                        help="AWS credentials JSON file")
+    parser.add_argument('-c', '--creds_file',
+                        help="AWS credentials JSON file. Required unless a local storage path is given")
     parser.add_argument('-l', '--language', required=True,
-                        help="Language for sentence preprocessing/splitting. Current options are: english, spanish")
+                        help="Language folder of the documents to split, and their language unless --detect_languages "
+                             "is given. Current options are: english, spanish")
     parser.add_argument('-n', '--min_num_words', default=5,
                         help="Minimum number of words that a sentence needs to have to be stored")
     parser.add_argument('-p', '--print_every', default=100,
                         help="Print status of preprocessing every X iterations")
+    parser.add_argument('-w', '--workers', default=1,
+                        help="Number of processes used to preprocess and split the documents in parallel")
+    parser.add_argument('-k', '--checkpoint_file', default=None,
+                        help="File where the ids of the stored documents whose text files are not moved yet are kept, "
+                             "to resume a stopped run. Defaults to one file per language in ../output/")
+    parser.add_argument('-s', '--storage_path', default=None,
+                        help="Local folder with the same structure as the S3 bucket, to run without network access")
+    parser.add_argument('-f', '--prefetch', default=0,
+                        help="Number of text files to download concurrently ahead of the ones being split")
+    parser.add_argument('-b', '--move_batch_size', default=100,
+                        help="Number of split documents whose text files are moved to the processed folder together")
+    parser.add_argument('--detect_languages', action='store_true',
+                        help="Detect the language of each document and process it accordingly, instead of processing "
+                             "all the documents as written in the given language")
 
     args = parser.parse_args()
 
-    main(args.creds_file, args.language, int(args.min_num_words), int(args.print_every))
+    main(args.creds_file, args.language, int(args.min_num_words), int(args.print_every),
+         int(args.workers), args.checkpoint_file, args.storage_path, int(args.prefetch),
+         int(args.move_batch_size), args.detect_languages)
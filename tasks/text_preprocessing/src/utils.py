@@ -41,3 +41,50 @@ def parse_acronyms(text: str) -> str:
 
     return text
 
+
+
+class TextCleaner:
+    """
+    Same cleaning steps as the functions above, with all the regular expressions compiled once.
+    Emails and acronyms are rewritten in a single re.sub() call, so a document is cleaned in a fixed number of
+    passes instead of one str.replace() over the whole text for each email or acronym found
+    """
+
+    def __init__(self):
+        self.html_tags_pattern = re.compile(r"<.*?>")
+        self.links_pattern = re.compile(r"http\S+|www\S+")
+        self.multiple_spaces_pattern = re.compile(r"\s+")
+        self.emails_and_acronyms_pattern = re.compile(r"(?P<email>\S*@\S*\s?)|(?P<acronym>\b(?:[a-zA-Z]\.){2,})")
+
+    def remove_html_tags(self, text: str) -> str:
+        return self.html_tags_pattern.sub("", text)
+
+    def replace_links(self, text: str) -> str:
+        return self.links_pattern.sub("[URL]", text)
+
+    def remove_multiple_spaces(self, text: str) -> str:
+        return self.multiple_spaces_pattern.sub(" ", text)
+
+    @staticmethod
+    def _parse_email_or_acronym(match) -> str:
+        """
+        Remove the periods from an email (except the last one) or from an acronym
+        """
+        matched_text = match.group(0)
+        if match.group("email") is not None and matched_text[-1] == ".":
+            return matched_text[:-1].replace(".", "") + "."
+
+        return matched_text.replace(".", "")
+
+    def parse_emails_and_acronyms(self, text: str) -> str:
+        return self.emails_and_acronyms_pattern.sub(self._parse_email_or_acronym, text)
+
+    def clean(self, text: str, remove_new_lines: bool = False) -> str:
+        """
+        Remove HTML tags, replace URLs by a tag [URL], remove excessive spaces and parse emails and acronyms
+        """
+        text = self.replace_links(self.remove_html_tags(text)).strip()
+        if remove_new_lines:
+            text = text.replace("\n", " ").replace("\t", " ").strip()
+
+        return self.parse_emails_and_acronyms(self.remove_multiple_spaces(text))
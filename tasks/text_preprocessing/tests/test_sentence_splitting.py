@@ -0,0 +1,118 @@
+import json
+import multiprocessing
+
+import nltk
+import pytest
+
+from tasks.data_loading import LocalBackend
+from tasks.text_preprocessing.src import sentence_splitting
+
+ENGLISH_TEXT = ("The farmers of the region will receive a payment for each hectare of forest that they protect. "
+                "This program is managed by the ministry of agriculture, and it is funded by the national government. "
+                "The payments will be made every year for a period of ten years.")
+SPANISH_TEXT = ("Los agricultores de la región recibirán un pago por cada hectárea de bosque que protejan. "
+                "Este programa es administrado por el ministerio de agricultura, y es financiado por el gobierno "
+                "nacional. Los pagos se realizarán cada año durante un período de diez años.")
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    """
+    Local copy of the bucket with a spanish document among the new english text files, and the working directory
+    that sentence_splitting.main() writes its error file to
+    """
+    storage_path = tmp_path / "bucket"
+    backend = LocalBackend(str(storage_path))
+    for file_id, text in [("a1", ENGLISH_TEXT), ("b2", SPANISH_TEXT), ("c3", ENGLISH_TEXT)]:
+        backend.put(f"english_documents/text_files/new/{file_id}.txt", text)
+    for language in ["english", "spanish"]:
+        backend.put(f"abbreviations/{language}_abbreviations.txt", "etc\ne.g")
+
+    # Untrained Punkt tokenizers, the trained ones are not needed to route the documents
+    monkeypatch.setattr(sentence_splitting, "get_punkt_tokenizer",
+                        lambda language, abbreviations=None: nltk.PunktSentenceTokenizer())
+    (tmp_path / "output").mkdir()
+    (tmp_path / "src").mkdir()
+    monkeypatch.chdir(tmp_path / "src")
+
+    return storage_path, backend
+
+
+def test_mixed_language_documents_are_stored_and_moved(bucket, tmp_path):
+    storage_path, backend = bucket
+    sentence_splitting.main(None, "english", 4, 100, checkpoint_fpath=str(tmp_path / "checkpoint.txt"),
+                            storage_path=str(storage_path), move_batch_size=2, detect_languages=True)
+
+    assert [obj.key for obj in backend.list_objects("english_documents/sentences/")] == [
+        "english_documents/sentences/a1_sents.json", "english_documents/sentences/c3_sents.json"]
+    assert [obj.key for obj in backend.list_objects("spanish_documents/sentences/")] == [
+        "spanish_documents/sentences/b2_sents.json"]
+    spanish_sents = json.loads(backend.get("spanish_documents/sentences/b2_sents.json"))
+    assert spanish_sents["b2"]["metadata"]["language"] == "spanish"
+
+    assert list(backend.list_objects("english_documents/text_files/new/")) == []
+    assert [obj.key for obj in backend.list_objects("english_documents/text_files/processed/")] == [
+        f"english_documents/text_files/processed/{file_id}.txt" for file_id in ["a1", "b2", "c3"]]
+    assert json.loads((tmp_path / "output" / "sentence_splitting_errors.json").read_text()) == []
+
+
+def run_splitting(storage_path, monkeypatch):
+    """
+    Run sentence_splitting.main() on the english documents with the default checkpoint, and return the ids it split
+    """
+    split_ids = []
+    split_document = sentence_splitting.split_document
+
+    def recording_split_document(file_id, *args, **kwargs):
+        split_ids.append(file_id)
+        return split_document(file_id, *args, **kwargs)
+
+    monkeypatch.setattr(sentence_splitting, "split_document", recording_split_document)
+    sentence_splitting.main(None, "english", 4, 100, storage_path=str(storage_path), move_batch_size=2)
+    return split_ids
+
+
+def test_resumed_run_moves_the_stored_documents_without_splitting_them_again(bucket, tmp_path, monkeypatch):
+    storage_path, backend = bucket
+    move_objects = sentence_splitting.S3Client.move_objects
+
+    def crashing_move_objects(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(sentence_splitting.S3Client, "move_objects", crashing_move_objects)
+    with pytest.raises(KeyboardInterrupt):
+        run_splitting(storage_path, monkeypatch)
+
+    checkpoint_fpath = tmp_path / "output" / "sentence_splitting_checkpoint_english.txt"
+    assert checkpoint_fpath.read_text().split() == ["a1", "b2"]
+
+    monkeypatch.setattr(sentence_splitting.S3Client, "move_objects", move_objects)
+    assert [file_id.replace("/", "") for file_id in run_splitting(storage_path, monkeypatch)] == ["c3"]
+
+    assert list(backend.list_objects("english_documents/text_files/new/")) == []
+    assert [obj.key for obj in backend.list_objects("english_documents/sentences/")] == [
+        f"english_documents/sentences/{file_id}_sents.json" for file_id in ["a1", "b2", "c3"]]
+    assert checkpoint_fpath.read_text() == ""
+
+
+def test_moved_documents_are_not_skipped_when_uploaded_again(bucket, tmp_path, monkeypatch):
+    storage_path, backend = bucket
+    run_splitting(storage_path, monkeypatch)
+
+    backend.put("english_documents/text_files/new/a1.txt", ENGLISH_TEXT)
+    assert [file_id.replace("/", "") for file_id in run_splitting(storage_path, monkeypatch)] == ["a1"]
+    assert list(backend.list_objects("english_documents/text_files/new/")) == []
+
+
+def test_workers_are_stopped_when_moving_fails(bucket, monkeypatch):
+    storage_path, _ = bucket
+
+    def failing_move_objects(*args, **kwargs):
+        raise OSError("Bucket not reachable")
+
+    monkeypatch.setattr(sentence_splitting.S3Client, "move_objects", failing_move_objects)
+    with pytest.raises(OSError):
+        sentence_splitting.main(None, "english", 4, 100, n_workers=2, storage_path=str(storage_path),
+                                move_batch_size=1)
+
+    assert multiprocessing.active_children() == []